@@ -11,22 +11,73 @@ Usage:
 Options:
     -R, --render=<render_option>    The typology of render engine to be used. By
                                     default it uses `matplotlib`. The other
-                                    option is to use the more fancy `opengl`, or
-                                    `file` to store output into a file.
+                                    option is to use the more fancy `opengl`,
+                                    `file` to store output into a file, or
+                                    `density` to write density map images.
                                     [default: matplotlib]
 
     --step=<step>                   Simulation step between each render
                                     [default: 5]
+
+    --theta=<theta>                 Opening angle of the Barnes-Hut algorithm
+                                    [default: 0.5]
+
+    --softening=<law>               Softening of the interaction: `plummer`,
+                                    `spline` or `none` (see
+                                    pygalaxy.forces.make_kernel)
+                                    [default: plummer]
+
+    --force-error=<error>           If given, theta is tuned during the run to
+                                    keep this relative error on the forces.
+
+    --tracers=<n>                   Number of massless tracer stars added to
+                                    each galaxy, they move in the field of
+                                    the massive bodies without entering the
+                                    tree [default: 0]
+
+    --treepm=<ngrid>                If given, use the TreePM engine with a
+                                    mesh of ngrid x ngrid nodes for the long
+                                    range forces (not with the `spline`
+                                    softening).
+
+    --core-quantile=<q>             If given, bodies outside the core domain
+                                    of this quantile are left out of the
+                                    tree and computed directly.
+
+    --escape-radius=<radius>        If given, bodies further than this radius
+                                    from the center of mass are removed.
+
+    --capture-radius=<radius>       If given, bodies closer than this radius
+                                    at the end of a step are merged (the
+                                    `file` renderer needs a fixed body count).
+
+    --serve=<port>                  If given, stream the positions to the
+                                    clients of a snapshot server on this
+                                    localhost port (see pygalaxy.streaming).
+
+    --background=<mode>             Run the simulation in a background `thread`
+                                    or `process` so that rendering does not
+                                    wait for the simulation steps (the body
+                                    count must be fixed: not with
+                                    --capture-radius or --escape-radius).
 """
 import numpy as np
 import importlib
+import functools
 
 from docopt import docopt
 # autopep8: off
 import sys
 sys.path.append('../')
 import pygalaxy
-from pygalaxy.barnes_hut_array import compute_energy
+from pygalaxy.barnes_hut_array import compute_energy, BarnesHut, ThetaTuner
+from pygalaxy.particle_mesh import TreePM
+from pygalaxy.forces import make_kernel
+from pygalaxy.runner import BackgroundSimulation
+from pygalaxy.encounters import Encounters
+from pygalaxy.escapers import remove_escapers
+from pygalaxy.streaming import SnapshotServer
+from pygalaxy.simulation import Simulation
 # autopep8: on
 
 def temp2color(temps):
@@ -61,26 +112,44 @@ def temp2color(temps):
     return colors
 
 
-class Galaxy:
-    def __init__(self, blackHole, dt=10., display_step=1):
-        self.mass, self.particles = pygalaxy.init_collisions(blackHole)
-        # self.time_method = pygalaxy.ADB6(dt, self.particles.shape[0], compute_energy)
-        # self.time_method = pygalaxy.Euler_symplectic(dt, self.particles.shape[0], compute_energy)
-        # self.time_method = pygalaxy.Stormer_verlet(dt, self.particles.shape[0], compute_energy)
-        self.time_method = pygalaxy.Optimized_815(
-            dt, self.particles.shape[0], compute_energy)
+class Galaxy(Simulation):
+    def __init__(self, blackHole, dt=10., display_step=1, compute_energy=compute_energy,
+                 capture_radius=None, escape_radius=None, serve=None):
+        mass, particles = pygalaxy.init_collisions(blackHole)
+        # scheme = pygalaxy.ADB6(dt, particles.shape[0], compute_energy)
+        # scheme = pygalaxy.Euler_symplectic(dt, particles.shape[0], compute_energy)
+        # scheme = pygalaxy.Stormer_verlet(dt, particles.shape[0], compute_energy)
+        scheme = pygalaxy.Optimized_815(dt, particles.shape[0], compute_energy)
+        super().__init__(mass, particles, scheme)
         self.display_step = display_step
-        self.it = 0
+        if capture_radius is not None:
+            self.encounters = Encounters(capture_radius)
+            self.add_hook(self.merge, every=1)
+        if escape_radius is not None:
+            self.escape_radius = escape_radius
+            self.add_hook(self.remove_escapers, every=1)
+        if serve is not None:
+            self.server = SnapshotServer(port=serve).start()
+            self.add_hook(lambda s: s.server.publish(s.it, s.particles), every=1)
 
     def next(self):
-        for i in range(self.display_step):
-            self.it += 1
-            print(self.it)
-            self.time_method.update(self.mass, self.particles)
+        self.run(self.display_step)
+
+    def merge(self, simu):
+        self.mass, self.particles = self.encounters(
+            self.mass, self.particles, self.scheme, self.tree())
+
+    def remove_escapers(self, simu):
+        self.mass, self.particles, _ = remove_escapers(
+            self.mass, self.particles, self.escape_radius, scheme=self.scheme)
 
     def coords(self):
         return self.particles[:, :2]
 
+    def tree(self):
+        # tree built by the engine during the last step, if any
+        return getattr(self.engine, 'tree', None)
+
     def colors(self):
         speed_magnitude = np.linalg.norm(self.particles[:, 2:4], axis=1)
         speed_min = speed_magnitude.min()
@@ -97,6 +166,14 @@ if __name__ == '__main__':
     args = docopt(__doc__)
 
     display_step = int(args['--step'])
+    if args['--background'] is not None and (args['--capture-radius'] is not None
+                                             or args['--escape-radius'] is not None):
+        # the snapshots are published in arrays of a fixed number of bodies
+        sys.exit('--background needs a fixed body count, it cannot be used '
+                 'with --capture-radius or --escape-radius')
+    if args['--treepm'] is not None and args['--softening'] == 'spline':
+        # the split of TreePM is the one of the plummer softening
+        sys.exit('--treepm cannot be used with the spline softening')
     render_engine = args['--render']
 
     # Importing the right class for rendering from the right module
@@ -121,8 +198,38 @@ if __name__ == '__main__':
             'stars': 1000,
             'radstars': 1
         }]
-
-    sim = Galaxy(blackHole, display_step=display_step)
+    for b in blackHole:
+        b['tracers'] = int(args['--tracers'])
+
+    core_quantile = None
+    if args['--core-quantile'] is not None:
+        core_quantile = float(args['--core-quantile'])
+    kernel = make_kernel(args['--softening'])
+    if args['--treepm'] is not None:
+        engine = TreePM(float(args['--theta']), int(args['--treepm']), kernel=kernel)
+    elif args['--force-error'] is None:
+        engine = BarnesHut(float(args['--theta']), core_quantile=core_quantile,
+                           kernel=kernel)
+    else:
+        engine = ThetaTuner(float(args['--force-error']),
+                            core_quantile=core_quantile, kernel=kernel)
+
+    make_galaxy = functools.partial(Galaxy, blackHole, display_step=display_step,
+                                    compute_energy=engine,
+                                    capture_radius=None if args['--capture-radius'] is None
+                                    else float(args['--capture-radius']),
+                                    escape_radius=None if args['--escape-radius'] is None
+                                    else float(args['--escape-radius']),
+                                    serve=None if args['--serve'] is None
+                                    else int(args['--serve']))
+    fields = ('coords', 'colors', 'particles', 'mass')
+    if args['--background'] == 'thread':
+        sim = BackgroundSimulation(make_galaxy(), fields, mode='thread')
+    elif args['--background'] == 'process':
+        sim = BackgroundSimulation(fields=fields, mode='process',
+                                   factory=make_galaxy)
+    else:
+        sim = make_galaxy()
 
     anim = Animation(sim, axis=[-10., 10., -10., 10.])
 
@@ -134,3 +241,7 @@ if __name__ == '__main__':
         anim.use_nebulae_render = True
 
     anim.main_loop()
+
+    if args['--background'] is not None:
+        print(sim)
+        sim.stop()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+Compare the array of structures layout of the bodies (row major (N, 4)
+particles) with the structure of arrays one (pygalaxy.soa.Particles): time
+of the updates of a time scheme, of the tree construction, of the force walk
+and of a whole Stormer-Verlet step.
+
+
+Usage:
+    layout.py [options]
+
+Options:
+    -n, --nbodies=<n>               Number of bodies (exponential disk)
+                                    [default: 1000000]
+
+    --theta=<theta>                 Opening angle of the Barnes-Hut algorithm
+                                    [default: 0.5]
+
+    --repeat=<repeat>               Number of timed runs, the best one is kept
+                                    [default: 3]
+
+    --threads=<n>                   If given, number of threads of the
+                                    parallel kernels.
+
+    --threading-layer=<layer>       Threading layer of the parallel kernels
+                                    (see pygalaxy.config.layers)
+                                    [default: default]
+
+    --cpus=<cpus>                   If given, run on these CPUs only (e.g.
+                                    0-3,8), Linux only.
+
+    --pin                           Bind the threads to the cores (OpenMP
+                                    threading layer only).
+"""
+import time
+
+import numpy as np
+from docopt import docopt
+# autopep8: off
+import sys
+sys.path.append('../')
+import pygalaxy
+from pygalaxy import config
+from pygalaxy.barnes_hut_array import BarnesHut, build_tree
+from pygalaxy.soa import Particles, SoAStorage
+# autopep8: on
+
+
+def no_force(mass, particles, energy):
+    energy[:, :2] = particles[:, 2:]
+    energy[:, 2:] = 0.
+
+
+def stages(mass, particles, storage, theta):
+    """ Functions running each benchmarked stage for one layout. """
+    n = particles.shape[0]
+    updates = pygalaxy.Stormer_verlet(1e-3, n, no_force, storage)
+    engine = BarnesHut(theta)
+    step = pygalaxy.Stormer_verlet(1e-3, n, engine, storage)
+    energy = updates.k1.copy(order='K')
+    # compilation for this layout
+    step.update(mass, particles)
+    return [lambda: updates.update(mass, particles),
+            lambda: build_tree(mass, particles),
+            lambda: engine.walk(particles, energy),
+            lambda: step.update(mass, particles)]
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    nbodies = int(args['--nbodies'])
+    theta = float(args['--theta'])
+    repeat = int(args['--repeat'])
+    config.configure(threads=None if args['--threads'] is None else int(args['--threads']),
+                     threading_layer=args['--threading-layer'],
+                     affinity=None if args['--cpus'] is None else config.parse_cpus(args['--cpus']),
+                     pin=args['--pin'])
+
+    mass, particles = pygalaxy.exponential_disk(nbodies, seed=0)
+    bodies = Particles.from_arrays(mass, particles)
+
+    layouts = [stages(mass, particles, None, theta),
+               stages(bodies.mass, bodies.state, SoAStorage(), theta)]
+
+    # the layouts are timed alternately so that both see the same load
+    times = np.full((2, 4), np.inf)
+    for i in range(repeat):
+        for k, funcs in enumerate(layouts):
+            for j, func in enumerate(funcs):
+                t = time.perf_counter()
+                func()
+                times[k, j] = min(times[k, j], time.perf_counter() - t)
+    aos, soa = times
+
+    print(config.describe())
+    print('{:>10} {:>10} {:>10} {:>8}   (ms)'.format('', 'AoS', 'SoA', 'speedup'))
+    for name, a, s in zip(('updates', 'build', 'walk', 'step'), aos, soa):
+        print('{:>10} {:>10.1f} {:>10.1f} {:>8.2f}'.format(name, 1000*a, 1000*s, a/s))
@@ -2,12 +2,21 @@
 
 import numpy as np
 import matplotlib.pyplot as plt
-
-# load data from file render (saved by NumPy)
-particles = np.load("particles.npy")
+# autopep8: off
+import sys
+sys.path.append('../')
+from pygalaxy.trajectory import TrajectoryReader
+# autopep8: on
+
+# open data from file render (memory-mapped, nothing is loaded yet)
+trajectory = TrajectoryReader("particles.npy")
 mass = np.load("mass.npy")
 
-time = np.linspace(0, 10, particles.shape[0])
+time = np.linspace(0, 10, trajectory.nframes)
+
+# only the plotted bodies are read
+particles = trajectory.iterate(bodies=slice(0, 11))
+particles = np.concatenate([data for _, data in particles])
 
 # particles is a 3D array
 # particles[i, j, k] means:
@@ -18,7 +27,7 @@ time = np.linspace(0, 10, particles.shape[0])
 # mass is a 1D array:
 # mass[i] means: mass of ith body
 #
-# time isn't stored in simulation, need to create one with the correct shape (particles.shape[0])
+# time isn't stored in simulation, need to create one with the correct shape (trajectory.nframes)
 
 
 # first plot: history of a particles
@@ -48,11 +57,9 @@ plt.show()
 # second plot: history of velocity (magnitude)
 
 plt.title("history of velocity")
-for i in range(1, 11):
-    vx = particles[:, i, 2]
-    vy = particles[:, i, 3]
-    velocity = np.sqrt(vx**2 + vy**2)
-    plt.plot(time, velocity)
+velocity = trajectory.speed(bodies=slice(1, 11))
+for i in range(10):
+    plt.plot(time, velocity[:, i])
 
 plt.xlabel("time")
 plt.ylabel("velocity")
@@ -73,8 +80,7 @@ ax.set_xlabel("x")
 ax.set_ylabel("y")
 ax.set_zlabel("time")
 
-vmax = max([max(np.sqrt(particles[:, i, 2]**2 + particles[:, i, 3]**2))
-           for i in range(1, 11)])
+vmax = velocity.max()
 
 for i in range(1, 11):
     x = particles[:, i, 0]
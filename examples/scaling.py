@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+Time the stages of a Barnes-Hut force evaluation (tree construction, mass
+distribution, force walk) for increasing numbers of Numba threads.
+
+
+Usage:
+    scaling.py [options]
+
+Options:
+    -n, --nbodies=<n>               Number of bodies (exponential disk)
+                                    [default: 1000000]
+
+    --theta=<theta>                 Opening angle of the Barnes-Hut algorithm
+                                    [default: 0.5]
+
+    --repeat=<repeat>               Number of timed evaluations per thread
+                                    count, the best one is kept [default: 3]
+
+    --threading-layer=<layer>       Threading layer of the parallel kernels
+                                    (see pygalaxy.config.layers)
+                                    [default: default]
+
+    --cpus=<cpus>                   If given, run on these CPUs only (e.g.
+                                    0-3,8), Linux only.
+
+    --pin                           Bind the threads to the cores (OpenMP
+                                    threading layer only).
+"""
+import time
+
+import numpy as np
+from docopt import docopt
+# autopep8: off
+import sys
+sys.path.append('../')
+import pygalaxy
+from pygalaxy import config
+from pygalaxy.barnes_hut_array import quadArray
+from pygalaxy.barnes_hut_array.energy import compute_force
+from pygalaxy.forces import default_kernel
+# autopep8: on
+
+
+def stages(mass, particles, energy, theta):
+    """ Return the duration of each stage of a force evaluation. """
+    t0 = time.perf_counter()
+    root = quadArray(np.min(particles[:, :2], axis=0),
+                     np.max(particles[:, :2], axis=0), particles.shape[0])
+    root.buildTree(particles)
+    t1 = time.perf_counter()
+    root.computeMassDistribution(particles, mass)
+    t2 = time.perf_counter()
+    compute_force(root.nbodies, root.child, root.center_of_mass, root.mass,
+                  root.cell_radius, root.max_depth, particles, energy, theta,
+                  default_kernel.pair, np.empty(0))
+    t3 = time.perf_counter()
+    return np.array([t1 - t0, t2 - t1, t3 - t2])
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    nbodies = int(args['--nbodies'])
+    theta = float(args['--theta'])
+    repeat = int(args['--repeat'])
+    # before the first parallel kernel
+    config.configure(threading_layer=args['--threading-layer'],
+                     affinity=None if args['--cpus'] is None else config.parse_cpus(args['--cpus']),
+                     pin=args['--pin'])
+
+    mass, particles = pygalaxy.exponential_disk(nbodies, seed=0)
+    energy = np.zeros_like(particles)
+    # compilation
+    stages(mass, particles, energy, theta)
+
+    nthreads = [1]
+    while 2*nthreads[-1] <= config.max_threads():
+        nthreads.append(2*nthreads[-1])
+    if nthreads[-1] != config.max_threads():
+        nthreads.append(config.max_threads())
+
+    print(config.describe())
+    print('{:>8} {:>10} {:>10} {:>10}   (ms, speedup)'.format(
+        'threads', 'build', 'mass', 'walk'))
+    for n in nthreads:
+        with config.threads(n):
+            best = np.min([stages(mass, particles, energy, theta)
+                           for i in range(repeat)], axis=0)
+        if n == 1:
+            reference = best
+        print('{:>8} '.format(n) + ' '.join(
+            '{:>5.0f} {:>4.1f}'.format(1000*t, r/t)
+            for t, r in zip(best, reference)))
@@ -11,8 +11,9 @@ Usage:
 Options:
     -R, --render=<render_option>    The typology of render engine to be used. By
                                     default it uses `matplotlib`. The other
-                                    option is to use the more fancy `opengl`, or
-                                    `file` to store output into a file.
+                                    option is to use the more fancy `opengl`,
+                                    `file` to store output into a file, or
+                                    `density` to write density map images.
                                     [default: matplotlib]
 
     --step=<step>                   Simulation step between each render
@@ -28,23 +29,22 @@ import sys
 sys.path.append('../')
 import pygalaxy
 from pygalaxy.barnes_hut_array import compute_energy
+from pygalaxy.simulation import Simulation
 # autopep8: on
 
 
-class SolarSystem:
+class SolarSystem(Simulation):
     def __init__(self, dt=pygalaxy.physics.day_in_sec, display_step=1):
-        self.mass, self.particles = pygalaxy.init_solar_system()
-        # self.time_method = pygalaxy.RK4(dt, self.particles.shape[0],
+        mass, particles = pygalaxy.init_solar_system()
+        # scheme = pygalaxy.RK4(dt, particles.shape[0], compute_energy)
+        # scheme = pygalaxy.Euler_symplectic(dt, particles.shape[0],
         # compute_energy)
-        # self.time_method = pygalaxy.Euler_symplectic(dt,
-        # self.particles.shape[0], compute_energy)
-        self.time_method = pygalaxy.Optimized_815(dt, self.particles.shape[0],
-                                                  compute_energy)
+        scheme = pygalaxy.Optimized_815(dt, particles.shape[0], compute_energy)
+        super().__init__(mass, particles, scheme)
         self.display_step = display_step
 
     def next(self):
-        for i in range(self.display_step):
-            self.time_method.update(self.mass, self.particles)
+        self.run(self.display_step)
 
     def coords(self):
         return self.particles[:, :2]
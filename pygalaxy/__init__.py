@@ -1,5 +1,5 @@
-from . import physics
-from .init import init_solar_system, init_collisions
+from . import physics, config
+from .init import init_solar_system, init_collisions, generate_collisions, plummer, exponential_disk
 from .time_schemes.euler import Euler, Euler_symplectic
 from .time_schemes.rk4 import RK4
 from .time_schemes.adb6 import ADB6
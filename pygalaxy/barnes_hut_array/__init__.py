@@ -1,2 +1,3 @@
-from .energy import compute_energy
+from .energy import compute_energy, build_tree, count_massive, evaluate_field, BarnesHut
+from .autotune import ThetaTuner
 from .quadTree import quadArray
\ No newline at end of file
@@ -0,0 +1,138 @@
+import json
+
+import numpy as np
+import numba
+
+from . import numba_functions
+from .energy import BarnesHut, compute_force
+from .. import config
+
+@numba.njit(parallel=True)
+def direct_force(sample, mass, particles, pair, acc):
+    for i in numba.prange(sample.shape[0]):
+        pos = particles[sample[i], :2]
+        ax = 0.
+        ay = 0.
+        # the sources are the first mass.size bodies (tracers left out)
+        for j in range(mass.shape[0]):
+            dx = particles[j, 0] - pos[0]
+            dy = particles[j, 1] - pos[1]
+            f, _ = pair(dx**2 + dy**2, mass[j])
+            ax += f*dx
+            ay += f*dy
+        acc[i, 0] = ax
+        acc[i, 1] = ay
+
+def force_error(root, sample, particles, exact, theta, kernel):
+    """ Return the RMS relative error of the Barnes-Hut accelerations of the
+    sampled bodies against the exact ones. """
+    acc = np.zeros((sample.size, 4))
+    compute_force(root.nbodies, root.child, root.center_of_mass, root.mass,
+                  root.cell_radius, root.max_depth, particles[sample], acc,
+                  theta, kernel.pair, np.empty(0))
+    if root.escapers.size:
+        numba_functions.computeDirectForce(root.center_of_mass[root.escapers],
+                                           root.mass[root.escapers],
+                                           particles[sample], acc, kernel.pair,
+                                           np.empty(0))
+    diff = np.linalg.norm(acc[:, 2:] - exact, axis=1)
+    norm = np.linalg.norm(exact, axis=1)
+    # the relative error is not defined for bodies with no exact
+    # acceleration (symmetric configurations, or no massive bodies)
+    valid = norm > 0
+    if not valid.any():
+        return 0.
+    return np.sqrt(np.mean((diff[valid]/norm[valid])**2))
+
+class ThetaTuner(BarnesHut):
+    """ Barnes-Hut engine choosing its opening angle from a force accuracy target.
+
+    Every check_every calls, nsample bodies are drawn at random and their
+    Barnes-Hut accelerations are compared with exact direct sums. The largest
+    theta in [theta_min, theta_max] whose RMS relative error stays below
+    target_error is then kept until the next check.
+
+    Parameters:
+    -----------
+    target_error: float
+        Maximal RMS relative error on the accelerations.
+    nsample: int
+        Number of bodies used for the comparison.
+    check_every: int
+        Number of engine calls between two tunings (a time scheme may call
+        the engine several times per step).
+    theta_min, theta_max: float
+        Search interval of the opening angle.
+    niter: int
+        Number of bisection iterations.
+    seed: int
+        Seed of the sampling random generator.
+    with_potential, core_quantile, core_margin, kernel, threads:
+        See BarnesHut.
+    """
+    def __init__(self, target_error=1e-3, nsample=256, check_every=100,
+                 theta_min=0.1, theta_max=1.2, niter=8, seed=None,
+                 with_potential=False, core_quantile=None, core_margin=1.,
+                 kernel=None, threads=None):
+        super().__init__(theta_max, with_potential, core_quantile, core_margin,
+                         kernel=kernel, threads=threads)
+        self.target_error = target_error
+        self.nsample = nsample
+        self.check_every = check_every
+        self.theta_min = theta_min
+        self.theta_max = theta_max
+        self.niter = niter
+        self.rng = np.random.default_rng(seed)
+        self.error = None
+        self.ncalls = 0
+
+    def tune(self, root, mass, particles):
+        """ Set self.theta and self.error from the given tree. """
+        nsample = min(self.nsample, particles.shape[0])
+        sample = self.rng.choice(particles.shape[0], nsample, replace=False)
+        exact = np.zeros((nsample, 2))
+        direct_force(sample, mass[:root.nbodies], particles, self.kernel.pair, exact)
+
+        def error(theta):
+            return force_error(root, sample, particles, exact, theta, self.kernel)
+
+        lo, hi = self.theta_min, self.theta_max
+        err_hi = error(hi)
+        if err_hi <= self.target_error:
+            self.theta, self.error = hi, err_hi
+            return self.theta
+
+        err_lo = error(lo)
+        for i in range(self.niter):
+            mid = .5*(lo + hi)
+            err_mid = error(mid)
+            if err_mid <= self.target_error:
+                lo, err_lo = mid, err_mid
+            else:
+                hi = mid
+
+        self.theta, self.error = lo, err_lo
+        return self.theta
+
+    def checkpoint(self):
+        state = super().checkpoint()
+        state['ncalls'] = np.asarray(self.ncalls)
+        state['error'] = np.asarray(np.nan if self.error is None else self.error)
+        state['rng'] = np.asarray(json.dumps(self.rng.bit_generator.state))
+        return state
+
+    def restore(self, state):
+        super().restore(state)
+        self.ncalls = np.asarray(state['ncalls']).item()
+        error = np.asarray(state['error']).item()
+        self.error = None if np.isnan(error) else error
+        self.rng.bit_generator.state = json.loads(np.asarray(state['rng']).item())
+
+    def __call__(self, mass, particles, energy):
+        self.build(mass, particles)
+        if self.ncalls % self.check_every == 0:
+            with config.threads(self.threads):
+                self.tune(self.tree, mass, particles)
+        self.ncalls += 1
+
+        self.walk(particles, energy)
@@ -2,25 +2,123 @@ from six import print_
 
 import numpy as np
 from .quadTree import quadArray
+from ..physics import theta
+from ..forces import default_kernel
+from .. import config
 import time
 
 from . import numba_functions
 import numba
 
-@numba.njit(parallel=True)
-def compute_force( nbodies, child, center_of_mass, mass, cell_radius, particles, energy):
+@numba.njit(parallel=True, nogil=True)
+def compute_force( nbodies, child, center_of_mass, mass, cell_radius, max_depth, particles, energy, theta, pair, potential):
+    # potential is filled only if it is not empty
+    with_potential = potential.size > 0
     for i in numba.prange(particles.shape[0]):
-        acc = numba_functions.computeForce( nbodies, child, center_of_mass, mass, cell_radius, particles[i] )
+        acc = numba_functions.computeForce( nbodies, child, center_of_mass, mass, cell_radius, max_depth, particles[i], theta, pair, with_potential )
         energy[i, 2] = acc[0]
         energy[i, 3] = acc[1]
+        if with_potential:
+            potential[i] = acc[2]
 
-def compute_energy(mass, particles, energy):
-    #print('compute energy:')
-    t_tot = time.time()
+@numba.njit(parallel=True, nogil=True)
+def compute_short_force( nbodies, child, center_of_mass, mass, cell_center, cell_radius, max_depth, particles, energy, theta, pair, table, rcut, potential):
+    # short range part of a TreePM split, added to energy and potential
+    with_potential = potential.size > 0
+    for i in numba.prange(particles.shape[0]):
+        acc = numba_functions.computeShortForce( nbodies, child, center_of_mass, mass, cell_center, cell_radius, max_depth, particles[i], theta, pair, table, rcut, with_potential )
+        energy[i, 2] += acc[0]
+        energy[i, 3] += acc[1]
+        if with_potential:
+            potential[i] += acc[2]
+
+@numba.njit(parallel=True, nogil=True)
+def compute_field( nbodies, child, center_of_mass, mass, cell_radius, max_depth, points, theta, pair, acc, potential):
+    for i in numba.prange(points.shape[0]):
+        f = numba_functions.computeForce( nbodies, child, center_of_mass, mass, cell_radius, max_depth, points[i], theta, pair, True )
+        acc[i, 0] = f[0]
+        acc[i, 1] = f[1]
+        potential[i] = f[2]
+
+@numba.njit(nogil=True)
+def last_massive(mass):
+    for i in range(mass.shape[0] - 1, -1, -1):
+        if mass[i] != 0.:
+            return i + 1
+    return 0
+
+@numba.njit(nogil=True)
+def first_massless(mass, n):
+    for i in range(n):
+        if mass[i] == 0.:
+            return i
+    return -1
+
+def count_massive(mass):
+    """ Number of bodies before the trailing massless ones.
+
+    Massless bodies stored after the massive ones are tracers: they are not
+    inserted in the tree and only receive accelerations. A massless body
+    stored before a massive one raises a ValueError (it would be an empty
+    cell of the tree).
+    """
+    nmassive = last_massive(mass)
+    i = first_massless(mass, nmassive)
+    if i >= 0:
+        raise ValueError('body {} is massless but stored before massive bodies, the '
+                         'tracers must be the last bodies'.format(i))
+    return nmassive
+
+def _check_quantile(quantile):
+    if not 0. <= quantile < .5:
+        raise ValueError('the core quantile must be in [0, 0.5), got {}'.format(quantile))
+
+def core_domain(particles, quantile=1e-3, margin=1., nsample=2**16):
+    """ Box [bmin, bmax] containing the bulk of the bodies.
 
-    bmin = np.min(particles[: ,:2], axis=0)
-    bmax = np.max(particles[: ,:2], axis=0)
-    root = quadArray(bmin, bmax, particles.shape[0])
+    The box is the one between the quantile and 1 - quantile of the
+    positions of (at most nsample) bodies, enlarged by margin times its size
+    on each side, so that a few far away bodies do not make it grow.
+    quantile must be in [0, 0.5).
+    """
+    _check_quantile(quantile)
+    step = max(1, particles.shape[0] // nsample)
+    sample = particles[::step, :2]
+    lo = np.quantile(sample, quantile, axis=0)
+    hi = np.quantile(sample, 1 - quantile, axis=0)
+    return lo - margin*(hi - lo), hi + margin*(hi - lo)
+
+def build_tree(mass, particles, core=None, allocate=np.zeros):
+    """ Build the tree of the massive bodies.
+
+    If core is a box (bmin, bmax), the root cell is restricted to it and the
+    bodies outside are left out of the tree, their indices are stored in
+    root.escapers; the queries of the tree (findInRadius, findNearest...)
+    never return them. The arrays of the tree are created by allocate (see
+    quadArray).
+    """
+    # tracers (trailing massless bodies) are left out of the tree
+    nmassive = count_massive(mass)
+    mass = mass[:nmassive]
+    particles = particles[:nmassive]
+
+    if nmassive == 0:
+        # only tracers (e.g. all the massive bodies merged): an empty tree,
+        # whose accelerations are zero
+        bmin = bmax = np.zeros(2)
+    else:
+        bmin = np.min(particles[: ,:2], axis=0)
+        bmax = np.max(particles[: ,:2], axis=0)
+    escapers = None
+    if core is not None and nmassive > 0:
+        outside = ((particles[:, :2] < core[0]) | (particles[:, :2] > core[1])).any(axis=1)
+        if outside.any():
+            escapers = np.flatnonzero(outside)
+            bmin = np.maximum(bmin, core[0])
+            bmax = np.minimum(bmax, core[1])
+    root = quadArray(bmin, bmax, particles.shape[0], allocate)
+    if escapers is not None:
+        root.escapers = escapers
 
     #print_('\tbuild tree:    ', end='', flush=True)
     #t1 = time.time()
@@ -34,11 +132,163 @@ def compute_energy(mass, particles, energy):
     #t2 = time.time()
     #print_('{:9.4f}ms'.format(1000*(t2-t1)))
 
+    return root
+
+def compute_energy(mass, particles, energy, theta=theta, potential=None, kernel=default_kernel):
+    #print('compute energy:')
+    t_tot = time.time()
+
+    root = build_tree(mass, particles)
+
+    if potential is None:
+        potential = np.empty(0)
+
     #print_('\tcompute force: ', end='', flush=True)
-    #t1 = time.time()    
-    compute_force( root.nbodies, root.child, root.center_of_mass, root.mass, root.cell_radius, particles, energy )
+    #t1 = time.time()
+    with config.threads():
+        compute_force( root.nbodies, root.child, root.center_of_mass, root.mass, root.cell_radius, root.max_depth, particles, energy, theta, kernel.pair, potential )
     energy[:, :2] = particles[:, 2:]
     #t2 = time.time()
     #print_('{:9.4f}ms'.format(1000*(t2-t1)))
 
     #print_('\ttotal:       {:11.4f}ms'.format(1000*(time.time()-t_tot)))
+    return root
+
+def evaluate_field(root, points, theta=theta, kernel=default_kernel):
+    """ Acceleration and potential of the bodies of a tree at arbitrary points.
+
+    points is an array whose first two columns are the positions (e.g. a
+    grid or massless probes), they do not enter the tree. A body located
+    exactly at a point is skipped. The escapers of the tree (see
+    build_tree) are summed directly. Returns the (npoints, 2) accelerations
+    and the (npoints,) potential.
+    """
+    points = np.ascontiguousarray(np.asarray(points, dtype=np.float64)[:, :2])
+    acc = np.zeros((points.shape[0], 2))
+    potential = np.zeros(points.shape[0])
+    with config.threads():
+        compute_field( root.nbodies, root.child, root.center_of_mass, root.mass, root.cell_radius, root.max_depth, points, theta, kernel.pair, acc, potential )
+    if root.escapers.size:
+        direct_acc, direct_potential = root.directField(points, kernel)
+        acc += direct_acc
+        potential += direct_potential
+    return acc, potential
+
+class BarnesHut:
+    """ Barnes-Hut engine with a runtime opening angle.
+
+    Instances are called like compute_energy and can be given to the time
+    schemes as their method. The last built tree is kept in self.tree.
+
+    If with_potential is True, the gravitational potential of each body is
+    accumulated during the same tree walk and stored in self.potential.
+
+    Trailing massless bodies are tracers (see count_massive): the tree is
+    built from the massive bodies only and the tracers just walk it.
+
+    If core_quantile (in [0, 0.5)) is given, the root cell is restricted to
+    the core domain of the bodies (see core_domain) so that a few escapers
+    do not make the tree deeper for all the others. The bodies outside are
+    left out of the tree: their contribution to the forces of the other
+    bodies (and to field) is summed directly, and their own forces are
+    direct sums over all the bodies. The tree queries of self.tree
+    (findInRadius, hence Encounters, findKNearest...) do not see them.
+
+    kernel is the interaction (see forces.make_kernel), the Plummer
+    softening of physics.eps in SI units by default.
+
+    threads is the number of threads of the parallel kernels of the engine,
+    the one of config.set_threads if None. self.stats holds the build and
+    walk times, the tree depth, the number of escapers and the number of
+    threads of the last call.
+
+    If storage (an out_of_core.Storage) is given, the tree and the potential
+    are memory-mapped arrays and the bodies are walked by chunks, for systems
+    larger than the memory.
+    """
+    def __init__(self, theta=theta, with_potential=False, core_quantile=None,
+                 core_margin=1., storage=None, kernel=None, threads=None):
+        self.theta = theta
+        self.threads = threads
+        self.kernel = default_kernel if kernel is None else kernel
+        self.storage = storage
+        self.with_potential = with_potential
+        if core_quantile is not None:
+            _check_quantile(core_quantile)
+        self.core_quantile = core_quantile
+        self.core_margin = core_margin
+        self.potential = np.empty(0)
+        self.tree = None
+        self.stats = {}
+
+    def __call__(self, mass, particles, energy):
+        self.build(mass, particles)
+        self.walk(particles, energy)
+
+    def build(self, mass, particles):
+        """ Build self.tree. """
+        t = time.perf_counter()
+        core = None
+        if self.core_quantile is not None and count_massive(mass) > 0:
+            core = core_domain(particles[:count_massive(mass)], self.core_quantile, self.core_margin)
+        allocate = np.zeros if self.storage is None else self.storage.zeros
+        with config.threads(self.threads):
+            self.tree = build_tree(mass, particles, core, allocate)
+        self.stats['build_time'] = time.perf_counter() - t
+        self.stats['max_depth'] = self.tree.max_depth
+        self.stats['escapers'] = self.tree.escapers.size
+
+    def checkpoint(self):
+        """ Return the engine state as a dict of arrays. """
+        return {'theta': np.asarray(self.theta)}
+
+    def restore(self, state):
+        """ Restore a state returned by checkpoint. """
+        self.theta = np.asarray(state['theta']).item()
+
+    def walk(self, particles, energy):
+        """ Compute the derivatives of particles using the current tree. """
+        if not self.with_potential:
+            potential = np.empty(0)
+        else:
+            if self.potential.size != particles.shape[0]:
+                allocate = np.zeros if self.storage is None else self.storage.zeros
+                self.potential = allocate(particles.shape[0])
+            potential = self.potential
+
+        n = particles.shape[0]
+        chunks = [slice(0, n)] if self.storage is None else self.storage.chunks(n)
+
+        t = time.perf_counter()
+        root = self.tree
+        if root.escapers.size:
+            escapers = (root.center_of_mass[root.escapers], root.mass[root.escapers])
+        with config.threads(self.threads) as nthreads:
+            for s in chunks:
+                chunk_potential = potential[s] if self.with_potential else potential
+                compute_force( root.nbodies, root.child, root.center_of_mass, root.mass, root.cell_radius, root.max_depth, particles[s], energy[s], self.theta, self.kernel.pair, chunk_potential )
+                if root.escapers.size:
+                    numba_functions.computeDirectForce( escapers[0], escapers[1], particles[s], energy[s], self.kernel.pair, chunk_potential )
+                energy[s, :2] = particles[s, 2:]
+            if root.escapers.size:
+                self._escaper_forces(particles, energy, potential)
+        self.stats['walk_time'] = time.perf_counter() - t
+        self.stats['threads'] = nthreads
+
+    def _escaper_forces(self, particles, energy, potential):
+        # the escapers are outside the root cell, whose walk would be a poor
+        # approximation: direct sums over all the massive bodies instead
+        root = self.tree
+        escapers = root.escapers
+        acc = np.zeros((escapers.size, 4))
+        escaper_potential = np.zeros(escapers.size) if self.with_potential else np.empty(0)
+        numba_functions.computeDirectForce( root.center_of_mass[:root.nbodies], root.mass[:root.nbodies], particles[escapers], acc, self.kernel.pair, escaper_potential )
+        energy[escapers, 2:] = acc[:, 2:]
+        if self.with_potential:
+            potential[escapers] = escaper_potential
+
+    def field(self, points):
+        """ Acceleration and potential at points using the current tree
+        (see evaluate_field). """
+        with config.threads(self.threads):
+            return evaluate_field(self.tree, points, self.theta, self.kernel)
@@ -1,16 +1,19 @@
+import math
 import numpy as np
 import numba
-from ..forces import force
-from ..physics import gamma_si, theta
+from ..physics import gamma_si, eps
 
-@numba.njit
-def buildTree(center0, box_size0, child, cell_center, cell_radius, particles):
+@numba.njit(nogil=True)
+def buildTree(center0, box_size0, child, cell_center, cell_radius, cell_depth, particles, bmin, bmax):
+    # the bodies outside [bmin, bmax] are not inserted
     ncell = 0
     nbodies = particles.shape[0]
     for ip in range(nbodies):
         center = center0.copy()
         box_size = box_size0.copy()
         x, y = particles[ip, :2]
+        if x < bmin[0] or x > bmax[0] or y < bmin[1] or y > bmax[1]:
+            continue
         cell = 0
 
         childPath = 0
@@ -66,6 +69,7 @@ def buildTree(center0, box_size0, child, cell_center, cell_radius, particles):
                 if particles[ip, 1] > center[1]:
                     newchildPath += 2
 
+                cell_depth[ncell] = cell_depth[cell] + 1
                 cell = ncell
 
                 cell_center[ncell] = center
@@ -124,32 +128,45 @@ def buildTree(center0, box_size0, child, cell_center, cell_radius, particles):
 #     return acc
 
 @numba.njit
-def computeForce(nbodies, child_array, center_of_mass, mass, cell_radius, p):
+def computeForce(nbodies, child_array, center_of_mass, mass, cell_radius, max_depth, p, theta, pair, with_potential=False):
+    # pair is the interaction of a kernel (see forces.make_kernel), the
+    # function is compiled for each kernel
+    # the stack only needs the depth of the tree
     depth = 0
-    localPos = np.zeros(2*nbodies, dtype=np.int32)
-    localNode = np.zeros(2*nbodies, dtype=np.int32)
+    localPos = np.zeros(max_depth + 2, dtype=np.int32)
+    localNode = np.zeros(max_depth + 2, dtype=np.int32)
     localNode[0] = nbodies
 
-    pos = p[:2]
-    acc = np.zeros(2)
+    # local copy: p may be a strided row (structure of arrays layout)
+    pos = np.empty(2)
+    pos[0] = p[0]
+    pos[1] = p[1]
+    # acc[2] holds the potential when with_potential is set
+    acc = np.zeros(3)
 
     while depth >= 0:
         while localPos[depth] < 4:
             child = child_array[localNode[depth] + localPos[depth]]
             localPos[depth] += 1
             if child >= 0:
+                dx = center_of_mass[child, 0] - pos[0]
+                dy = center_of_mass[child, 1] - pos[1]
+                dist2 = dx**2 + dy**2
                 if child < nbodies:
-                    Fx, Fy = force(pos, center_of_mass[child], mass[child])
-                    acc[0] += Fx
-                    acc[1] += Fy
+                    f, phi = pair(dist2, mass[child])
+                    acc[0] += f*dx
+                    acc[1] += f*dy
+                    # skip the body itself
+                    if with_potential and dist2 > 0:
+                        acc[2] += phi
                 else:
-                    dx = center_of_mass[child, 0] - pos[0]
-                    dy = center_of_mass[child, 1] - pos[1]
-                    dist = np.sqrt(dx**2 + dy**2)
+                    dist = np.sqrt(dist2)
                     if dist != 0 and cell_radius[child - nbodies][0]/dist < theta:
-                        Fx, Fy = force(pos, center_of_mass[child], mass[child])
-                        acc[0] += Fx
-                        acc[1] += Fy
+                        f, phi = pair(dist2, mass[child])
+                        acc[0] += f*dx
+                        acc[1] += f*dy
+                        if with_potential:
+                            acc[2] += phi
                     else:
                         depth += 1
                         localNode[depth] = nbodies + 4*(child-nbodies)
@@ -157,19 +174,342 @@ def computeForce(nbodies, child_array, center_of_mass, mass, cell_radius, p):
         depth -= 1
     return acc
 
+@numba.njit(nogil=True)
+def shortRangeTable(rs, rmax, size, eps=eps):
+    # part of the force (column 0) and of the potential (column 1) left by the
+    # long range (gaussian smoothed) interaction of a TreePM split of scale
+    # rs, at the softened distance like the interaction itself, tabulated on
+    # size points of the squared distance in [0, rmax^2]
+    table = np.empty((size + 1, 2))
+    for k in range(size + 1):
+        dist = np.sqrt(k*rmax*rmax/size + eps)
+        u = dist/(2*rs)
+        erfc = math.erfc(u)
+        table[k, 0] = erfc + dist/(math.sqrt(math.pi)*rs)*math.exp(-u*u)
+        table[k, 1] = erfc
+    return table
+
 @numba.njit
-def computeMassDistribution(nbodies, ncell, child, mass, center_of_mass ):
+def shortRangeFactors(table, scale, dist2):
+    # linear interpolation in the table of shortRangeTable, scale is
+    # size/rmax^2, the factors are 0 beyond rmax
+    x = dist2*scale
+    if x >= table.shape[0] - 1:
+        return 0., 0.
+    k = int(x)
+    w = x - k
+    return ((1. - w)*table[k, 0] + w*table[k + 1, 0],
+            (1. - w)*table[k, 1] + w*table[k + 1, 1])
+
+@numba.njit
+def computeShortForce(nbodies, child_array, center_of_mass, mass, cell_center, cell_radius, max_depth, p, theta, pair, table, rcut, with_potential=False):
+    # same walk as computeForce, the cells further than rcut are skipped and
+    # the interactions are multiplied by the short range factors of table
+    # (see shortRangeTable, tabulated up to 2 rcut: the center of mass of an
+    # accepted cell can be further than rcut)
+    depth = 0
+    localPos = np.zeros(max_depth + 2, dtype=np.int32)
+    localNode = np.zeros(max_depth + 2, dtype=np.int32)
+    localNode[0] = nbodies
+
+    pos = np.empty(2)
+    pos[0] = p[0]
+    pos[1] = p[1]
+    acc = np.zeros(3)
+    rcut2 = rcut*rcut
+    scale = (table.shape[0] - 1)/(4*rcut2)
+
+    while depth >= 0:
+        while localPos[depth] < 4:
+            child = child_array[localNode[depth] + localPos[depth]]
+            localPos[depth] += 1
+            if child >= 0:
+                dx = center_of_mass[child, 0] - pos[0]
+                dy = center_of_mass[child, 1] - pos[1]
+                dist2 = dx**2 + dy**2
+                if child < nbodies:
+                    if dist2 < rcut2:
+                        f, fp = shortRangeFactors(table, scale, dist2)
+                        F, phi = pair(dist2, mass[child])
+                        acc[0] += f*F*dx
+                        acc[1] += f*F*dy
+                        if with_potential and dist2 > 0:
+                            acc[2] += fp*phi
+                else:
+                    cell = child - nbodies
+                    # distance to the box of the cell
+                    bx = max(abs(pos[0] - cell_center[cell, 0]) - cell_radius[cell, 0], 0.)
+                    by = max(abs(pos[1] - cell_center[cell, 1]) - cell_radius[cell, 1], 0.)
+                    if bx**2 + by**2 >= rcut2:
+                        continue
+                    dist = np.sqrt(dist2)
+                    if dist != 0 and cell_radius[cell][0]/dist < theta:
+                        f, fp = shortRangeFactors(table, scale, dist2)
+                        F, phi = pair(dist2, mass[child])
+                        acc[0] += f*F*dx
+                        acc[1] += f*F*dy
+                        if with_potential:
+                            acc[2] += fp*phi
+                    else:
+                        depth += 1
+                        localNode[depth] = nbodies + 4*cell
+                        localPos[depth] = 0
+        depth -= 1
+    return acc
+
+@numba.njit(parallel=True, nogil=True)
+def computeDirectForce(source_pos, source_mass, particles, energy, pair, body_potential):
+    # direct interactions with bodies left out of the tree, added to energy
+    # and body_potential (if not empty)
+    with_potential = body_potential.size > 0
+    for i in numba.prange(particles.shape[0]):
+        pos = particles[i, :2]
+        for e in range(source_mass.size):
+            dx = source_pos[e, 0] - pos[0]
+            dy = source_pos[e, 1] - pos[1]
+            dist2 = dx**2 + dy**2
+            f, phi = pair(dist2, source_mass[e])
+            energy[i, 2] += f*dx
+            energy[i, 3] += f*dy
+            # skip the body itself
+            if with_potential and dist2 > 0:
+                body_potential[i] += phi
+
+@numba.njit(nogil=True)
+def cellLevels(ncell, cell_depth):
+    # cells sorted by depth (counting sort): the cells of depth d are
+    # order[start[d]:start[d+1]]
+    max_depth = 0
+    for i in range(ncell + 1):
+        max_depth = max(max_depth, cell_depth[i])
+    start = np.zeros(max_depth + 2, dtype=np.int64)
+    for i in range(ncell + 1):
+        start[cell_depth[i] + 1] += 1
+    for d in range(max_depth + 1):
+        start[d + 1] += start[d]
+    pos = start.copy()
+    order = np.empty(ncell + 1, dtype=np.int64)
+    for i in range(ncell + 1):
+        order[pos[cell_depth[i]]] = i
+        pos[cell_depth[i]] += 1
+    return order, start
+
+@numba.njit(parallel=True, nogil=True)
+def computeMassDistribution(nbodies, ncell, child, mass, center_of_mass, cell_depth):
+    # level by level from the deepest one: the cells of a level only depend
+    # on the deeper ones and are computed in parallel
+    order, start = cellLevels(ncell, cell_depth)
+    for d in range(start.size - 2, -1, -1):
+        for k in numba.prange(start[d], start[d + 1]):
+            i = order[k]
+            this_mass = 0.
+            this_x = 0.
+            this_y = 0.
+            for j in range( nbodies + 4*i, nbodies + 4*i + 4 ):
+                element_id = child[j]
+                if element_id >= 0:
+                    this_mass += mass[ element_id ]
+                    this_x += center_of_mass[element_id, 0] * mass[element_id]
+                    this_y += center_of_mass[element_id, 1] * mass[element_id]
+
+            center_of_mass[nbodies + i, 0] = this_x / this_mass
+            center_of_mass[nbodies + i, 1] = this_y / this_mass
+            mass[nbodies + i] = this_mass
+
+
+@numba.njit(nogil=True)
+def computeColorDistribution(nbodies, ncell, child, colors):
+    # colors of the cells: mean of the children colors weighted by their
+    # opacity, opacity is the sum of the children ones
+    node_colors = np.zeros((nbodies + ncell + 1, 4))
+    node_colors[:nbodies, :colors.shape[1]] = colors
+    if colors.shape[1] == 3:
+        node_colors[:nbodies, 3] = 1.
     for i in range(ncell, -1, -1):
-        this_mass = 0
-        this_center_of_mass = [0, 0]
         for j in range( nbodies + 4*i, nbodies + 4*i + 4 ):
             element_id = child[j]
             if element_id >= 0:
-                this_mass += mass[ element_id ]
-                this_center_of_mass[0] += center_of_mass[element_id][0] * mass[element_id]
-                this_center_of_mass[1] += center_of_mass[element_id][1] * mass[element_id]
+                alpha = node_colors[element_id, 3]
+                for k in range(3):
+                    node_colors[nbodies + i, k] += alpha*node_colors[element_id, k]
+                node_colors[nbodies + i, 3] += alpha
+        if node_colors[nbodies + i, 3] > 0:
+            for k in range(3):
+                node_colors[nbodies + i, k] /= node_colors[nbodies + i, 3]
+    return node_colors
+
+@numba.njit(nogil=True)
+def selectNodes(nbodies, child_array, center_of_mass, cell_center, cell_radius, max_radius, bmin, bmax, nodes):
+    # select the bodies and the cells whose radius is below max_radius which
+    # intersect the box [bmin, bmax], return their number
+    count = 0
+    if cell_radius[0, 0] < max_radius:
+        nodes[0] = nbodies
+        return 1
+
+    depth = 0
+    localPos = np.zeros(cell_radius.shape[0] + 1, dtype=np.int32)
+    localNode = np.zeros(cell_radius.shape[0] + 1, dtype=np.int32)
+    localNode[0] = nbodies
+
+    while depth >= 0:
+        while localPos[depth] < 4:
+            child = child_array[localNode[depth] + localPos[depth]]
+            localPos[depth] += 1
+            if child >= 0:
+                if child < nbodies:
+                    if bmin[0] <= center_of_mass[child, 0] <= bmax[0] and \
+                       bmin[1] <= center_of_mass[child, 1] <= bmax[1]:
+                        nodes[count] = child
+                        count += 1
+                else:
+                    cell = child - nbodies
+                    if cell_center[cell, 0] + cell_radius[cell, 0] < bmin[0] or \
+                       cell_center[cell, 0] - cell_radius[cell, 0] > bmax[0] or \
+                       cell_center[cell, 1] + cell_radius[cell, 1] < bmin[1] or \
+                       cell_center[cell, 1] - cell_radius[cell, 1] > bmax[1]:
+                        continue
+                    if cell_radius[cell, 0] < max_radius:
+                        nodes[count] = child
+                        count += 1
+                    else:
+                        depth += 1
+                        localNode[depth] = nbodies + 4*cell
+                        localPos[depth] = 0
+        depth -= 1
+    return count
+
+@numba.njit(nogil=True)
+def nodeDistance2(nbodies, center_of_mass, cell_center, cell_radius, node, point):
+    # squared distance from point to a body, or to the box of a cell
+    if node < nbodies:
+        dx = center_of_mass[node, 0] - point[0]
+        dy = center_of_mass[node, 1] - point[1]
+    else:
+        cell = node - nbodies
+        dx = max(0., abs(point[0] - cell_center[cell, 0]) - cell_radius[cell, 0])
+        dy = max(0., abs(point[1] - cell_center[cell, 1]) - cell_radius[cell, 1])
+    return dx*dx + dy*dy
+
+@numba.njit(nogil=True)
+def kNearest(nbodies, child_array, center_of_mass, cell_center, cell_radius, max_depth, point, best_index, best_dist2):
+    # fill best_index/best_dist2 with the k nearest bodies of point, sorted;
+    # the children of each cell are visited nearest first so that the bound
+    # best_dist2[k-1] quickly prunes the far cells
+    k = best_index.size
+    if k == 0:
+        return
+    best_index[:] = -1
+    best_dist2[:] = np.inf
+
+    depth = 0
+    localPos = np.empty(max_depth + 2, dtype=np.int32)
+    localNode = np.empty((max_depth + 2, 4), dtype=np.int64)
+    localDist2 = np.empty((max_depth + 2, 4))
+    cell = 0
+
+    while True:
+        # sort the children of cell by distance
+        n = 0
+        for j in range( nbodies + 4*cell, nbodies + 4*cell + 4 ):
+            child = child_array[j]
+            if child >= 0:
+                d2 = nodeDistance2(nbodies, center_of_mass, cell_center, cell_radius, child, point)
+                m = n
+                while m > 0 and localDist2[depth, m-1] > d2:
+                    localDist2[depth, m] = localDist2[depth, m-1]
+                    localNode[depth, m] = localNode[depth, m-1]
+                    m -= 1
+                localDist2[depth, m] = d2
+                localNode[depth, m] = child
+                n += 1
+        for m in range(n, 4):
+            localNode[depth, m] = -1
+        localPos[depth] = 0
+
+        # next cell to open
+        cell = -1
+        while depth >= 0 and cell < 0:
+            while localPos[depth] < 4:
+                child = localNode[depth, localPos[depth]]
+                d2 = localDist2[depth, localPos[depth]]
+                localPos[depth] += 1
+                if child < 0 or d2 >= best_dist2[k-1]:
+                    # the following children are further
+                    localPos[depth] = 4
+                elif child < nbodies:
+                    j = k - 1
+                    while j > 0 and best_dist2[j-1] > d2:
+                        best_dist2[j] = best_dist2[j-1]
+                        best_index[j] = best_index[j-1]
+                        j -= 1
+                    best_dist2[j] = d2
+                    best_index[j] = child
+                else:
+                    cell = child - nbodies
+                    break
+            if cell < 0:
+                depth -= 1
+        if cell < 0:
+            return
+        depth += 1
+
+@numba.njit(parallel=True, nogil=True)
+def kNearestBatch(nbodies, child_array, center_of_mass, cell_center, cell_radius, max_depth, points, best_index, best_dist2):
+    for i in numba.prange(points.shape[0]):
+        kNearest(nbodies, child_array, center_of_mass, cell_center, cell_radius, max_depth, points[i], best_index[i], best_dist2[i])
+
+@numba.njit(nogil=True)
+def rangeQuery(nbodies, child_array, center_of_mass, cell_center, cell_radius, max_depth, lo, hi, center, radius2, out):
+    # bodies in the box [lo, hi], and within sqrt(radius2) of center if
+    # radius2 >= 0; they are written in out if it is not empty, the number
+    # of bodies is returned
+    count = 0
+    depth = 0
+    localPos = np.empty(max_depth + 2, dtype=np.int32)
+    localNode = np.empty(max_depth + 2, dtype=np.int32)
+    localNode[0] = nbodies
+    localPos[0] = 0
+
+    while depth >= 0:
+        while localPos[depth] < 4:
+            child = child_array[localNode[depth] + localPos[depth]]
+            localPos[depth] += 1
+            if child >= 0:
+                if child < nbodies:
+                    x = center_of_mass[child, 0]
+                    y = center_of_mass[child, 1]
+                    if lo[0] <= x <= hi[0] and lo[1] <= y <= hi[1]:
+                        if radius2 < 0 or (x - center[0])**2 + (y - center[1])**2 <= radius2:
+                            if out.size > 0:
+                                out[count] = child
+                            count += 1
+                else:
+                    cell = child - nbodies
+                    if cell_center[cell, 0] + cell_radius[cell, 0] >= lo[0] and \
+                       cell_center[cell, 0] - cell_radius[cell, 0] <= hi[0] and \
+                       cell_center[cell, 1] + cell_radius[cell, 1] >= lo[1] and \
+                       cell_center[cell, 1] - cell_radius[cell, 1] <= hi[1]:
+                        depth += 1
+                        localNode[depth] = nbodies + 4*cell
+                        localPos[depth] = 0
+        depth -= 1
+    return count
 
-        center_of_mass[nbodies + i][0] = this_center_of_mass[0] / this_mass
-        center_of_mass[nbodies + i][1] = this_center_of_mass[1] / this_mass
-        mass[nbodies + i] = this_mass
+@numba.njit(parallel=True, nogil=True)
+def rangeQueryBatch(nbodies, child_array, center_of_mass, cell_center, cell_radius, max_depth, lo, hi, center, radius2):
+    # results of query i are indices[offsets[i]:offsets[i+1]]
+    nquery = lo.shape[0]
+    empty = np.empty(0, dtype=np.int64)
+    counts = np.zeros(nquery, dtype=np.int64)
+    for i in numba.prange(nquery):
+        counts[i] = rangeQuery(nbodies, child_array, center_of_mass, cell_center, cell_radius, max_depth,
+                               lo[i], hi[i], center[i], radius2[i], empty)
 
+    offsets = np.zeros(nquery + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    indices = np.empty(offsets[-1], dtype=np.int64)
+    for i in numba.prange(nquery):
+        rangeQuery(nbodies, child_array, center_of_mass, cell_center, cell_radius, max_depth,
+                   lo[i], hi[i], center[i], radius2[i], indices[offsets[i]:offsets[i+1]])
+    return indices, offsets
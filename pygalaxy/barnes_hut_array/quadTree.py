@@ -1,36 +1,147 @@
 import numpy as np
-from ..forces import force
+from ..forces import default_kernel
+from ..physics import theta
 from . import numba_functions
+from .. import config
 
 class quadArray:
-    def __init__(self, bmin, bmax, size):
+    def __init__(self, bmin, bmax, size, allocate=np.zeros):
+        # allocate(shape, dtype) creates the arrays of the tree (e.g. the
+        # memory-mapped ones of an out_of_core.Storage)
+        self.allocate = allocate
         self.nbodies = size
-        self.child = -np.ones(4*(2*size+1), dtype=np.int32)
+        self.child = allocate(4*(2*size+1), dtype=np.int32)
+        self.child[:] = -1
         self.bmin = np.asarray(bmin)
         self.bmax = np.asarray(bmax)
         self.center = .5*(self.bmin + self.bmax)
         self.box_size = (self.bmax - self.bmin)
         self.ncell = 0
-        self.cell_center = np.zeros((2*size+1, 2))
-        self.cell_radius = np.zeros((2*size+1, 2))
+        self.cell_center = allocate((2*size+1, 2), dtype=np.float64)
+        self.cell_radius = allocate((2*size+1, 2), dtype=np.float64)
+        self.cell_depth = allocate(2*size+1, dtype=np.int32)
+        # bodies outside [bmin, bmax], not inserted in the tree: the force
+        # and potential methods sum them directly, the find methods do not
+        # see them
+        self.escapers = np.empty(0, dtype=np.int64)
         self.cell_center[0] = self.center
         self.cell_radius[0] = self.box_size
 
     def buildTree(self, particles):
-        self.ncell = numba_functions.buildTree(self.center, self.box_size, self.child, self.cell_center, self.cell_radius, particles)
+        self.ncell = numba_functions.buildTree(self.center, self.box_size, self.child, self.cell_center, self.cell_radius, self.cell_depth, particles, self.bmin, self.bmax)
+        self.max_depth = int(self.cell_depth[:self.ncell+1].max())
 
     def computeMassDistribution(self, particles, mass):
-        self.mass = np.zeros(self.nbodies + self.ncell + 1)
+        self.mass = self.allocate(self.nbodies + self.ncell + 1, dtype=np.float64)
         self.mass[:self.nbodies] = mass
-        self.center_of_mass = np.zeros((self.nbodies + self.ncell + 1, 2))
+        self.center_of_mass = self.allocate((self.nbodies + self.ncell + 1, 2), dtype=np.float64)
         self.center_of_mass[:self.nbodies] = particles[:, :2]
 
-        numba_functions.computeMassDistribution( self.nbodies, self.ncell,
-                self.child, self.mass, self.center_of_mass )
+        with config.threads():
+            numba_functions.computeMassDistribution( self.nbodies, self.ncell,
+                    self.child, self.mass, self.center_of_mass, self.cell_depth )
 
 
-    def computeForce(self, p):
-        return numba_functions.computeForce(self.nbodies, self.child, self.center_of_mass, self.mass, self.cell_radius, p)
+    def builtOn(self, particles):
+        """ True if the tree was built on the positions of particles (the
+        positions of the bodies are kept in center_of_mass[:nbodies]). """
+        return particles.shape[0] == self.nbodies and \
+            np.array_equal(self.center_of_mass[:self.nbodies], particles[:, :2])
+
+    def computeForce(self, p, theta=theta, kernel=default_kernel):
+        acc = numba_functions.computeForce(self.nbodies, self.child, self.center_of_mass, self.mass, self.cell_radius, self.max_depth, p, theta, kernel.pair)[:2]
+        return acc + self.directField(p, kernel)[0][0]
+
+    def computePotential(self, p, theta=theta, kernel=default_kernel):
+        potential = numba_functions.computeForce(self.nbodies, self.child, self.center_of_mass, self.mass, self.cell_radius, self.max_depth, p, theta, kernel.pair, True)[2]
+        return potential + self.directField(p, kernel)[1][0]
+
+    def directField(self, points, kernel=default_kernel):
+        """ Acceleration ((npoints, 2) array) and potential ((npoints,)
+        array) at points (or a single point) of the escapers, the bodies left
+        out of the tree (see build_tree), by direct summation. A body
+        located exactly at a point is skipped. """
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        energy = np.zeros((points.shape[0], 4))
+        potential = np.zeros(points.shape[0])
+        if self.escapers.size:
+            with config.threads():
+                numba_functions.computeDirectForce(self.center_of_mass[self.escapers], self.mass[self.escapers],
+                                                   points, energy, kernel.pair, potential)
+        return energy[:, 2:], potential
+
+    def computeColorDistribution(self, colors):
+        self.node_colors = numba_functions.computeColorDistribution(self.nbodies, self.ncell, self.child, colors)
+        return self.node_colors
+
+    def selectNodes(self, max_radius, bmin, bmax):
+        """ Indices (in center_of_mass) of the bodies and of the largest
+        cells with a radius below max_radius, restricted to the box
+        [bmin, bmax]. """
+        nodes = np.empty(self.nbodies + self.ncell + 1, dtype=np.int64)
+        count = numba_functions.selectNodes(self.nbodies, self.child, self.center_of_mass, self.cell_center, self.cell_radius,
+                                            max_radius, np.asarray(bmin, dtype=np.float64), np.asarray(bmax, dtype=np.float64), nodes)
+        return nodes[:count]
+
+    ###########################################################################
+    # Spatial queries
+    #
+    # They use the body positions at the time the tree was built, e.g. the
+    # tree kept by a BarnesHut engine after its last evaluation. Batched
+    # queries are run in parallel.
+
+    def findKNearest(self, points, k=1):
+        """ Indices and distances of the k nearest bodies of each point.
+
+        points is an (npoints, 2) array (or a single point); the results are
+        (npoints, k) arrays sorted by distance. A body used as a query point
+        is its own nearest body. There are less than k columns if the tree
+        has less than k bodies, none if k <= 0.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        single = points.ndim == 1
+        points = np.atleast_2d(points)
+        k = max(0, min(k, self.nbodies))
+        index = np.empty((points.shape[0], k), dtype=np.int64)
+        dist2 = np.empty((points.shape[0], k))
+        if k > 0:
+            with config.threads():
+                numba_functions.kNearestBatch(self.nbodies, self.child, self.center_of_mass, self.cell_center, self.cell_radius,
+                                              self.max_depth, points, index, dist2)
+        if single:
+            return index[0], np.sqrt(dist2[0])
+        return index, np.sqrt(dist2)
+
+    def findNearest(self, points):
+        """ Index of the nearest body of each point. """
+        if self.nbodies == 0:
+            raise ValueError('the tree has no bodies')
+        index, _ = self.findKNearest(points, 1)
+        return index[..., 0]
+
+    def findInRadius(self, points, radius):
+        """ Bodies within radius of each point.
+
+        Returns (indices, offsets): the bodies of the ith point are
+        indices[offsets[i]:offsets[i+1]].
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), points.shape[:1])
+        with config.threads():
+            return numba_functions.rangeQueryBatch(self.nbodies, self.child, self.center_of_mass, self.cell_center, self.cell_radius,
+                                                   self.max_depth, points - radius[:, None], points + radius[:, None], points,
+                                                   np.ascontiguousarray(radius**2))
+
+    def findInBox(self, bmin, bmax):
+        """ Bodies in the boxes [bmin, bmax] (arrays of shape (nbox, 2)).
+
+        Returns (indices, offsets) as findInRadius.
+        """
+        bmin = np.atleast_2d(np.asarray(bmin, dtype=np.float64))
+        bmax = np.atleast_2d(np.asarray(bmax, dtype=np.float64))
+        with config.threads():
+            return numba_functions.rangeQueryBatch(self.nbodies, self.child, self.center_of_mass, self.cell_center, self.cell_radius,
+                                                   self.max_depth, bmin, bmax, bmin, -np.ones(bmin.shape[0]))
 
     def __str__(self):
         indent = ' '*2
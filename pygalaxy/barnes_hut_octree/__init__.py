@@ -0,0 +1,2 @@
+from .energy import compute_energy, build_tree, BarnesHut
+from .octree import octArray
@@ -0,0 +1,138 @@
+import time
+
+import numpy as np
+import numba
+
+from .octree import octArray
+from ..physics import theta
+from ..forces import default_kernel
+from .. import config
+from ..barnes_hut_array import count_massive
+from . import numba_functions
+
+
+@numba.njit(parallel=True, nogil=True)
+def compute_force(pos, mass, first, count, nchild, child_start, cell_mass, center_of_mass, size2, ngen, order, particles, energy, theta, pair, potential):
+    # the bodies of the tree are walked in the Morton order, so that
+    # consecutive walks (and the bodies of a thread) go through the same
+    # cells; the trailing tracers walk the tree after them
+    with_potential = potential.size > 0
+    ntree = pos.shape[0]
+    for k in numba.prange(particles.shape[0]):
+        stack = np.empty(7*ngen + 1, dtype=np.int64)
+        # explicit types: the loop index is unsigned
+        if k < ntree:
+            i = np.int64(order[k])
+            p = pos[k]
+            self_index = np.int64(k)
+        else:
+            i = np.int64(k)
+            p = particles[k]
+            self_index = np.int64(-1)
+        ax, ay, az, pot = numba_functions.computeForce(
+            pos, mass, first, count, nchild, child_start, cell_mass, center_of_mass, size2,
+            stack, p, self_index, theta*theta, pair, with_potential)
+        energy[i, 3] = ax
+        energy[i, 4] = ay
+        energy[i, 5] = az
+        if with_potential:
+            potential[i] = pot
+
+
+def build_tree(mass, particles, leaf_size=8):
+    """ Build the octree of the massive bodies (the trailing massless ones
+    are tracers, see barnes_hut_array.count_massive). """
+    nmassive = count_massive(mass)
+    mass = mass[:nmassive]
+    particles = particles[:nmassive]
+
+    if nmassive == 0:
+        # only tracers: an empty tree, whose accelerations are zero
+        bmin = bmax = np.zeros(3)
+    else:
+        bmin = np.min(particles[:, :3], axis=0)
+        bmax = np.max(particles[:, :3], axis=0)
+    root = octArray(bmin, bmax, particles.shape[0], leaf_size)
+    root.buildTree(particles)
+    root.computeMassDistribution(particles, mass)
+    return root
+
+
+def walk(root, particles, energy, theta=theta, potential=None, kernel=default_kernel):
+    """ Accelerations of the bodies (and tracers) of particles in the tree
+    root, in energy[:, 3:]. """
+    if potential is None:
+        potential = np.empty(0)
+    with config.threads():
+        compute_force(root.pos, root.mass, root.first, root.count, root.nchild, root.child_start,
+                      root.cell_mass, root.center_of_mass, root.size2, len(root.generations),
+                      root.order, particles, energy, theta, kernel.pair, potential)
+
+
+def compute_energy(mass, particles, energy, theta=theta, potential=None, kernel=default_kernel):
+    """ Derivatives of the (N, 6) state particles (positions, velocities) in
+    energy. """
+    root = build_tree(mass, particles)
+    walk(root, particles, energy, theta, potential, kernel)
+    energy[:, :3] = particles[:, 3:]
+    return root
+
+
+class BarnesHut:
+    """ 3D Barnes-Hut engine.
+
+    The state of the bodies is an (N, 6) array (x, y, z, vx, vy, vz): give
+    the time schemes dim=3. Instances are called like compute_energy, the
+    last built tree is kept in self.tree and the potential in
+    self.potential if with_potential is True.
+
+    The octree is compressed and its leaves hold up to leaf_size bodies;
+    the build (Morton keys, cells of a generation, masses of a generation)
+    and the walk are parallel, with threads threads (the number of
+    config.set_threads if None). self.stats holds the build and walk times,
+    the depth and the number of cells of the tree and the number of threads
+    of the last call.
+
+    kernel is the interaction (see forces.make_kernel), the Plummer
+    softening of physics.eps in SI units by default.
+    """
+    def __init__(self, theta=theta, leaf_size=8, with_potential=False, kernel=None,
+                 threads=None):
+        self.theta = theta
+        self.threads = threads
+        self.kernel = default_kernel if kernel is None else kernel
+        self.leaf_size = leaf_size
+        self.with_potential = with_potential
+        self.potential = np.empty(0)
+        self.tree = None
+        self.stats = {}
+
+    def __call__(self, mass, particles, energy):
+        with config.threads(self.threads) as nthreads:
+            self._compute(mass, particles, energy)
+        self.stats['threads'] = nthreads
+
+    def _compute(self, mass, particles, energy):
+        t = time.perf_counter()
+        self.tree = build_tree(mass, particles, self.leaf_size)
+        self.stats['build_time'] = time.perf_counter() - t
+        self.stats['max_depth'] = self.tree.max_depth
+        self.stats['ncell'] = self.tree.ncell
+
+        potential = None
+        if self.with_potential:
+            if self.potential.size != particles.shape[0]:
+                self.potential = np.zeros(particles.shape[0])
+            potential = self.potential
+        t = time.perf_counter()
+        walk(self.tree, particles, energy, self.theta, potential, self.kernel)
+        energy[:, :3] = particles[:, 3:]
+        self.stats['walk_time'] = time.perf_counter() - t
+
+    def checkpoint(self):
+        """ Return the engine state as a dict of arrays. """
+        return {'theta': np.asarray(self.theta)}
+
+    def restore(self, state):
+        """ Restore a state returned by checkpoint. """
+        self.theta = np.asarray(state['theta']).item()
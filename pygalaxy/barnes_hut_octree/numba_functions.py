@@ -0,0 +1,198 @@
+import numpy as np
+import numba
+
+# Array layout of the octree
+#
+# The bodies are sorted along the Morton (Z-order) curve of the root cube,
+# keys of NBITS bits per dimension. A cell holds the range
+# [first[cell], first[cell] + count[cell]) of the sorted bodies, and its
+# level is the number of octant digits shared by the keys of its bodies, so
+# that its size is the root size / 2**level. The tree is compressed: a cell
+# whose bodies lie in a single octant is not split at this level, so each
+# cell which is not a leaf has at least two children.
+#
+# The cells are stored breadth first: the children of a cell are contiguous,
+# the nchild[cell] cells from child_start[cell], and the cells of each
+# generation (depth in the tree) are contiguous. The tree is built and its
+# mass distribution computed one generation at a time, in parallel over the
+# cells of the generation.
+#
+# Leaves (nchild == 0) hold at most leaf_size bodies (more if they share the
+# same key) which interact directly with the bodies close to them.
+
+NBITS = 21
+
+
+@numba.njit
+def spread3(v):
+    """ Bits of v (< 2**21) separated by two zeros. """
+    v = v & 0x1fffff
+    v = (v | (v << 32)) & 0x1f00000000ffff
+    v = (v | (v << 16)) & 0x1f0000ff0000ff
+    v = (v | (v << 8)) & 0x100f00f00f00f00f
+    v = (v | (v << 4)) & 0x10c30c30c30c30c3
+    v = (v | (v << 2)) & 0x1249249249249249
+    return v
+
+
+@numba.njit(parallel=True, nogil=True)
+def mortonKeys(particles, bmin, scale, keys):
+    """ Keys of the bodies in the cube starting at bmin, scale being the
+    number of key cells per unit length. """
+    top = 2**NBITS - 1
+    for i in numba.prange(particles.shape[0]):
+        ix = min(max(int((particles[i, 0] - bmin[0])*scale), 0), top)
+        iy = min(max(int((particles[i, 1] - bmin[1])*scale), 0), top)
+        iz = min(max(int((particles[i, 2] - bmin[2])*scale), 0), top)
+        keys[i] = spread3(ix) | (spread3(iy) << 1) | (spread3(iz) << 2)
+
+
+@numba.njit
+def sharedLevel(k1, k2):
+    """ Number of leading octant digits shared by the keys k1 and k2. """
+    d = k1 ^ k2
+    if d == 0:
+        return NBITS
+    h = 0
+    while d > 1:
+        d >>= 1
+        h += 1
+    return (3*NBITS - 1 - h)//3
+
+
+@numba.njit
+def lowerBound(keys, lo, hi, shift, octant):
+    """ First index of [lo, hi) whose octant digit at shift is >= octant. """
+    while lo < hi:
+        mid = (lo + hi)//2
+        if ((keys[mid] >> shift) & 7) < octant:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+@numba.njit(parallel=True, nogil=True)
+def splitCells(keys, start, end, first, count, level, leaf_size, nchild, bounds):
+    """ Octant bounds (in bounds) and number of non empty octants (in
+    nchild) of the cells [start, end). """
+    for c in numba.prange(start, end):
+        k = c - start
+        nchild[k] = 0
+        if count[c] <= leaf_size or level[c] >= NBITS:
+            continue
+        shift = 3*(NBITS - 1 - level[c])
+        hi = first[c] + count[c]
+        bounds[k, 0] = first[c]
+        for o in range(1, 8):
+            bounds[k, o] = lowerBound(keys, bounds[k, o - 1], hi, shift, o)
+        bounds[k, 8] = hi
+        for o in range(8):
+            if bounds[k, o + 1] > bounds[k, o]:
+                nchild[k] += 1
+
+
+@numba.njit(parallel=True, nogil=True)
+def fillChildren(keys, start, end, nchild, child_start, bounds, first, count, level):
+    """ Ranges and levels of the children of the cells [start, end). """
+    for c in numba.prange(start, end):
+        if nchild[c] == 0:
+            continue
+        k = c - start
+        j = child_start[c]
+        for o in range(8):
+            lo = bounds[k, o]
+            hi = bounds[k, o + 1]
+            if hi > lo:
+                first[j] = lo
+                count[j] = hi - lo
+                level[j] = sharedLevel(keys[lo], keys[hi - 1])
+                j += 1
+
+
+@numba.njit(parallel=True, nogil=True)
+def computeCells(start, end, first, count, nchild, child_start, pos, mass, cell_mass, center_of_mass):
+    """ Mass and center of mass of the cells [start, end), from their bodies
+    for the leaves and from their children (already computed) otherwise. """
+    for c in numba.prange(start, end):
+        m = 0.
+        x = 0.
+        y = 0.
+        z = 0.
+        if nchild[c] == 0:
+            for j in range(first[c], first[c] + count[c]):
+                m += mass[j]
+                x += mass[j]*pos[j, 0]
+                y += mass[j]*pos[j, 1]
+                z += mass[j]*pos[j, 2]
+        else:
+            for j in range(child_start[c], child_start[c] + nchild[c]):
+                m += cell_mass[j]
+                x += cell_mass[j]*center_of_mass[j, 0]
+                y += cell_mass[j]*center_of_mass[j, 1]
+                z += cell_mass[j]*center_of_mass[j, 2]
+        cell_mass[c] = m
+        if m > 0.:
+            center_of_mass[c, 0] = x/m
+            center_of_mass[c, 1] = y/m
+            center_of_mass[c, 2] = z/m
+        elif count[c] > 0:
+            # massless bodies: the position of the first one (the root of an
+            # empty tree stays at the origin)
+            j = first[c]
+            center_of_mass[c, 0] = pos[j, 0]
+            center_of_mass[c, 1] = pos[j, 1]
+            center_of_mass[c, 2] = pos[j, 2]
+
+
+@numba.njit(nogil=True)
+def computeForce(pos, mass, first, count, nchild, child_start, cell_mass, center_of_mass, size2, stack, p, self_index, theta2, pair, with_potential):
+    """ Acceleration (and potential) at p, skipping the sorted body
+    self_index (-1 for none).
+
+    A cell is used as a whole if its size is below theta times its distance
+    to p, the bodies of the leaves that are too close interact directly.
+    pair is the interaction of a kernel (see forces.make_kernel), the
+    function is compiled for each kernel. stack must hold 7 cells per generation of the tree plus one.
+    """
+    px = p[0]
+    py = p[1]
+    pz = p[2]
+    ax = 0.
+    ay = 0.
+    az = 0.
+    pot = 0.
+    stack[0] = 0
+    sp = 1
+    while sp > 0:
+        sp -= 1
+        c = stack[sp]
+        dx = center_of_mass[c, 0] - px
+        dy = center_of_mass[c, 1] - py
+        dz = center_of_mass[c, 2] - pz
+        r2 = dx*dx + dy*dy + dz*dz
+        if size2[c] < theta2*r2:
+            f, phi = pair(r2, cell_mass[c])
+            ax += f*dx
+            ay += f*dy
+            az += f*dz
+            if with_potential:
+                pot += phi
+        elif nchild[c] == 0:
+            for j in range(first[c], first[c] + count[c]):
+                if j == self_index:
+                    continue
+                dx = pos[j, 0] - px
+                dy = pos[j, 1] - py
+                dz = pos[j, 2] - pz
+                f, phi = pair(dx*dx + dy*dy + dz*dz, mass[j])
+                ax += f*dx
+                ay += f*dy
+                az += f*dz
+                if with_potential:
+                    pot += phi
+        else:
+            for k in range(nchild[c]):
+                stack[sp] = child_start[c] + k
+                sp += 1
+    return ax, ay, az, pot
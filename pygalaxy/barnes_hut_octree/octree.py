@@ -0,0 +1,96 @@
+import numpy as np
+from ..physics import theta
+from ..forces import default_kernel
+from . import numba_functions
+from .. import config
+
+
+class octArray:
+    """ Octree of size bodies in the box [bmin, bmax], stored in arrays (see
+    numba_functions for the layout).
+
+    Parameters:
+    -----------
+    bmin, bmax: arrays
+        Corners of the box of the bodies, the root cell is the cube of the
+        largest side starting at bmin.
+    size: int
+        Number of bodies.
+    leaf_size: int
+        Maximal number of bodies of a leaf.
+    """
+
+    def __init__(self, bmin, bmax, size, leaf_size=8):
+        self.nbodies = size
+        self.leaf_size = leaf_size
+        self.bmin = np.asarray(bmin, dtype=np.float64)
+        self.bmax = np.asarray(bmax, dtype=np.float64)
+        self.box_size = max(float(np.max(self.bmax - self.bmin)), 1e-300)
+        # a compressed octree has at most 2*size - 1 cells
+        ncell = max(2*size - 1, 1)
+        self.first = np.zeros(ncell, dtype=np.int64)
+        self.count = np.zeros(ncell, dtype=np.int64)
+        self.level = np.zeros(ncell, dtype=np.int64)
+        self.nchild = np.zeros(ncell, dtype=np.int64)
+        self.child_start = np.zeros(ncell, dtype=np.int64)
+        self.generations = [0]
+        self.ncell = 0
+
+    @property
+    def max_depth(self):
+        return len(self.generations) - 1
+
+    def buildTree(self, particles):
+        """ Sort the bodies along the Morton curve and build the cells, one
+        generation at a time. """
+        with config.threads():
+            self._buildTree(particles)
+
+    def _buildTree(self, particles):
+        n = self.nbodies
+        keys = np.empty(n, dtype=np.int64)
+        scale = (2**numba_functions.NBITS - 1)/self.box_size
+        numba_functions.mortonKeys(particles, self.bmin, scale, keys)
+        self.order = np.argsort(keys, kind='stable')
+        keys = keys[self.order]
+
+        self.first[0] = 0
+        self.count[0] = n
+        self.level[0] = numba_functions.sharedLevel(keys[0], keys[-1]) if n else 0
+        start, end = 0, 1
+        self.generations = [0]
+        while start < end:
+            nchild = np.empty(end - start, dtype=np.int64)
+            bounds = np.empty((end - start, 9), dtype=np.int64)
+            numba_functions.splitCells(keys, start, end, self.first, self.count, self.level,
+                                       self.leaf_size, nchild, bounds)
+            self.nchild[start:end] = nchild
+            self.child_start[start:end] = end + np.cumsum(nchild) - nchild
+            nnew = int(nchild.sum())
+            numba_functions.fillChildren(keys, start, end, self.nchild, self.child_start, bounds,
+                                         self.first, self.count, self.level)
+            self.generations.append(end)
+            start, end = end, end + nnew
+        self.ncell = end
+        # squared size of the cells
+        self.size2 = (self.box_size*0.5**self.level[:self.ncell])**2
+
+    def computeMassDistribution(self, particles, mass):
+        """ Masses and centers of mass of the cells, from the leaves up. """
+        self.pos = np.ascontiguousarray(particles[self.order, :3])
+        self.mass = np.ascontiguousarray(mass[self.order])
+        self.cell_mass = np.zeros(self.ncell)
+        self.center_of_mass = np.zeros((self.ncell, 3))
+        with config.threads():
+            for g in range(len(self.generations) - 2, -1, -1):
+                numba_functions.computeCells(self.generations[g], self.generations[g + 1],
+                                             self.first, self.count, self.nchild, self.child_start,
+                                             self.pos, self.mass, self.cell_mass, self.center_of_mass)
+
+    def computeForce(self, p, theta=theta, kernel=default_kernel):
+        """ Acceleration at the point p. """
+        stack = np.empty(7*len(self.generations) + 1, dtype=np.int64)
+        return np.array(numba_functions.computeForce(
+            self.pos, self.mass, self.first, self.count, self.nchild, self.child_start,
+            self.cell_mass, self.center_of_mass, self.size2, stack,
+            np.asarray(p, dtype=np.float64), -1, theta*theta, kernel.pair, False)[:3])
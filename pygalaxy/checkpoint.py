@@ -0,0 +1,103 @@
+import os
+import stat
+import tempfile
+
+import numpy as np
+
+
+def save_checkpoint(path, mass, particles, scheme=None, engine=None, it=0,
+                    save_rng=True):
+    """ Save everything needed to continue a run bit for bit.
+
+    The file is an uncompressed .npz archive written to a temporary file
+    next to path and then renamed, so an existing checkpoint is never left
+    half written.
+
+    Parameters:
+    -----------
+    path: str
+        Checkpoint file.
+    mass, particles: arrays
+        Simulation state.
+    scheme: object or None
+        Time scheme providing checkpoint (see time_schemes.scheme.TimeScheme).
+    engine: object or None
+        Force engine providing checkpoint, e.g. a BarnesHut or ThetaTuner.
+    it: int
+        Iteration counter.
+    save_rng: bool
+        True to save the state of the numpy.random global generator.
+    """
+    arrays = {'mass': mass, 'particles': particles, 'it': np.asarray(it)}
+    if scheme is not None:
+        arrays['scheme_class'] = np.asarray(type(scheme).__name__)
+        for name, value in scheme.checkpoint().items():
+            arrays['scheme/' + name] = value
+    if engine is not None:
+        for name, value in engine.checkpoint().items():
+            arrays['engine/' + name] = value
+    if save_rng:
+        kind, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        arrays['rng/keys'] = keys
+        arrays['rng/values'] = np.array([pos, has_gauss])
+        arrays['rng/cached_gaussian'] = np.asarray(cached_gaussian)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp, _file_mode(path))
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def _file_mode(path):
+    """ Permissions of the file path replaces, those of a new file (as
+    np.savez would create it) if there is none. """
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def load_checkpoint(path, scheme=None, engine=None, restore_rng=True):
+    """ Load a checkpoint written by save_checkpoint.
+
+    The states of scheme and engine, if given, are restored in place, as is
+    the numpy.random global generator if restore_rng is True and the
+    checkpoint contains it. Returns mass, particles and the iteration
+    counter.
+    """
+    with np.load(path) as data:
+        mass = data['mass']
+        particles = data['particles']
+        it = data['it'].item()
+
+        if scheme is not None:
+            name = data['scheme_class'].item()
+            if name != type(scheme).__name__:
+                raise ValueError('checkpoint of a {} scheme restored into a {}'
+                                 .format(name, type(scheme).__name__))
+            scheme.restore(_section(data, 'scheme/'))
+        if engine is not None:
+            engine.restore(_section(data, 'engine/'))
+        if restore_rng and 'rng/keys' in data:
+            pos, has_gauss = data['rng/values']
+            np.random.set_state(('MT19937', data['rng/keys'], int(pos),
+                                 int(has_gauss),
+                                 data['rng/cached_gaussian'].item()))
+
+    return mass, particles, it
+
+
+def _section(data, prefix):
+    return {key[len(prefix):]: data[key] for key in data.files
+            if key.startswith(prefix)}
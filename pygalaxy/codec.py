@@ -0,0 +1,250 @@
+import lzma
+import struct
+import time
+import zlib
+
+import numpy as np
+
+# frame header: magic, keyframe flag, precision id, compression id, padding,
+# number of bodies, number of components
+_HEADER = struct.Struct('<4sBBBBII')
+_MAGIC = b'PGS1'
+
+_PRECISIONS = ['float64', 'float32', 'uint16', 'uint32']
+_COMPRESSIONS = [None, 'zlib', 'lzma']
+
+# integer type holding the code of a value for each precision
+_CODE_DTYPES = {'float64': np.uint64, 'float32': np.uint32,
+                'uint16': np.uint16, 'uint32': np.uint32}
+
+
+class SnapshotCodec(object):
+    """ Compact encoding of (N, ncomp) snapshots.
+
+    Each component is stored with the given precision:
+    - 'float64': exact,
+    - 'float32': relative error below 2**-24,
+    - 'uint16'/'uint32': quantized on the bounding box [min, max] of the
+      component in the snapshot, absolute error below
+      (max - min) / (2 * (2**bits - 1)).
+
+    Frames between two keyframes are encoded as differences against the
+    previous frame (wrapping integer difference of the quantized codes,
+    XOR of the bit patterns for floats), which is lossless with respect to
+    the chosen precision. The bytes are then shuffled (all first bytes, then
+    all second bytes...) and optionally compressed with zlib or lzma.
+
+    The codec is stateful: frames must be decoded in the order they were
+    encoded, starting from a keyframe.
+
+    Parameters:
+    -----------
+    precision: str
+        One of 'float64', 'float32', 'uint16', 'uint32'.
+    compression: str or None
+        None, 'zlib' or 'lzma'.
+    level: int
+        Compression level.
+    keyframe: int
+        Number of frames between two keyframes, 1 to disable delta encoding.
+    """
+
+    def __init__(self, precision='uint32', compression='zlib', level=6,
+                 keyframe=32):
+        if precision not in _PRECISIONS:
+            raise ValueError('unknown precision {!r}'.format(precision))
+        if compression not in _COMPRESSIONS:
+            raise ValueError('unknown compression {!r}'.format(compression))
+        self.precision = precision
+        self.compression = compression
+        self.level = level
+        self.keyframe = keyframe
+        self.error_bound = None
+        self.reset()
+
+    def reset(self):
+        """ Forget the previous frame, the next encoded frame is a keyframe. """
+        self._count = 0
+        self._previous = None
+        self._decoded = None
+
+    @property
+    def _code_dtype(self):
+        return _CODE_DTYPES[self.precision]
+
+    def encode(self, frame):
+        """ Return the bytes encoding frame and set self.error_bound to the
+        maximal absolute error per component. """
+        frame = np.asarray(frame, dtype=np.float64)
+        nbodies, ncomp = frame.shape
+        # planar layout: one contiguous block per component
+        planar = np.ascontiguousarray(frame.T)
+
+        bounds = b''
+        if self.precision.startswith('uint'):
+            # an empty frame (e.g. all the bodies removed) has no range
+            lo = planar.min(axis=1) if nbodies else np.zeros(ncomp)
+            hi = planar.max(axis=1) if nbodies else np.zeros(ncomp)
+            nlevels = np.iinfo(self._code_dtype).max
+            span = hi - lo
+            scale = np.where(span > 0, nlevels/np.where(span > 0, span, 1.), 0.)
+            codes = np.rint((planar - lo[:, None])*scale[:, None]).astype(self._code_dtype)
+            bounds = np.concatenate([lo, hi]).tobytes()
+            self.error_bound = span/(2*nlevels)
+        else:
+            values = planar.astype(self.precision)
+            codes = values.view(self._code_dtype)
+            self.error_bound = np.abs(planar - values).max(axis=1) if nbodies else np.zeros(ncomp)
+
+        is_key = (self._count % self.keyframe == 0 or self._previous is None
+                  or self._previous.shape != codes.shape)
+        payload = codes if is_key else _delta(codes, self._previous, self.precision)
+        self._previous = codes
+        self._count += 1
+
+        data = _shuffle(payload)
+        if self.compression == 'zlib':
+            data = zlib.compress(data, self.level)
+        elif self.compression == 'lzma':
+            data = lzma.compress(data, preset=self.level)
+
+        header = _HEADER.pack(_MAGIC, is_key,
+                              _PRECISIONS.index(self.precision),
+                              _COMPRESSIONS.index(self.compression), 0,
+                              nbodies, ncomp)
+        return header + bounds + data
+
+    def decode(self, data):
+        """ Return the (N, ncomp) float64 frame encoded in data. """
+        magic, is_key, precision, compression, _, nbodies, ncomp = \
+            _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError('not a snapshot frame')
+        precision = _PRECISIONS[precision]
+        compression = _COMPRESSIONS[compression]
+        code_dtype = _CODE_DTYPES[precision]
+
+        offset = _HEADER.size
+        if precision.startswith('uint'):
+            bounds = np.frombuffer(data, np.float64, 2*ncomp, offset)
+            lo, hi = bounds[:ncomp], bounds[ncomp:]
+            offset += bounds.nbytes
+
+        payload = data[offset:]
+        if compression == 'zlib':
+            payload = zlib.decompress(payload)
+        elif compression == 'lzma':
+            payload = lzma.decompress(payload)
+        codes = _unshuffle(payload, code_dtype).reshape(ncomp, nbodies)
+
+        if not is_key:
+            if self._decoded is None:
+                raise ValueError('delta frame decoded without its keyframe')
+            codes = _undelta(codes, self._decoded, precision)
+        self._decoded = codes
+
+        if precision.startswith('uint'):
+            nlevels = np.iinfo(code_dtype).max
+            span = hi - lo
+            step = np.where(span > 0, span/nlevels, 0.)
+            planar = lo[:, None] + codes*step[:, None]
+        else:
+            planar = codes.view(precision).astype(np.float64)
+        return np.ascontiguousarray(planar.T)
+
+
+def _delta(codes, previous, precision):
+    """ Difference of codes against the previous frame (wrapping for
+    quantized values, XOR of the bit patterns for floats). """
+    if precision.startswith('uint'):
+        return codes - previous
+    return codes ^ previous
+
+
+def _undelta(delta, previous, precision):
+    if precision.startswith('uint'):
+        return delta + previous
+    return delta ^ previous
+
+
+def _shuffle(codes):
+    """ Group the bytes of codes by significance. """
+    itemsize = codes.dtype.itemsize
+    return np.ascontiguousarray(
+        codes.reshape(-1).view(np.uint8).reshape(-1, itemsize).T).tobytes()
+
+
+def _unshuffle(data, dtype):
+    itemsize = np.dtype(dtype).itemsize
+    planes = np.frombuffer(data, np.uint8).reshape(itemsize, -1)
+    return np.ascontiguousarray(planes.T).view(dtype).reshape(-1)
+
+
+class SnapshotAppender(object):
+    """ File of encoded snapshots, each prefixed by its length.
+
+    Has the same interface as trajectory.NpyAppender.
+    """
+
+    def __init__(self, path, codec):
+        self.path = path
+        self.codec = codec
+        self.nframes = 0
+        self._file = open(path, 'wb')
+
+    def append(self, frame):
+        data = self.codec.encode(frame)
+        self._file.write(struct.pack('<Q', len(data)))
+        self._file.write(data)
+        self._file.flush()
+        self.nframes += 1
+
+    def close(self):
+        self._file.close()
+
+
+def read_snapshots(path, codec=None):
+    """ Iterate over the frames of a file written by SnapshotAppender. """
+    codec = SnapshotCodec() if codec is None else codec
+    codec.reset()
+    with open(path, 'rb') as f:
+        while True:
+            size = f.read(8)
+            if len(size) < 8:
+                return
+            data = f.read(struct.unpack('<Q', size)[0])
+            yield codec.decode(data)
+
+
+def benchmark(codec, frames):
+    """ Encode and decode a sequence of frames.
+
+    Returns a dict with the encode and decode throughputs in MB/s of raw
+    float64 data, the compression ratio and the maximal absolute round-trip
+    error compared to the maximal error bound.
+    """
+    frames = [np.asarray(f, dtype=np.float64) for f in frames]
+    raw = sum(f.nbytes for f in frames)
+
+    codec.reset()
+    t = time.perf_counter()
+    encoded = []
+    bounds = []
+    for f in frames:
+        encoded.append(codec.encode(f))
+        bounds.append(codec.error_bound)
+    t_encode = time.perf_counter() - t
+
+    codec.reset()
+    t = time.perf_counter()
+    decoded = [codec.decode(d) for d in encoded]
+    t_decode = time.perf_counter() - t
+
+    error = max(np.abs(f - d).max(initial=0.) for f, d in zip(frames, decoded))
+    return {
+        'encode_MBps': raw/t_encode/1e6,
+        'decode_MBps': raw/t_decode/1e6,
+        'ratio': raw/sum(len(d) for d in encoded),
+        'max_error': error,
+        'max_error_bound': max(b.max() for b in bounds),
+    }
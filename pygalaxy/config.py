@@ -0,0 +1,185 @@
+import contextlib
+import os
+import threading
+
+import numba
+from numba.np.ufunc import parallel as _parallel
+
+# threading layers of Numba, the first four select one of the last three
+layers = ('default', 'safe', 'threadsafe', 'forksafe', 'workqueue', 'omp', 'tbb')
+
+# number of threads of set_threads, None if not set
+_threads = None
+# number of open threads contexts of each Python thread
+_local = threading.local()
+
+
+def max_threads():
+    """ Number of threads of the Numba pool (NUMBA_NUM_THREADS). """
+    return numba.config.NUMBA_NUM_THREADS
+
+
+def _check_threads(n):
+    if not 1 <= n <= max_threads():
+        raise ValueError('the number of threads must be in [1, {}], got {}'
+                         .format(max_threads(), n))
+
+
+def set_threads(n):
+    """ Set the number of threads of the parallel kernels.
+
+    Numba keeps a number of threads per Python thread: the functions of
+    pygalaxy launching parallel kernels run them in a threads context, so
+    that they use this number whatever the Python thread calling them (e.g.
+    the one of a runner.BackgroundSimulation or of a hook). They are the
+    engines (BarnesHut of both trees, ThetaTuner, ParticleMesh, TreePM and
+    the compute_energy functions), the trees (construction, mass
+    distribution, evaluate_field, nearest neighbour and range queries),
+    diagnostics.Diagnostics, density.Animation, out_of_core.spatial_sort
+    and the initial condition generators of init. Kernels called directly
+    use the number of the calling thread.
+
+    None to use all the threads of the pool.
+    """
+    global _threads
+    if n is not None:
+        _check_threads(n)
+    _threads = n
+    numba.set_num_threads(max_threads() if n is None else n)
+
+
+@contextlib.contextmanager
+def threads(n=None):
+    """ Context in which the parallel kernels launched by the calling thread
+    use n threads, the number of set_threads if n is None. The engines run
+    their kernels in this context with their threads parameter, so that the
+    number of threads can be chosen for each engine (or each call). The
+    number of the calling thread is kept if neither is set, or in a nested
+    context (e.g. a tree built by an engine). """
+    depth = getattr(_local, 'depth', 0)
+    if n is None:
+        n = numba.get_num_threads() if _threads is None or depth else _threads
+    _check_threads(n)
+    previous = numba.get_num_threads()
+    numba.set_num_threads(n)
+    _local.depth = depth + 1
+    try:
+        yield n
+    finally:
+        _local.depth = depth
+        numba.set_num_threads(previous)
+
+
+def set_threading_layer(layer):
+    """ Choose the threading layer of the parallel kernels (see layers and
+    the Numba documentation).
+
+    The layer is started by the first parallel kernel and cannot be
+    changed afterwards: a RuntimeError is raised if another layer is
+    already running.
+    """
+    if layer not in layers:
+        raise ValueError('unknown threading layer {!r}, expected one of {}'.format(layer, layers))
+    if _parallel._is_initialized:
+        if layer in (numba.config.THREADING_LAYER, numba.threading_layer()):
+            return
+        raise RuntimeError('the {} threading layer is already running, choose the layer '
+                           'before the first parallel kernel'.format(numba.threading_layer()))
+    numba.config.THREADING_LAYER = layer
+
+
+def set_affinity(cpus, pin=False):
+    """ Restrict the threads of the process to the CPUs cpus (Linux only).
+
+    The running threads are moved to these CPUs and the threads started
+    later (the Numba pool if no parallel kernel has run yet) inherit them.
+
+    If pin is True, the threads of the OpenMP layer are also bound one per
+    core (OMP_PROC_BIND and OMP_PLACES), which has to be done before the
+    layer is started; the other layers let the system place their threads
+    on the CPUs.
+    """
+    if not hasattr(os, 'sched_setaffinity'):
+        raise NotImplementedError('thread affinity is not supported on this platform')
+    cpus = set(cpus)
+    if pin:
+        if _parallel._is_initialized:
+            raise RuntimeError('the threads can only be pinned before the first parallel kernel')
+        os.environ['OMP_PROC_BIND'] = 'close'
+        os.environ['OMP_PLACES'] = 'cores'
+    try:
+        tasks = [int(tid) for tid in os.listdir('/proc/self/task')]
+    except OSError:
+        tasks = [0]
+    for tid in tasks:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except ProcessLookupError:
+            # the thread has exited
+            pass
+
+
+def configure(threads=None, threading_layer=None, affinity=None, pin=False):
+    """ Apply the given settings (see set_threading_layer, set_affinity and
+    set_threads), the ones that are None are left unchanged. """
+    if threading_layer is not None:
+        set_threading_layer(threading_layer)
+    if affinity is not None:
+        set_affinity(affinity, pin)
+    if threads is not None:
+        set_threads(threads)
+
+
+def parse_cpus(text):
+    """ CPUs of a list like '0-3,8,10-11'. """
+    cpus = []
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _format_cpus(cpus):
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else '{}-{}'.format(a, b) for a, b in ranges)
+
+
+def info():
+    """ Current settings: the number of threads of the calling thread, the
+    size of the pool, the threading layer (the running one, or the chosen
+    one if no parallel kernel has run yet) and the CPUs of the process
+    (None if unknown). """
+    # numba.get_num_threads would start the threading layer
+    if _parallel._is_initialized:
+        layer = numba.threading_layer()
+        nthreads = numba.get_num_threads()
+    else:
+        layer = numba.config.THREADING_LAYER
+        nthreads = max_threads() if _threads is None else _threads
+    cpus = None
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    return {'threads': nthreads,
+            'max_threads': max_threads(),
+            'threading_layer': layer,
+            'started': bool(_parallel._is_initialized),
+            'cpus': cpus,
+            'pinned': os.environ.get('OMP_PROC_BIND') is not None}
+
+
+def describe():
+    """ One line summary of info, for the benchmark outputs. """
+    settings = info()
+    line = 'threads {threads}/{max_threads}, layer {threading_layer}'.format(**settings)
+    if not settings['started']:
+        line += ' (not started)'
+    if settings['cpus'] is not None:
+        line += ', cpus ' + _format_cpus(settings['cpus'])
+    if settings['pinned']:
+        line += ', pinned'
+    return line
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+import math
+import struct
+import time
+import zlib
+
+import numpy as np
+import numba
+
+from . import config
+
+
+@numba.njit(parallel=True, nogil=True)
+def splat(coords, colors, origin, scale, partial):
+    """ Accumulate the bodies into partial images, one per chunk of bodies.
+
+    Each body is spread on the 4 nearest pixels (cloud in cell). Channel 0
+    holds the density (weighted by the body opacity), channels 1 to 3 the
+    colors weighted the same way.
+    """
+    nchunks, height, width, _ = partial.shape
+    n = coords.shape[0]
+    for c in numba.prange(nchunks):
+        image = partial[c]
+        image[:] = 0.
+        for i in range(c*n//nchunks, (c+1)*n//nchunks):
+            fx = (coords[i, 0] - origin[0])/scale - .5
+            fy = (coords[i, 1] - origin[1])/scale - .5
+            if not (-1. < fx < width and -1. < fy < height):
+                continue
+            ix = int(math.floor(fx))
+            iy = int(math.floor(fy))
+            wx = fx - ix
+            wy = fy - iy
+            alpha = colors[i, 3]
+            for dy in range(2):
+                y = iy + dy
+                if y < 0 or y >= height:
+                    continue
+                for dx in range(2):
+                    x = ix + dx
+                    if x < 0 or x >= width:
+                        continue
+                    w = alpha*(wx if dx else 1. - wx)*(wy if dy else 1. - wy)
+                    image[y, x, 0] += w
+                    image[y, x, 1] += w*colors[i, 0]
+                    image[y, x, 2] += w*colors[i, 1]
+                    image[y, x, 3] += w*colors[i, 2]
+
+
+@numba.njit(parallel=True, nogil=True)
+def reduce_images(partial, image):
+    """ Sum the partial images into image. """
+    nchunks, height, width, nchannels = partial.shape
+    for y in numba.prange(height):
+        for x in range(width):
+            for k in range(nchannels):
+                v = 0.
+                for c in range(nchunks):
+                    v += partial[c, y, x, k]
+                image[y, x, k] = v
+
+
+def tone_map(image, density_factor=1.):
+    """ Return the RGB uint8 picture of an accumulated image.
+
+    The brightness varies as log(1 + density/density_factor) normalized by
+    its maximum, like the opacity of the nebulae shader of the OpenGL
+    renderer, and the color is the mean color of the bodies in the pixel.
+    """
+    density = image[..., 0]
+    brightness = np.log1p(density/density_factor)
+    brightness /= max(brightness.max(), 1e-30)
+    color = image[..., 1:]/np.maximum(density, 1e-30)[..., None]
+    rgb = np.clip(255.*color*brightness[..., None], 0., 255.).astype(np.uint8)
+    # first row of a picture is the top of the view
+    return np.ascontiguousarray(rgb[::-1])
+
+
+def write_png(path, rgb):
+    """ Write an (height, width, 3) uint8 array in a PNG file. """
+    height, width, _ = rgb.shape
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    # each row is prefixed by its filter type (0: none)
+    rows = np.zeros((height, 1 + 3*width), dtype=np.uint8)
+    rows[:, 1:] = rgb.reshape(height, -1)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 1)))
+        f.write(chunk(b'IEND', b''))
+
+
+class Animation(object):
+    """ Headless simulation renderer writing density maps in image files. """
+
+    def __init__(self, simu, axis=[0, 1, 0, 1], size=[1024, 1024],
+                 number_iterations=50, every=1, output="frame_{:05d}.png",
+                 use_colors=True, density_factor=1.):
+        """ Initialize an animation view.
+
+        Parameters:
+        -----------
+        simu: object
+            Simulation object with coords and next methods (and colors if
+            use_colors is True).
+        axis: list
+            Axis bounds [ xmin, xmax, ymin, ymax ].
+        size: list
+            Image size [width, height].
+        number_iterations: int
+            Number of calls to simu.next.
+        every: int
+            Number of iterations between two frames.
+        output: str
+            Frame file name, formatted with the frame number. Frames are
+            written as PNG files, or as raw .npy accumulation images
+            (density and weighted colors) if the name ends with .npy.
+        use_colors: bool
+            True to colorize the stars using simu.colors method, white
+            otherwise (or if simu has no colors method).
+        density_factor: float
+            Density of the log tone mapping knee.
+        """
+        self.simu = simu
+        self.size = size
+        self.scale = max((axis[1]-axis[0])/size[0], (axis[3]-axis[2])/size[1])
+        # center the axis in the image
+        self.origin = np.array([
+            .5*(axis[0] + axis[1]) - .5*size[0]*self.scale,
+            .5*(axis[2] + axis[3]) - .5*size[1]*self.scale])
+        self.number_iterations = number_iterations
+        self.every = every
+        self.output = output
+        self.use_colors = use_colors
+        self.density_factor = density_factor
+
+        self.image = np.zeros((size[1], size[0], 4), dtype=np.float32)
+        # one partial image per thread, allocated by render
+        # (numba.get_num_threads would start the threading layer here)
+        self._partial = np.zeros((0, *self.image.shape), dtype=np.float32)
+        self.render_time = 0.
+
+    def render(self):
+        """ Accumulate the current bodies in self.image. """
+        coords = self.simu.coords()
+        if self.use_colors and hasattr(self.simu, 'colors'):
+            colors = np.asarray(self.simu.colors())
+            if colors.shape[1] == 3:
+                colors = np.concatenate([colors, np.ones((colors.shape[0], 1))], axis=1)
+        else:
+            colors = np.ones((coords.shape[0], 4))
+
+        with config.threads() as nthreads:
+            if self._partial.shape[0] != nthreads:
+                self._partial = np.zeros((nthreads, *self.image.shape), dtype=np.float32)
+            splat(coords, colors, self.origin, self.scale, self._partial)
+            reduce_images(self._partial, self.image)
+        return self.image
+
+    def save(self, frame):
+        """ Render and write the frame file. """
+        t = time.time()
+        self.render()
+        path = self.output.format(frame)
+        if path.endswith('.npy'):
+            np.save(path, self.image)
+        else:
+            write_png(path, tone_map(self.image, self.density_factor))
+        self.render_time = time.time() - t
+
+    def main_loop(self):
+        """ main loop. """
+        self.save(0)
+        for i in range(1, self.number_iterations):
+            self.simu.next()
+            if i % self.every == 0:
+                self.save(i // self.every)
+            print("{}/{} ({:.1f}ms/frame)".format(
+                i, self.number_iterations, 1000*self.render_time), end="\r")
+        print()
@@ -0,0 +1,85 @@
+import numpy as np
+import numba
+
+from . import config
+
+
+@numba.njit(parallel=True)
+def conserved_quantities(mass, particles, potential):
+    """ Return kinetic energy, potential energy, momentum (px, py) and
+    angular momentum in one pass over the bodies.
+
+    potential is the per-body gravitational potential as accumulated by the
+    Barnes-Hut engine with with_potential=True.
+    """
+    kinetic = 0.
+    pot = 0.
+    px = 0.
+    py = 0.
+    lz = 0.
+    for i in numba.prange(particles.shape[0]):
+        x, y, vx, vy = particles[i, 0], particles[i, 1], particles[i, 2], particles[i, 3]
+        m = mass[i]
+        kinetic += .5*m*(vx*vx + vy*vy)
+        pot += .5*m*potential[i]
+        px += m*vx
+        py += m*vy
+        lz += m*(x*vy - y*vx)
+    return kinetic, pot, px, py, lz
+
+
+class Diagnostics:
+    """ History of the conserved quantities of a simulation.
+
+    Each call to update appends a row to the history with the columns given
+    by Diagnostics.columns. The energy drift is relative to the first
+    recorded total energy.
+    """
+
+    columns = ('time', 'kinetic', 'potential', 'energy', 'energy_drift',
+               'px', 'py', 'angular_momentum')
+
+    def __init__(self):
+        self.history = []
+        self.energy0 = None
+
+    def update(self, mass, particles, potential, time=None):
+        """ Record the conserved quantities of the current state.
+
+        Parameters:
+        -----------
+        mass: array
+            Mass of the bodies.
+        particles: array
+            (N,4) state of the bodies.
+        potential: array
+            Gravitational potential at the body positions, e.g. the potential
+            attribute of a BarnesHut engine whose last evaluation was done on
+            particles.
+        time: float
+            Simulated time of the state. Defaults to the number of records.
+        """
+        with config.threads():
+            kinetic, pot, px, py, lz = conserved_quantities(mass, particles, potential)
+        energy = kinetic + pot
+        if self.energy0 is None:
+            self.energy0 = energy
+
+        if time is None:
+            time = len(self.history)
+
+        drift = (energy - self.energy0)/abs(self.energy0) if self.energy0 != 0 else 0.
+        row = (time, kinetic, pot, energy, drift, px, py, lz)
+        self.history.append(row)
+        return dict(zip(self.columns, row))
+
+    def as_array(self):
+        """ Return the history as a (records, len(columns)) array. """
+        return np.array(self.history).reshape(-1, len(self.columns))
+
+    def __str__(self):
+        if not self.history:
+            return 'no diagnostics'
+        time, kinetic, pot, energy, drift, px, py, lz = self.history[-1]
+        return 't={:g} E={:.6e} dE/E0={:+.3e} P=({:.3e}, {:.3e}) L={:.6e}'.format(
+            time, energy, drift, px, py, lz)
@@ -0,0 +1,116 @@
+import numpy as np
+import numba
+
+from .barnes_hut_array import build_tree, count_massive
+from .soa import take
+
+
+@numba.njit(nogil=True)
+def close_pairs(indices, offsets, particles, radius2):
+    """ Pairs (i, j), i < j, of the candidates of a range query closer than
+    sqrt(radius2) at the current positions. """
+    npairs = 0
+    pairs = np.empty((indices.size, 2), dtype=np.int64)
+    for i in range(offsets.size - 1):
+        for k in range(offsets[i], offsets[i+1]):
+            j = indices[k]
+            if j <= i:
+                continue
+            dx = particles[j, 0] - particles[i, 0]
+            dy = particles[j, 1] - particles[i, 1]
+            if dx*dx + dy*dy <= radius2:
+                pairs[npairs, 0] = i
+                pairs[npairs, 1] = j
+                npairs += 1
+    return pairs[:npairs]
+
+
+@numba.njit(nogil=True)
+def merge_pairs(pairs, mass, particles, alive):
+    """ Merge the second body of each pair into the first one, in place.
+
+    The merged body is at the center of mass of the pair with its momentum.
+    A body already merged is skipped (its partner is merged into the body
+    that absorbed it at a later step, if still close). Returns the number of
+    merged bodies.
+    """
+    nmerged = 0
+    for k in range(pairs.shape[0]):
+        i = pairs[k, 0]
+        j = pairs[k, 1]
+        if not (alive[i] and alive[j]):
+            continue
+        m = mass[i] + mass[j]
+        for c in range(4):
+            particles[i, c] = (mass[i]*particles[i, c] + mass[j]*particles[j, c])/m
+        mass[i] = m
+        alive[j] = False
+        nmerged += 1
+    return nmerged
+
+
+class Encounters(object):
+    """ Close encounter pass merging (or flagging) the bodies closer than
+    capture_radius.
+
+    The candidates are found with a range query on the Barnes-Hut tree,
+    so the pass costs about one tree walk with a small radius. Merging
+    conserves mass and momentum; the merged bodies are removed and the
+    time scheme buffers are resized (see TimeScheme.resize).
+
+    Example, after each step of a simulation:
+
+        encounters = Encounters(capture_radius=1e-3)
+        ...
+        scheme.update(mass, particles)
+        mass, particles = encounters(mass, particles, scheme, engine.tree)
+
+    Parameters:
+    -----------
+    capture_radius: float
+        Distance below which two bodies are merged.
+    merge: bool
+        If False, the close pairs are only stored in self.pairs for a
+        special handling and the bodies are left unchanged.
+    """
+
+    def __init__(self, capture_radius, merge=True):
+        self.capture_radius = capture_radius
+        self.merge = merge
+        self.pairs = np.empty((0, 2), dtype=np.int64)
+        self.nmerged = 0
+
+    def find(self, mass, particles, tree=None):
+        """ Return the (npairs, 2) indices of the massive bodies closer than
+        capture_radius.
+
+        tree is used if it was built on the current positions of the massive
+        bodies (e.g. the tree of an engine called at the end of a Stormer
+        step, checked with tree.builtOn), otherwise a new one is built. A
+        tree with escapers (see BarnesHut core_quantile) is not used either,
+        its queries do not see them.
+        """
+        nmassive = count_massive(mass)
+        if tree is None or tree.escapers.size or not tree.builtOn(particles[:nmassive]):
+            tree = build_tree(mass, particles)
+        indices, offsets = tree.findInRadius(particles[:nmassive, :2],
+                                             self.capture_radius)
+        return close_pairs(indices, offsets, particles,
+                           self.capture_radius**2)
+
+    def __call__(self, mass, particles, scheme=None, tree=None):
+        """ Find the close pairs and merge them.
+
+        Returns mass and particles, which are new arrays if bodies were
+        merged; scheme (if given) is resized accordingly.
+        """
+        self.pairs = self.find(mass, particles, tree)
+        if not self.merge or self.pairs.shape[0] == 0:
+            return mass, particles
+
+        alive = np.ones(mass.size, dtype=np.bool_)
+        nmerged = merge_pairs(self.pairs, mass, particles, alive)
+        self.nmerged += nmerged
+        if scheme is not None:
+            scheme.resize(alive)
+        return mass[alive], take(particles, alive)
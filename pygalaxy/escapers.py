@@ -0,0 +1,27 @@
+import numpy as np
+
+from .barnes_hut_array import count_massive
+from .soa import take
+
+
+def remove_escapers(mass, particles, radius, center=None, scheme=None):
+    """ Remove the bodies further than radius from center.
+
+    center is the center of mass of the massive bodies by default. As for
+    merged bodies (see encounters.Encounters), scheme (if given) is resized
+    and mass and particles are new arrays if bodies were removed.
+
+    Returns mass, particles and the indices of the removed bodies.
+    """
+    if center is None:
+        nmassive = count_massive(mass)
+        center = np.average(particles[:nmassive, :2], axis=0,
+                            weights=mass[:nmassive])
+    dist2 = ((particles[:, :2] - center)**2).sum(axis=1)
+    keep = dist2 <= radius**2
+    if keep.all():
+        return mass, particles, np.empty(0, dtype=np.int64)
+
+    if scheme is not None:
+        scheme.resize(keep)
+    return mass[keep], take(particles, keep), np.flatnonzero(~keep)
@@ -2,11 +2,15 @@
 
 import numpy as np
 
+from .trajectory import TrajectoryWriter
+
 
 class Animation(object):
     """ Simulation renderer in output file. """
 
-    def __init__(self, simu, axis=[0, 1, 0, 1]):
+    def __init__(self, simu, axis=[0, 1, 0, 1], number_iterations=50,
+                 output="particles.npy", every=1, codec=None,
+                 tracers=None, tracers_output="tracers.npy", tracers_every=1):
         """ Initialize an animation view.
 
         Parameters:
@@ -15,14 +19,28 @@ class Animation(object):
             Simulation object with coords and next methods
         axis: list
             Axis bounds [ xmin, xmax, ymin, ymax ].
+        number_iterations: int
+            Number of calls to simu.next.
+        output: str
+            File of the full snapshots.
+        every: int
+            Number of iterations between two full snapshots.
+        codec: codec.SnapshotCodec or None
+            Codec compressing the full snapshots (read them back with
+            codec.read_snapshots).
+        tracers: array or None
+            Indices of bodies written to tracers_output every tracers_every
+            iterations.
         """
 
         self.simu = simu
 
-        self.number_iterations = 50
-        self.history = np.empty(
-            shape=(self.number_iterations, *self.simu.particles.shape))
-        self.history[0] = self.simu.particles
+        self.number_iterations = number_iterations
+        self.writer = TrajectoryWriter()
+        self.writer.add_stream(output, every=every, codec=codec)
+        if tracers is not None:
+            self.writer.add_stream(tracers_output, every=tracers_every,
+                                   bodies=tracers)
 
     def _update_coords(self, i):
         """ Update scatter coordinates. """
@@ -35,11 +53,14 @@ class Animation(object):
     def main_loop(self):
         """ main loop. """
 
-        for i in range(self.number_iterations):
-            print(f"{i}/{self.number_iterations}", end="\r")
-            self.history[i] = self._update_coords(i)
-
-        print("save history...")
-        # save all history into a file
-        np.save("particles.npy", self.history)
         np.save("mass.npy", self.simu.mass)
+
+        # snapshots are streamed to the output files while running
+        self.writer.write(0, self.simu.particles)
+        try:
+            for i in range(1, self.number_iterations):
+                print(f"{i}/{self.number_iterations}", end="\r")
+                self.writer.write(i, self._update_coords(i))
+        finally:
+            print("save history...")
+            self.writer.close()
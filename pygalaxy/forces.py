@@ -1,16 +1,105 @@
+from collections import namedtuple
+import functools
 from math import sqrt
+from . import physics
 from .physics import gamma_si, eps, gamma_1
 import numpy as np
 import numba
 
+softenings = ('plummer', 'spline', 'none')
+
+Kernel = namedtuple('Kernel', ['softening', 'eps', 'G', 'pair'])
+
+def make_kernel(softening='plummer', eps=eps, G='si'):
+    """ Interaction kernel of a softening law and a gravitational constant.
+
+    The pair function of the kernel, pair(r2, m), returns the factor f and
+    the potential phi of the interaction with a mass m at the squared
+    distance r2: the acceleration is f times the offset to the mass. It is
+    compiled with the parameters as constants, and the engines given the
+    kernel (the kernel argument of the BarnesHut engines, TreePM and the
+    compute_energy functions) are compiled for it, so that a kernel costs
+    the same as the hard-coded one. Kernels are cached: the same parameters
+    give the same kernel and reuse its compiled engines.
+
+    Parameters:
+    -----------
+    softening: str
+        'plummer' (1/sqrt(r2 + eps)), 'spline' (the cubic spline kernel,
+        newtonian beyond 2.8 sqrt(eps), with the same central potential as
+        the Plummer one) or 'none'.
+    eps: float
+        Squared softening length.
+    G: float or str
+        Gravitational constant, or the name of a unit system of
+        physics.units ('si', 'pc_msun_yr' or 'nbody').
+    """
+    if softening not in softenings:
+        raise ValueError('unknown softening {!r}, expected one of {}'.format(softening, softenings))
+    if isinstance(G, str):
+        if G not in physics.units:
+            raise ValueError('unknown unit system {!r}, expected one of {}'.format(G, tuple(physics.units)))
+        G = physics.units[G]
+    if softening == 'none' or eps == 0.:
+        softening, eps = 'none', 0.
+    return _make_kernel(softening, float(eps), float(G))
+
+@functools.lru_cache(maxsize=None)
+def _make_kernel(softening, eps, G):
+    if softening == 'plummer':
+        @numba.njit(inline='always')
+        def pair(r2, m):
+            inv = 1./sqrt(r2 + eps)
+            return G*m*inv*inv*inv, -G*m*inv
+
+    elif softening == 'spline':
+        # Monaghan & Lattanzio (1985) kernel, of support h
+        hinv = 1./(2.8*sqrt(eps))
+        hinv3 = hinv*hinv*hinv
+
+        @numba.njit(inline='always')
+        def pair(r2, m):
+            r = sqrt(r2)
+            u = r*hinv
+            if u < 0.5:
+                f = hinv3*(10.666666666667 + u*u*(32.*u - 38.4))
+                phi = hinv*(-2.8 + u*u*(5.333333333333 + u*u*(6.4*u - 9.6)))
+            elif u < 1.:
+                f = hinv3*(21.333333333333 - 48.*u + 38.4*u*u - 10.666666666667*u*u*u
+                           - 0.066666666667/(u*u*u))
+                phi = hinv*(-3.2 + 0.066666666667/u
+                            + u*u*(10.666666666667 + u*(-16. + u*(9.6 - 2.133333333333*u))))
+            else:
+                f = 1./(r2*r)
+                phi = -1./r
+            return G*m*f, G*m*phi
+
+    else:
+        @numba.njit(inline='always')
+        def pair(r2, m):
+            # no interaction of a body with itself
+            if r2 == 0.:
+                return 0., 0.
+            inv = 1./sqrt(r2)
+            return G*m*inv*inv*inv, -G*m*inv
+
+    return Kernel(softening, eps, G, pair)
+
+# Plummer softening of physics.eps, in SI units
+default_kernel = make_kernel()
+_default_pair = default_kernel.pair
+
 @numba.njit
 def force(p1, p2, m2):
     dx = p2[0] - p1[0]
     dy = p2[1] - p1[1]
-    dist = sqrt(dx**2 + dy**2 + eps)
+    F, _ = _default_pair(dx**2 + dy**2, m2)
+    return F * dx, F * dy
 
-    F = 0.
-    if dist > 0:
-        F = (gamma_si * m2) / (dist*dist*dist)
 
-    return F * dx, F * dy
+@numba.njit
+def potential(p1, p2, m2):
+    dx = p2[0] - p1[0]
+    dy = p2[1] - p1[1]
+    _, phi = _default_pair(dx**2 + dy**2, m2)
+    return phi
@@ -1,5 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
+from math import sqrt, sin, cos, log, exp, pi
+
 import numpy as np
+import numba
 from .physics import gamma_1, gamma_si
+from . import config
 
 def init_solar_system():
     bodies = np.array([[        0, 0, 0,      0], #sun
@@ -44,11 +49,14 @@ def init_collisions(blackHole):
     npart = len(blackHole)
     for b in blackHole:
         npart += b['stars']
+    # massless tracer stars are stored after all the massive bodies
+    ntracers = sum(b.get('tracers', 0) for b in blackHole)
 
-    particles = np.empty((npart, 4))
-    mass = np.empty(npart)
+    particles = np.empty((npart + ntracers, 4))
+    mass = np.empty(npart + ntracers)
 
     ind = 0
+    velocities = []
     for ib, b in enumerate(blackHole):
         particles[ind, :2] = b['coord']
         mass[ind] = b['mass']
@@ -61,23 +69,236 @@ def init_collisions(blackHole):
             vxb, vyb = getOrbitalVelocity(blackHole[0]['coord'][0], blackHole[0]['coord'][1], blackHole[0]['mass'], b['coord'][0], b['coord'][1])
             particles[ind, 2] = b['svel']*vxb
             particles[ind, 3] = b['svel']*vyb
+        velocities.append((vxb, vyb))
         ind += 1
 
         nstars = b['stars']
-        rad = b['radstars']
-        r = 0.3 + .8 * (rad * np.random.rand(nstars))
-        a = 2*np.pi*np.random.rand(nstars)
-        tmp_mass = 0.03 + 20*np.random.rand(nstars)
-        x = b['coord'][0] + r*np.sin(a)
-        y = b['coord'][1] + r*np.cos(a)
-
-        vx, vy = getOrbitalVelocity(b['coord'][0], b['coord'][1], b['mass'], x, y)
-
-        particles[ind:ind+nstars, 0] = x
-        particles[ind:ind+nstars, 1] = y
-        particles[ind:ind+nstars, 2] = vx + vxb
-        particles[ind:ind+nstars, 3] = vy + vyb
-        mass[ind:ind+nstars] = tmp_mass
+        _init_stars(b, particles[ind:ind+nstars], vxb, vyb)
+        mass[ind:ind+nstars] = 0.03 + 20*np.random.rand(nstars)
+        ind += nstars
+
+    for b, (vxb, vyb) in zip(blackHole, velocities):
+        nstars = b.get('tracers', 0)
+        _init_stars(b, particles[ind:ind+nstars], vxb, vyb)
+        mass[ind:ind+nstars] = 0.
         ind += nstars
 
     return mass, particles
+
+def _init_stars(b, particles, vxb, vyb):
+    """ Stars on circular orbits around the black hole b (of velocity
+    vxb, vyb). """
+    nstars = particles.shape[0]
+    rad = b['radstars']
+    r = 0.3 + .8 * (rad * np.random.rand(nstars))
+    a = 2*np.pi*np.random.rand(nstars)
+    x = b['coord'][0] + r*np.sin(a)
+    y = b['coord'][1] + r*np.cos(a)
+
+    vx, vy = getOrbitalVelocity(b['coord'][0], b['coord'][1], b['mass'], x, y)
+
+    particles[:, 0] = x
+    particles[:, 1] = y
+    particles[:, 2] = vx + vxb
+    particles[:, 3] = vy + vyb
+
+
+###############################################################################
+# Fast generators for large N
+#
+# The bodies are generated by chunks of chunk_size bodies, in parallel on
+# numba.get_num_threads() threads, directly in the particles and mass arrays
+# (which can be given, e.g. memory-mapped with np.lib.format.open_memmap, or
+# views on a part of a bigger array). Each chunk has its own random stream
+# spawned from numpy.random.SeedSequence(seed), so the result only depends
+# on seed and chunk_size, not on the number of threads.
+
+@numba.njit(nogil=True)
+def _ring_chunk(seed, particles, mass, center, velocity, central_mass, r0, dr,
+                massless, G):
+    np.random.seed(seed)
+    for i in range(particles.shape[0]):
+        r = r0 + dr*np.random.random()
+        a = 2*pi*np.random.random()
+        dx = r*sin(a)
+        dy = r*cos(a)
+        # circular orbit around the central mass (see getOrbitalVelocity)
+        v = sqrt(G*central_mass/r)
+        particles[i, 0] = center[0] + dx
+        particles[i, 1] = center[1] + dy
+        particles[i, 2] = velocity[0] - dy/r*v
+        particles[i, 3] = velocity[1] + dx/r*v
+        mass[i] = 0. if massless else 0.03 + 20*np.random.random()
+
+@numba.njit(nogil=True)
+def _plummer_chunk(seed, particles, mass, center, velocity, total_mass, a,
+                   body_mass, G):
+    np.random.seed(seed)
+    for i in range(particles.shape[0]):
+        # radius from the inverse of the cumulative mass, 1 - random() is in
+        # (0, 1]
+        u = 1. - np.random.random()
+        r = a/sqrt(max(u**(-2./3.) - 1., 1e-300))
+        # escape velocity fraction by rejection (Aarseth, Henon, Wielen 1974)
+        while True:
+            q = np.random.random()
+            g = .1*np.random.random()
+            if g < q*q*(1. - q*q)**3.5:
+                break
+        v = q*sqrt(2.*G*total_mass)*(r*r + a*a)**(-.25)
+
+        # isotropic directions projected on the plane
+        cost = 2.*np.random.random() - 1.
+        phi = 2*pi*np.random.random()
+        rxy = r*sqrt(1. - cost*cost)
+        cost = 2.*np.random.random() - 1.
+        psi = 2*pi*np.random.random()
+        vxy = v*sqrt(1. - cost*cost)
+
+        particles[i, 0] = center[0] + rxy*cos(phi)
+        particles[i, 1] = center[1] + rxy*sin(phi)
+        particles[i, 2] = velocity[0] + vxy*cos(psi)
+        particles[i, 3] = velocity[1] + vxy*sin(psi)
+        mass[i] = body_mass
+
+@numba.njit(nogil=True)
+def _disk_chunk(seed, particles, mass, center, velocity, total_mass,
+                scale_length, central_mass, sigma, body_mass, G):
+    np.random.seed(seed)
+    for i in range(particles.shape[0]):
+        # surface density exp(-r/h): r/h follows a Gamma(2) distribution
+        r = -scale_length*log((1. - np.random.random())*(1. - np.random.random()))
+        r = max(r, 1e-12*scale_length)
+        a = 2*pi*np.random.random()
+        dx = r*cos(a)
+        dy = r*sin(a)
+        # circular velocity from the enclosed mass
+        x = r/scale_length
+        enclosed = total_mass*(1. - (1. + x)*exp(-x)) + central_mass
+        v = sqrt(G*enclosed/r)
+
+        particles[i, 0] = center[0] + dx
+        particles[i, 1] = center[1] + dy
+        particles[i, 2] = velocity[0] - dy/r*v + sigma*v*np.random.standard_normal()
+        particles[i, 3] = velocity[1] + dx/r*v + sigma*v*np.random.standard_normal()
+        mass[i] = body_mass
+
+def _allocate(n, particles, mass):
+    if particles is None:
+        particles = np.empty((n, 4))
+    if mass is None:
+        mass = np.empty(n)
+    if particles.shape != (n, 4) or mass.shape != (n,):
+        raise ValueError('particles and mass must have the shapes {} and {}'
+                         .format((n, 4), (n,)))
+    return particles, mass
+
+def _generate(kernel, particles, mass, seed, chunk_size, *args):
+    """ Run kernel(chunk seed, particles chunk, mass chunk, *args) on every
+    chunk, in parallel. """
+    n = particles.shape[0]
+    nchunks = max(1, -(-n // chunk_size))
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    seeds = [int(s.generate_state(1)[0]) for s in seed.spawn(nchunks)]
+
+    def run(c):
+        chunk = slice(c*chunk_size, (c + 1)*chunk_size)
+        kernel(seeds[c], particles[chunk], mass[chunk], *args)
+
+    with config.threads() as nthreads, ThreadPoolExecutor(nthreads) as pool:
+        # list() to raise the errors of the chunks
+        list(pool.map(run, range(nchunks)))
+
+def plummer(n, total_mass=1., a=1., center=(0., 0.), velocity=(0., 0.),
+            G=gamma_si, seed=None, particles=None, mass=None,
+            chunk_size=2**16):
+    """ Plummer sphere of n equal mass bodies projected on the plane.
+
+    Parameters:
+    -----------
+    n: int
+        Number of bodies.
+    total_mass, a: float
+        Mass and scale radius of the sphere.
+    center, velocity: tuple
+        Position and velocity of the center of the sphere.
+    G: float
+        Gravitational constant used for the velocities.
+    seed: int, SeedSequence or None
+        Seed of the random streams.
+    particles, mass: arrays or None
+        (n, 4) and (n,) arrays filled in place, allocated if None.
+    chunk_size: int
+        Number of bodies generated by a random stream.
+
+    Returns mass and particles.
+    """
+    particles, mass = _allocate(n, particles, mass)
+    _generate(_plummer_chunk, particles, mass, seed, chunk_size,
+              np.asarray(center, dtype=np.float64),
+              np.asarray(velocity, dtype=np.float64),
+              float(total_mass), float(a), total_mass/max(n, 1), float(G))
+    return mass, particles
+
+def exponential_disk(n, total_mass=1., scale_length=1., central_mass=0.,
+                     sigma=0., center=(0., 0.), velocity=(0., 0.), G=gamma_si,
+                     seed=None, particles=None, mass=None, chunk_size=2**16):
+    """ Exponential disk of n equal mass bodies on circular orbits.
+
+    The circular velocity is computed from the mass of the disk enclosed in
+    the radius of the body plus central_mass (e.g. a black hole or a bulge
+    that is not part of the bodies), and a gaussian dispersion of sigma
+    times this velocity is added.
+
+    The other parameters are those of plummer. Returns mass and particles.
+    """
+    particles, mass = _allocate(n, particles, mass)
+    _generate(_disk_chunk, particles, mass, seed, chunk_size,
+              np.asarray(center, dtype=np.float64),
+              np.asarray(velocity, dtype=np.float64),
+              float(total_mass), float(scale_length), float(central_mass),
+              float(sigma), total_mass/max(n, 1), float(G))
+    return mass, particles
+
+def generate_collisions(blackHole, seed=None, particles=None, mass=None,
+                        chunk_size=2**16):
+    """ Same configuration as init_collisions, with the fast generators.
+
+    The bodies are in the same order (black holes followed by their stars,
+    then the tracers) but the random numbers differ from init_collisions.
+    Returns mass and particles.
+    """
+    nbodies = [1 + b['stars'] for b in blackHole]
+    ntracers = [b.get('tracers', 0) for b in blackHole]
+    n = sum(nbodies) + sum(ntracers)
+    particles, mass = _allocate(n, particles, mass)
+    seeds = (seed if isinstance(seed, np.random.SeedSequence)
+             else np.random.SeedSequence(seed)).spawn(2*len(blackHole))
+
+    ind = 0
+    starts = []
+    for ib, b in enumerate(blackHole):
+        particles[ind, :2] = b['coord']
+        mass[ind] = b['mass']
+        if ib == 0:
+            vb = np.zeros(2)
+        else:
+            vb = np.array(getOrbitalVelocity(blackHole[0]['coord'][0], blackHole[0]['coord'][1], blackHole[0]['mass'], b['coord'][0], b['coord'][1]))
+        particles[ind, 2:] = b['svel']*vb
+        starts.append((ind + 1, vb))
+        ind += nbodies[ib]
+
+    for ib, b in enumerate(blackHole):
+        for count, start, massless in ((b['stars'], starts[ib][0], False),
+                                       (ntracers[ib], ind, True)):
+            chunk = slice(start, start + count)
+            _generate(_ring_chunk, particles[chunk], mass[chunk],
+                      seeds[2*ib + massless], chunk_size,
+                      np.asarray(b['coord'], dtype=np.float64), starts[ib][1],
+                      float(b['mass']), .3, .8*b['radstars'], massless,
+                      gamma_si)
+        ind += ntracers[ib]
+
+    return mass, particles
+
@@ -1,14 +1,22 @@
-from ..forces import force
+from ..forces import default_kernel
 import numpy as np
 import numba
 
 #@numba.njit
-def compute_energy(mass, particles, energy):
+def compute_energy(mass, particles, energy, potential=None, kernel=default_kernel):
     energy[:] = 0.
+    if potential is not None:
+        potential[:] = 0.
     N = energy.shape[0]
+    # trailing massless bodies (tracers) do not contribute
+    nonzero = np.flatnonzero(mass)
+    nmassive = nonzero[-1] + 1 if nonzero.size else 0
     for i in range(N):
-        for j in range(N):
+        for j in range(nmassive):
             if i != j:
-                F = force(particles[i, :2], particles[j,:2], mass[j])
-                energy[i, 2:] += F
+                d = particles[j, :2] - particles[i, :2]
+                f, phi = kernel.pair(d[0]**2 + d[1]**2, mass[j])
+                energy[i, 2:] += f*d
+                if potential is not None:
+                    potential[i] += phi
     energy[:, :2] = particles[:, 2:]
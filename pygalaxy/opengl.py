@@ -2,7 +2,6 @@
 
 from OpenGL.GL import *
 from OpenGL.GLUT import *
-import OpenGL.arrays.vbo as glvbo
 from OpenGL.GL import shaders
 
 import sys
@@ -11,6 +10,8 @@ import numpy as np
 import time
 from copy import deepcopy
 
+from .barnes_hut_array import build_tree
+
 
 class Animation(object):
     """ Simulation renderer using OpenGL.
@@ -103,9 +104,13 @@ class Animation(object):
         glutKeyboardFunc(self._keyboard)
 
         # Create a Vertex Buffer Object for the vertices
+        self.upload_bytes = 0
+        self._upload_bytes = 0
         coords = simu.coords()
-        self._star_vbo = glvbo.VBO(coords)
+        self._star_vbo = Animation._Buffer()
+        self._upload_bytes += self._star_vbo.update(coords)
         self._star_count = coords.shape[0]
+        self._coords_version = 0
 
         # Display options
         self.use_colors_update = update_colors
@@ -131,7 +136,7 @@ class Animation(object):
 
         if self.__use_colors:
             try:
-                if self.use_colors_update or not hasattr(self, 'vbo_color'):
+                if self.use_colors_update or not hasattr(self, '_color_vbo'):
                     self._update_colors()
                 glEnableClientState(GL_COLOR_ARRAY)
             except AttributeError as e:
@@ -433,6 +438,39 @@ class Animation(object):
                 self.__use_nebulae_render = False
                 print('Nebulae render failure: {}'.format(str(e)))
 
+    @property
+    def use_lod(self):
+        """ Control the level of detail rendering.
+
+        Tree cells smaller than lod_pixel_size pixels are drawn as a single
+        point at their center of mass (with the mean color of their stars),
+        so that the number of drawn points depends on the screen resolution
+        instead of the number of stars.
+        The tree is given by the simu.tree method if any (e.g. the tree
+        built by the Barnes-Hut engine), otherwise it is built from the
+        coordinates.
+        """
+        try:
+            return self.__use_lod
+        except AttributeError:
+            return False
+
+    @use_lod.setter
+    def use_lod(self, value):
+        self.__use_lod = value
+
+    @property
+    def lod_pixel_size(self):
+        """ Screen size (in pixels) below which a tree cell is aggregated. """
+        try:
+            return self.__lod_pixel_size
+        except AttributeError:
+            return 1.
+
+    @lod_pixel_size.setter
+    def lod_pixel_size(self, value):
+        self.__lod_pixel_size = value
+
     ###########################################################################
     # Public methods
 
@@ -493,33 +531,110 @@ class Animation(object):
             self.origin = origin
             self.scale = scale
 
+    class _Buffer(object):
+        """ Single precision Vertex Buffer Object updated in place.
+
+        The data is converted to float32 in a persistent host array and
+        uploaded with glBufferSubData; the buffer is only reallocated when
+        the shape changes.
+        """
+        def __init__(self):
+            self.id = glGenBuffers(1)
+            self.data = None
+            self._new_data = None
+
+        def update(self, array, only_if_changed=False):
+            """ Upload array and return the number of uploaded bytes. """
+            array = np.asarray(array)
+            if self.data is None or self.data.shape != array.shape:
+                self.data = np.empty(array.shape, dtype=np.float32)
+                self._new_data = np.empty_like(self.data)
+                np.copyto(self.data, array, casting='unsafe')
+                glBindBuffer(GL_ARRAY_BUFFER, self.id)
+                glBufferData(GL_ARRAY_BUFFER, self.data.nbytes, self.data,
+                             GL_DYNAMIC_DRAW)
+                return self.data.nbytes
+
+            if only_if_changed:
+                np.copyto(self._new_data, array, casting='unsafe')
+                if np.array_equal(self._new_data, self.data):
+                    return 0
+                self.data, self._new_data = self._new_data, self.data
+            else:
+                np.copyto(self.data, array, casting='unsafe')
+
+            glBindBuffer(GL_ARRAY_BUFFER, self.id)
+            glBufferSubData(GL_ARRAY_BUFFER, 0, self.data.nbytes, self.data)
+            return self.data.nbytes
+
+        def bind(self):
+            glBindBuffer(GL_ARRAY_BUFFER, self.id)
+
     ###########################################################################
     # Internal methods
 
     def _update_coords(self):
         """ Update vertex coordinates. """
         coords = self.simu.coords()
-        self._star_vbo.set_array(coords)
+        self._upload_bytes += self._star_vbo.update(coords)
         self._star_count = coords.shape[0]
+        self._coords_version += 1
 
         # Centering view on tracked star
         if self.tracked_star is not None:
             self.center_view(*coords[self.tracked_star])
 
     def _update_colors(self):
-        """ Update or create Vertex Buffer Object of colors. """
+        """ Update or create Vertex Buffer Object of colors.
+
+        Colors are only uploaded when they differ from the current ones.
+        """
         colors = self.simu.colors()
 
-        try:
-            self.vbo_color.set_array(colors)
-        except AttributeError:
-            self.vbo_color = glvbo.VBO(colors)
+        if not hasattr(self, '_color_vbo'):
+            self._color_vbo = Animation._Buffer()
+        self._upload_bytes += self._color_vbo.update(colors, only_if_changed=True)
+        self._lod_colors = None
 
-        self.vbo_color.bind()
+        self._color_vbo.bind()
         if colors.shape[1] == 3:
-            glColorPointer(3, GL_DOUBLE, 0, None)
+            glColorPointer(3, GL_FLOAT, 0, None)
         else:
-            glColorPointer(4, GL_DOUBLE, 0, None)
+            glColorPointer(4, GL_FLOAT, 0, None)
+
+    def _update_lod(self):
+        """ Select the tree nodes drawn in the current view and upload
+        their coordinates and colors. """
+        if getattr(self, '_lod_version', None) != self._coords_version:
+            tree = self.simu.tree() if hasattr(self.simu, 'tree') else None
+            if tree is None or tree.nbodies != self._star_count:
+                coords = self.simu.coords()
+                tree = build_tree(np.ones(coords.shape[0]), coords)
+            self._lod_tree = tree
+            self._lod_colors = None
+            self._lod_version = self._coords_version
+
+            if not hasattr(self, '_lod_vbo'):
+                self._lod_vbo = Animation._Buffer()
+                self._lod_color_vbo = Animation._Buffer()
+
+        tree = self._lod_tree
+        if self.use_colors and self._lod_colors is None:
+            self._lod_colors = tree.computeColorDistribution(self._color_vbo.data)
+
+        bmin = np.asarray(self.axis.origin)
+        bmax = bmin + self.axis.scale * np.asarray(self.size)
+        nodes = tree.selectNodes(0.5 * self.lod_pixel_size * self.axis.scale,
+                                 bmin, bmax)
+        self._upload_bytes += self._lod_vbo.update(tree.center_of_mass[nodes])
+        if self.use_colors:
+            self._upload_bytes += \
+                self._lod_color_vbo.update(self._lod_colors[nodes])
+        self._lod_count = nodes.size
+
+    def _draw_count(self):
+        """ Number of vertices to draw. """
+        return self._lod_count if self.use_lod else self._star_count
 
     def _mouse(self, button, state, x, y):
         """ Called when a mouse button has been pressed/released. """
@@ -594,6 +709,8 @@ class Animation(object):
             self.use_pixel_render = not self.use_pixel_render
         elif key == b'n':
             self.use_nebulae_render = not self.use_nebulae_render
+        elif key == b'l':
+            self.use_lod = not self.use_lod
         elif key == b't':
             self.tracked_star = self._find_nearest_star(x, y)
         elif key == b'T':
@@ -641,6 +758,7 @@ u: toggle colors update
 o: toggle adaptative opacity
 s: toggle star display (pixels)
 n: toggle nebulae display
+l: toggle level of detail
 t: track nearest star
 T: disable tracking
 p: pause (or <space>)
@@ -656,13 +774,22 @@ h: toggle help display""")
         return len(self.frame_times) / duration
 
     def _print_fps(self):
-        """ Calculate and print fps. """
-        self._print("{:.1f}fps".format(self._fps()))
+        """ Calculate and print fps and uploaded bytes per frame. """
+        self._print("{:.1f}fps {:.1f}kB/frame".format(
+            self._fps(), self.upload_bytes/1024))
 
     def _find_nearest_star(self, x, y):
         """ Return the index of the nearest star from mouse coordinates. """
         mouse_pos = \
             self.axis.origin + self.axis.scale * np.asarray([x, self.size[1]-y])
+
+        # Query the tree of the simulation (built at the last force
+        # evaluation) if any, unless it leaves escapers out
+        tree = self.simu.tree() if hasattr(self.simu, 'tree') else None
+        if tree is not None and tree.nbodies == self._star_count \
+                and not tree.escapers.size:
+            return tree.findNearest(mouse_pos)
+
         return ((self.simu.coords() - mouse_pos) ** 2).sum(axis=1).argmin()
 
     def _calc_opacity_factor(self):
@@ -674,14 +801,23 @@ h: toggle help display""")
 
     def _bind_star_vbo(self):
         """ Bind the vertex buffer object with star coordinates. """
-        # Bind the vertex VBO
-        self._star_vbo.bind()
+        # Bind the vertex VBO (stars or tree nodes)
+        if self.use_lod:
+            self._lod_vbo.bind()
+        else:
+            self._star_vbo.bind()
 
         # Tell OpenGL that the VBO contains an array of vertices
         glEnableClientState(GL_VERTEX_ARRAY)
 
-        # These vertices contain 2 double precision coordinates
-        glVertexPointer(2, GL_DOUBLE, 0, None)
+        # These vertices contain 2 single precision coordinates
+        glVertexPointer(2, GL_FLOAT, 0, None)
+
+        # Colors of these vertices
+        if self.use_colors:
+            vbo = self._lod_color_vbo if self.use_lod else self._color_vbo
+            vbo.bind()
+            glColorPointer(vbo.data.shape[1], GL_FLOAT, 0, None)
 
     def _draw_pixels(self, frame_buffer=0):
         """ Draw stars as pixels.
@@ -703,7 +839,7 @@ h: toggle help display""")
             glUseProgram(0)
 
         # Draw "count" points from the VBO
-        glDrawArrays(GL_POINTS, 0, self._star_count)
+        glDrawArrays(GL_POINTS, 0, self._draw_count())
 
     def _draw_nebulae(self, frame_buffer=0):
         """ Draw stars as nebulae.
@@ -735,7 +871,7 @@ h: toggle help display""")
         bind_uniform_1f('density_factor', self.nebulae_density_factor)
 
         # Draw "count" point sprites from the VBO
-        glDrawArrays(GL_POINTS, 0, self._star_count)
+        glDrawArrays(GL_POINTS, 0, self._draw_count())
 
         # Disabling sprite and point size
         glDisable(GL_PROGRAM_POINT_SIZE)
@@ -767,6 +903,10 @@ h: toggle help display""")
         # Draw color
         glColor(1., 1., 1.)
 
+        # Select the tree nodes to draw
+        if self.use_lod:
+            self._update_lod()
+
         # Draw stars as nebulae
         if self.use_nebulae_render:
             self._draw_nebulae()
@@ -786,6 +926,10 @@ h: toggle help display""")
         # Swap display buffers
         glutSwapBuffers()
 
+        # Bytes uploaded to the GPU since the previous frame
+        self.upload_bytes = self._upload_bytes
+        self._upload_bytes = 0
+
 
 ###############################################################################
 # Demo
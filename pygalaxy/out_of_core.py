@@ -0,0 +1,137 @@
+import os
+import tempfile
+
+import numpy as np
+import numba
+
+from .barnes_hut_array import count_massive
+from . import config
+
+
+class Storage(object):
+    """ Memory-mapped arrays for systems larger than the memory.
+
+    The arrays are files of directory, mapped in memory: the operating
+    system pages them in and out as they are used, so only the working set
+    (the top of the tree and the chunk of bodies being processed) has to fit
+    in memory. The files are removed as soon as they are mapped, their space
+    is released with the arrays.
+
+    A storage is given to the time schemes (their buffers) and to the
+    BarnesHut engine (the tree and the walk), which then process the bodies
+    by chunks of chunk_size. The bodies should be sorted along a space
+    filling curve (see spatial_sort) so that the chunks are spatially
+    coherent.
+
+    Example:
+
+        storage = Storage('/scratch/run')
+        mass, particles = pygalaxy.exponential_disk(
+            n, particles=storage.zeros((n, 4)), mass=storage.zeros(n))
+        mass, particles, _ = spatial_sort(mass, particles, storage)
+        engine = BarnesHut(storage=storage)
+        scheme = Stormer_verlet(dt, n, engine, storage)
+
+    Parameters:
+    -----------
+    directory: str
+        Directory of the files, on a disk (not a tmpfs, which is in memory).
+    chunk_size: int
+        Number of bodies per chunk.
+    soa: bool
+        True to create the arrays in the structure of arrays layout (see
+        soa.zeros).
+    """
+
+    def __init__(self, directory, chunk_size=2**20, soa=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.soa = soa
+
+    def zeros(self, shape, dtype=np.float64):
+        """ New memory-mapped array filled with zeros, like numpy.zeros. """
+        shape = tuple(np.atleast_1d(shape))
+        if self.soa and len(shape) >= 2:
+            return self._memmap(shape[:-2] + shape[:-3:-1], dtype).swapaxes(-1, -2)
+        return self._memmap(shape, dtype)
+
+    def _memmap(self, shape, dtype):
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape))*dtype.itemsize
+        if nbytes == 0:
+            return np.zeros(shape, dtype=dtype)
+        fd, path = tempfile.mkstemp(suffix='.dat', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w+b') as f:
+                f.truncate(nbytes)
+                return np.memmap(f, dtype=dtype, mode='r+', shape=shape)
+        finally:
+            os.remove(path)
+
+    def chunks(self, n):
+        """ Slices of the chunks of n bodies. """
+        return [slice(start, min(start + self.chunk_size, n))
+                for start in range(0, n, self.chunk_size)]
+
+
+@numba.njit
+def spread_bits(v):
+    """ Bits of v (< 2**31) interleaved with zeros. """
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+
+@numba.njit(parallel=True, nogil=True)
+def morton_keys(particles, bmin, scale, keys):
+    """ Position of the bodies along the Z-order curve of the box starting at
+    bmin, scale being the number of curve cells per unit length. """
+    for i in numba.prange(particles.shape[0]):
+        ix = min(max(int((particles[i, 0] - bmin[0])*scale), 0), 2**31 - 1)
+        iy = min(max(int((particles[i, 1] - bmin[1])*scale), 0), 2**31 - 1)
+        keys[i] = spread_bits(ix) | (spread_bits(iy) << 1)
+
+
+def spatial_sort(mass, particles, storage=None):
+    """ Sort the bodies along a Z-order (Morton) curve.
+
+    The bodies close in space are then close in memory, and so are the
+    cells of the tree built on them (the cells are created in the insertion
+    order), so that a chunk of bodies only touches a small part of the
+    arrays. The massive bodies and the tracers are sorted separately, the
+    tracers staying last.
+
+    The sorted arrays are allocated by storage (in memory if None), the keys
+    and the order use 16 bytes of memory per body. The buffers of a time
+    scheme are not reordered: sort before creating it.
+
+    Returns the sorted mass and particles and the order of the bodies
+    (sorted = original[order]).
+    """
+    n = mass.shape[0]
+    nmassive = count_massive(mass)
+    allocate = np.zeros if storage is None else storage.zeros
+    chunks = [slice(0, n)] if storage is None else storage.chunks(n)
+
+    order = np.empty(n, dtype=np.int64)
+    for start, end in ((0, nmassive), (nmassive, n)):
+        if start == end:
+            continue
+        bmin = np.min(particles[start:end, :2], axis=0)
+        bmax = np.max(particles[start:end, :2], axis=0)
+        scale = (2**31 - 1)/max(np.max(bmax - bmin), 1e-300)
+        keys = np.empty(end - start, dtype=np.int64)
+        with config.threads():
+            morton_keys(particles[start:end], bmin, scale, keys)
+        order[start:end] = start + np.argsort(keys, kind='stable')
+
+    sorted_mass = allocate(mass.shape)
+    sorted_particles = allocate(particles.shape)
+    for s in chunks:
+        sorted_mass[s] = mass[order[s]]
+        sorted_particles[s] = particles[order[s]]
+    return sorted_mass, sorted_particles, order
@@ -0,0 +1 @@
+from .energy import compute_energy, ParticleMesh, TreePM
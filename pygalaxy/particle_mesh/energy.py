@@ -0,0 +1,171 @@
+import numpy as np
+import numba
+
+from ..physics import theta
+from ..forces import default_kernel
+from .. import config
+from ..barnes_hut_array import build_tree
+from ..barnes_hut_array.energy import compute_short_force
+from ..barnes_hut_array.numba_functions import shortRangeTable
+from . import numba_functions
+
+# assignment schemes and their order (see numba_functions)
+assignments = {'cic': 1, 'tsc': 2}
+
+class ParticleMesh:
+    """ Particle-mesh engine.
+
+    The masses are assigned to a (ngrid, ngrid) grid covering the bodies,
+    the potential and the accelerations on the grid are the convolutions
+    of the masses with the interaction kernels, done with zero padded FFTs
+    (isolated boundaries), and they are interpolated back to the bodies.
+    The cost is O(n + ngrid^2 log(ngrid)), but the forces are smoothed at
+    the grid scale.
+
+    Instances are called like compute_energy and can be given to the time
+    schemes as their method.
+
+    Parameters:
+    -----------
+    ngrid: int
+        Number of grid nodes in each direction.
+    assignment: str
+        Mass assignment and interpolation scheme, 'cic' (cloud in cell) or
+        'tsc' (triangular shaped cloud).
+    softening: float or None
+        Softening length of the interaction, the grid spacing if None.
+    with_potential: bool
+        True to compute the potential of the bodies in self.potential.
+    kernel: forces.Kernel
+        Interaction (see forces.make_kernel), physics.eps in SI units by
+        default. The mesh uses its gravitational constant and its eps as a
+        Plummer softening.
+    threads: int or None
+        Number of threads of the parallel kernels, the one of
+        config.set_threads if None.
+    """
+    def __init__(self, ngrid=256, assignment='tsc', softening=None,
+                 with_potential=False, kernel=None, threads=None):
+        if assignment not in assignments:
+            raise ValueError('unknown assignment {!r}'.format(assignment))
+        self.ngrid = ngrid
+        self.assignment = assignment
+        self.order = assignments[assignment]
+        self.softening = softening
+        self.with_potential = with_potential
+        self.kernel = default_kernel if kernel is None else kernel
+        self.threads = threads
+        self.potential = np.empty(0)
+
+        # one partial grid per thread, allocated by mesh (numba.get_num_threads
+        # would start the threading layer here)
+        self._partial = np.zeros((0, ngrid, ngrid))
+        self._grid = np.zeros((2*ngrid, 2*ngrid))
+        self._kernels = np.zeros((3, 2*ngrid, 2*ngrid))
+
+    def __call__(self, mass, particles, energy):
+        with config.threads(self.threads):
+            self.mesh(mass, particles, energy, self._potential(particles))
+        energy[:, :2] = particles[:, 2:]
+
+    def _potential(self, particles):
+        if not self.with_potential:
+            return np.empty(0)
+        if self.potential.size != particles.shape[0]:
+            self.potential = np.zeros(particles.shape[0])
+        return self.potential
+
+    def grid_of(self, particles):
+        """ Origin and spacing of the grid covering the bodies, with a margin
+        for the assignment stencil. """
+        bmin = np.min(particles[:, :2], axis=0)
+        bmax = np.max(particles[:, :2], axis=0)
+        margin = self.order + 1
+        h = max(np.max(bmax - bmin), 1e-300)/(self.ngrid - 1 - 2*margin)
+        return bmin - margin*h, h
+
+    def mesh(self, mass, particles, energy, potential, rs=0.):
+        """ Set the accelerations of energy (and potential if not empty) to
+        the ones of the mesh.
+
+        rs is the scale of the TreePM split (see green_functions), 0 for the
+        whole softened interaction.
+        """
+        n = self.ngrid
+        origin, self.h = self.grid_of(particles)
+        softening = self.h if self.softening is None else self.softening
+
+        if self._partial.shape[0] != numba.get_num_threads():
+            self._partial = np.zeros((numba.get_num_threads(), n, n))
+        numba_functions.assign(particles, mass, origin, self.h, self.order, self._partial)
+        self._grid[:] = 0.
+        numba_functions.reduce_grids(self._partial, self._grid[:n, :n])
+
+        numba_functions.green_functions(2*n, self.h, self.kernel.G, self.kernel.eps + softening**2, rs, self._kernels)
+        rho = np.fft.rfft2(self._grid)
+        fields = np.empty((3, n, n))
+        for k in range(3):
+            fields[k] = np.fft.irfft2(rho*np.fft.rfft2(self._kernels[k]), s=self._grid.shape)[:n, :n]
+
+        numba_functions.interpolate(particles, mass, origin, self.h, self.order,
+                                    fields, self._kernels[0], energy, potential)
+
+class TreePM(ParticleMesh):
+    """ TreePM engine: particle-mesh long range forces and Barnes-Hut short
+    range ones.
+
+    The interaction is split at the scale rs: the mesh computes the
+    interaction of the masses smoothed by a gaussian of width rs, the tree
+    walk the rest, which vanishes beyond a few rs, so the cells further than
+    rcut are not walked. The last built tree is kept in self.tree.
+
+    Parameters:
+    -----------
+    theta: float
+        Opening angle of the tree walk.
+    ngrid, assignment, with_potential, threads:
+        See ParticleMesh.
+    kernel: forces.Kernel
+        Interaction of the tree walk (see forces.make_kernel). The split
+        factors are those of the Plummer softening of its eps, so the
+        kernel must be a Plummer (or unsoftened) one.
+    rs: float
+        Split scale, in grid spacings.
+    rcut: float
+        Cutoff of the tree walk, in rs.
+    """
+    def __init__(self, theta=theta, ngrid=256, assignment='tsc', rs=1.25,
+                 rcut=4.5, with_potential=False, kernel=None, threads=None):
+        super().__init__(ngrid, assignment, 0., with_potential, kernel, threads)
+        if self.kernel.softening not in ('plummer', 'none'):
+            raise ValueError('TreePM needs a plummer (or unsoftened) kernel, got a {} one'
+                             .format(self.kernel.softening))
+        self.theta = theta
+        self.rs = rs
+        self.rcut = rcut
+        self.tree = None
+
+    def __call__(self, mass, particles, energy):
+        with config.threads(self.threads):
+            self._compute(mass, particles, energy)
+
+    def _compute(self, mass, particles, energy):
+        potential = self._potential(particles)
+        self.tree = build_tree(mass, particles)
+        origin, h = self.grid_of(particles)
+        rs = self.rs*h
+        self.mesh(mass, particles, energy, potential, rs)
+
+        root = self.tree
+        table = shortRangeTable(rs, 2*self.rcut*rs, 4096, self.kernel.eps)
+        compute_short_force( root.nbodies, root.child, root.center_of_mass, root.mass, root.cell_center, root.cell_radius, root.max_depth, particles, energy, self.theta, self.kernel.pair, table, self.rcut*rs, potential )
+        energy[:, :2] = particles[:, 2:]
+
+def compute_energy(mass, particles, energy, ngrid=256, assignment='tsc', potential=None,
+                   kernel=default_kernel):
+    engine = ParticleMesh(ngrid, assignment, kernel=kernel)
+    if potential is None:
+        potential = np.empty(0)
+    with config.threads():
+        engine.mesh(mass, particles, energy, potential)
+    energy[:, :2] = particles[:, 2:]
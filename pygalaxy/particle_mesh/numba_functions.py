@@ -0,0 +1,121 @@
+import math
+import numpy as np
+import numba
+
+# The grid nodes are at origin + (i, j)*h, grid[i, j] is the node (i, j)
+# (x first). The assignment orders are 1 for the cloud in cell (CIC) scheme
+# and 2 for the triangular shaped cloud (TSC) one.
+
+@numba.njit
+def weights(f, order, w):
+    """ First node and weights (in w) of the nodes around the grid
+    coordinate f. """
+    if order == 1:
+        i = int(math.floor(f))
+        d = f - i
+        w[0] = 1. - d
+        w[1] = d
+        return i
+    i = int(math.floor(f + .5))
+    d = f - i
+    w[0] = .5*(.5 - d)**2
+    w[1] = .75 - d*d
+    w[2] = .5*(.5 + d)**2
+    return i - 1
+
+@numba.njit(parallel=True, nogil=True)
+def assign(particles, mass, origin, h, order, partial):
+    """ Mass of the bodies assigned to the nodes, one partial grid per chunk
+    of bodies (see reduce_grids). """
+    nchunks = partial.shape[0]
+    n = mass.shape[0]
+    for c in numba.prange(nchunks):
+        grid = partial[c]
+        grid[:] = 0.
+        wx = np.empty(3)
+        wy = np.empty(3)
+        for b in range(c*n//nchunks, (c+1)*n//nchunks):
+            if mass[b] == 0.:
+                continue
+            ix = weights((particles[b, 0] - origin[0])/h, order, wx)
+            iy = weights((particles[b, 1] - origin[1])/h, order, wy)
+            for i in range(order + 1):
+                for j in range(order + 1):
+                    grid[ix + i, iy + j] += mass[b]*wx[i]*wy[j]
+
+@numba.njit(parallel=True, nogil=True)
+def reduce_grids(partial, grid):
+    """ Sum the partial grids into grid. """
+    nchunks, nx, ny = partial.shape
+    for i in numba.prange(nx):
+        for j in range(ny):
+            v = 0.
+            for c in range(nchunks):
+                v += partial[c, i, j]
+            grid[i, j] = v
+
+@numba.njit(parallel=True, nogil=True)
+def green_functions(n, h, G, eps, rs, kernels):
+    """ Potential and acceleration kernels, of the interaction of a unit mass
+    at the offsets of a (n, n) zero padded grid, in kernels[0:3].
+
+    The interaction is the softened newtonian one if rs is 0, otherwise
+    the long range part of a TreePM split of scale rs, the potential of a
+    mass smoothed by a gaussian: erf(r/(2 rs))/r. In both cases r is the
+    softened distance sqrt(d^2 + eps).
+    """
+    for a in numba.prange(n):
+        dx = (a if a < n//2 else a - n)*h
+        for b in range(n):
+            dy = (b if b < n//2 else b - n)*h
+            r2 = dx*dx + dy*dy
+            r = math.sqrt(r2 + eps)
+            if rs == 0.:
+                kernels[0, a, b] = -G/r
+                f = -G/(r*r*r)
+            elif r == 0.:
+                kernels[0, a, b] = -G/(math.sqrt(math.pi)*rs)
+                f = 0.
+            else:
+                u = r/(2*rs)
+                kernels[0, a, b] = -G*math.erf(u)/r
+                f = -G*(math.erf(u) - r/(math.sqrt(math.pi)*rs)*math.exp(-u*u))/(r*r*r)
+            # the acceleration of a body at d from the unit mass is f*d
+            kernels[1, a, b] = f*dx
+            kernels[2, a, b] = f*dy
+
+@numba.njit(parallel=True, nogil=True)
+def interpolate(particles, mass, origin, h, order, fields, kernel, energy, potential):
+    """ Accelerations (fields[1:3]) and potential (fields[0], if potential is
+    not empty) interpolated at the bodies with the assignment weights.
+
+    The interaction of a body with its own assigned mass is removed from the
+    potential using the potential kernel (the one of green_functions); it
+    cancels out in the accelerations.
+    """
+    with_potential = potential.size > 0
+    nfft = kernel.shape[0]
+    for b in numba.prange(particles.shape[0]):
+        wx = np.empty(3)
+        wy = np.empty(3)
+        ix = weights((particles[b, 0] - origin[0])/h, order, wx)
+        iy = weights((particles[b, 1] - origin[1])/h, order, wy)
+        ax = 0.
+        ay = 0.
+        pot = 0.
+        for i in range(order + 1):
+            for j in range(order + 1):
+                w = wx[i]*wy[j]
+                ax += w*fields[1, ix + i, iy + j]
+                ay += w*fields[2, ix + i, iy + j]
+                pot += w*fields[0, ix + i, iy + j]
+        energy[b, 2] = ax
+        energy[b, 3] = ay
+        if with_potential:
+            if mass[b] != 0.:
+                for i in range(order + 1):
+                    for j in range(order + 1):
+                        for k in range(order + 1):
+                            for l in range(order + 1):
+                                pot -= mass[b]*wx[i]*wy[j]*wx[k]*wy[l]*kernel[(i - k) % nfft, (j - l) % nfft]
+            potential[b] = pot
@@ -0,0 +1,331 @@
+import multiprocessing
+import threading
+import time
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# indices of the triple buffer shared state
+_LATEST, _READING, _SEQ, _STEPS = range(4)
+
+
+class TripleBuffer(object):
+    """ Three slots of arrays shared between one writer and one reader.
+
+    The writer fills a slot which is neither the latest published one nor
+    the one being read, then publishes it. The reader takes the latest
+    published slot. Neither side ever waits for the other, the lock only
+    protects the swap of the slot indices.
+    """
+
+    def __init__(self, slots, state, lock):
+        self.slots = slots
+        self.state = state
+        self.lock = lock
+
+    def back(self):
+        """ Slot index (and arrays) the writer can fill. """
+        with self.lock:
+            busy = (self.state[_LATEST], self.state[_READING])
+        index = [i for i in range(3) if i not in busy][0]
+        return index, self.slots[index]
+
+    def publish(self, index):
+        with self.lock:
+            self.state[_LATEST] = index
+            self.state[_SEQ] += 1
+            self.state[_STEPS] += 1
+
+    def acquire(self):
+        """ Reserve the latest published slot for reading and return its
+        arrays and sequence number. """
+        with self.lock:
+            self.state[_READING] = self.state[_LATEST]
+            seq = self.state[_SEQ]
+        return self.slots[self.state[_READING]], seq
+
+
+def _fields_of(simu, names):
+    values = {}
+    callables = {}
+    for name in names:
+        value = getattr(simu, name)
+        callables[name] = callable(value)
+        values[name] = np.asarray(value() if callable(value) else value)
+    return values, callables
+
+
+class _RemoteError(Exception):
+    """ Exception of the simulation process, sent with its traceback (the
+    exception itself may not be picklable). """
+
+
+def _run(simu, names, buffer, stop):
+    while not stop.is_set():
+        simu.next()
+        index, slot = buffer.back()
+        values, _ = _fields_of(simu, names)
+        for name in names:
+            if values[name].shape != slot[name].shape:
+                raise ValueError('field {!r} changed shape from {} to {}, the published '
+                                 'fields must keep their shape'.format(
+                                     name, slot[name].shape, values[name].shape))
+            slot[name][...] = values[name]
+        buffer.publish(index)
+
+
+def _process_main(factory, names, conn, state_name, lock, stop):
+    """ Body of the simulation process: build the simulation, send the
+    layout of the fields, attach to the shared memory and run. An exception
+    is sent to the parent instead. """
+    try:
+        _process_run(factory, names, conn, state_name, lock, stop)
+    except Exception:
+        try:
+            conn.send(_RemoteError(traceback.format_exc()))
+        except OSError:
+            # the parent is gone
+            pass
+
+
+def _process_run(factory, names, conn, state_name, lock, stop):
+    simu = factory()
+    values, callables = _fields_of(simu, names)
+    conn.send({name: (v.shape, v.dtype.str, callables[name])
+               for name, v in values.items()})
+    memory_names = conn.recv()
+
+    memories = []
+    slots = []
+    for i in range(3):
+        slot = {}
+        for name in names:
+            shm = shared_memory.SharedMemory(name=memory_names[i][name])
+            memories.append(shm)
+            slot[name] = np.ndarray(values[name].shape, values[name].dtype,
+                                    buffer=shm.buf)
+        slots.append(slot)
+    state_shm = shared_memory.SharedMemory(name=state_name)
+    state = np.ndarray(4, np.int64, buffer=state_shm.buf)
+
+    try:
+        # first snapshot is the initial state
+        for name in names:
+            slots[0][name][...] = values[name]
+        conn.send('ready')
+        _run(simu, names, TripleBuffer(slots, state, lock), stop)
+    finally:
+        del slots, state
+        for shm in memories + [state_shm]:
+            shm.close()
+
+
+class BackgroundSimulation(object):
+    """ Run a simulation in a background thread or process.
+
+    The renderers use this object as the simulation: next() only takes the
+    latest snapshot published by the background runner (it never waits for
+    a simulation step) and the fields (e.g. coords, colors) return the
+    arrays of this snapshot. The rendering rate is thus independent of the
+    simulation rate.
+
+    In 'thread' mode, simu is the simulation object; the Numba kernels
+    release the GIL so the rendering thread is not blocked. In 'process'
+    mode, factory is a picklable callable building the simulation in the
+    child process and snapshots are published through shared memory.
+
+    The fields must keep their shape during the run. An exception of the
+    background runner stops it and is raised again (as the cause of a
+    RuntimeError) by next and stop.
+
+    Parameters:
+    -----------
+    simu: object
+        Simulation object with a next method (thread mode).
+    fields: list of str
+        Names of the methods or attributes of the simulation published at
+        each step (e.g. 'coords', 'colors', 'particles', 'mass').
+    mode: str
+        'thread' or 'process'.
+    factory: callable
+        Builds the simulation object (process mode).
+    """
+
+    def __init__(self, simu=None, fields=('coords',), mode='thread',
+                 factory=None):
+        self.fields = tuple(fields)
+        self.mode = mode
+        self._error = None
+        self._frames = 0
+        self._t_start = None
+        self._memories = []
+
+        if mode == 'thread':
+            values, self._callables = _fields_of(simu, self.fields)
+            slots = [{name: v.copy() for name, v in values.items()}
+                     for i in range(3)]
+            self._state = np.zeros(4, np.int64)
+            self._stop = threading.Event()
+            self._buffer = TripleBuffer(slots, self._state, threading.Lock())
+            self._worker = threading.Thread(
+                target=self._thread_main, args=(simu,), daemon=True)
+        elif mode == 'process':
+            self._start_process(factory)
+        else:
+            raise ValueError('unknown mode {!r}'.format(mode))
+
+        self._snapshot, _ = self._buffer.acquire()
+        self._t_start = time.time()
+        self._worker.start()
+        if mode == 'process':
+            # the child end is only used by the child: the parent end sees
+            # the end of the pipe if the child exits
+            self._child_conn.close()
+            del self._child_conn
+            try:
+                self._handshake()
+            except BaseException:
+                # a child waiting for the parent sees the end of the pipe
+                self._conn.close()
+                self._stop.set()
+                self._worker.join()
+                self._release()
+                raise
+
+    def _thread_main(self, simu):
+        try:
+            _run(simu, self.fields, self._buffer, self._stop)
+        except Exception as e:
+            self._error = e
+
+    def _start_process(self, factory):
+        # spawn: forking a process running Numba threads is unsafe
+        ctx = multiprocessing.get_context('spawn')
+        self._lock = ctx.Lock()
+        self._stop = ctx.Event()
+        state_shm = shared_memory.SharedMemory(create=True, size=4*8)
+        self._memories.append(state_shm)
+        self._state = np.ndarray(4, np.int64, buffer=state_shm.buf)
+        self._state[:] = 0
+        self._conn, self._child_conn = ctx.Pipe()
+        self._worker = ctx.Process(
+            target=_process_main,
+            args=(factory, self.fields, self._child_conn, state_shm.name,
+                  self._lock, self._stop),
+            daemon=True)
+        # slots are allocated after the handshake, start with empty ones
+        self._buffer = TripleBuffer([{}] * 3, self._state, self._lock)
+
+    def _receive(self):
+        """ Next message of the simulation process during the start. """
+        try:
+            message = self._conn.recv()
+        except EOFError:
+            raise RuntimeError('the simulation process exited during its start') from None
+        if isinstance(message, _RemoteError):
+            raise RuntimeError('background simulation failed') from message
+        return message
+
+    def _check(self):
+        """ Raise the exception of the background runner, if any. """
+        if self.mode == 'process' and self._error is None and self._conn.poll():
+            try:
+                self._error = self._conn.recv()
+            except EOFError:
+                # the process exited without sending anything
+                if not self._stop.is_set():
+                    self._error = _RemoteError('the simulation process exited')
+        if self._error is not None:
+            raise RuntimeError('background simulation failed') from self._error
+
+    def _handshake(self):
+        layout = self._receive()
+        self._callables = {name: c for name, (_, _, c) in layout.items()}
+        slots = []
+        names = []
+        for i in range(3):
+            slot = {}
+            slot_names = {}
+            for name, (shape, dtype, _) in layout.items():
+                size = max(1, int(np.prod(shape))*np.dtype(dtype).itemsize)
+                shm = shared_memory.SharedMemory(create=True, size=size)
+                self._memories.append(shm)
+                slot[name] = np.ndarray(shape, dtype, buffer=shm.buf)
+                slot_names[name] = shm.name
+            slots.append(slot)
+            names.append(slot_names)
+        self._buffer.slots = slots
+        self._conn.send(names)
+
+        # wait for the initial snapshot
+        self._receive()
+        self._snapshot, _ = self._buffer.acquire()
+        self._t_start = time.time()
+
+    def next(self):
+        """ Switch to the latest published snapshot, without waiting. """
+        self._check()
+        self._snapshot, _ = self._buffer.acquire()
+        self._frames += 1
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self.fields:
+            raise AttributeError(name)
+        value = self._snapshot[name]
+        if self._callables[name]:
+            return lambda: value
+        return value
+
+    @property
+    def steps(self):
+        """ Number of simulation steps done by the background runner. """
+        return int(self._state[_STEPS])
+
+    def stats(self):
+        """ Return the simulated steps and the rendered frames (calls to
+        next) per second since the start. """
+        duration = max(time.time() - self._t_start, 1e-9)
+        return {'steps_per_s': self.steps/duration,
+                'fps': self._frames/duration}
+
+    def __str__(self):
+        return '{steps_per_s:.1f} steps/s, {fps:.1f} fps'.format(**self.stats())
+
+    def stop(self):
+        """ Stop the background runner and release the shared memory. """
+        self._stop.set()
+        self._worker.join()
+        self._release()
+        self._check()
+
+    def _release(self):
+        if self.mode == 'process':
+            # keep a copy of the last snapshot and drop the views on the
+            # shared memory before releasing it
+            self._snapshot = {name: v.copy() for name, v in self._snapshot.items()}
+            self._state = self._state.copy()
+            self._buffer = None
+            for shm in self._memories:
+                try:
+                    shm.close()
+                except BufferError:
+                    # an array of a snapshot is still referenced, the memory
+                    # is released when it is garbage collected
+                    pass
+                shm.unlink()
+            self._memories = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.stop()
+            return
+        # already failing (e.g. next raised the error of the runner): only
+        # release the resources
+        try:
+            self.stop()
+        except RuntimeError:
+            pass
@@ -0,0 +1,158 @@
+import math
+import time
+
+
+class _Hook(object):
+    def __init__(self, func, every, interval):
+        self.func = func
+        self.every = every
+        self.interval = interval
+        self.next_wall = math.inf
+
+
+class Simulation(object):
+    """ Run loop of a simulation.
+
+    The simulation owns the state (mass, particles), the time scheme and the
+    force engine. run advances it by a number of steps or until a wall clock
+    or simulated time budget is exhausted, reports the progress at most
+    every progress seconds and calls the hooks registered with add_hook
+    (outputs, diagnostics, rendering...) on their cadences. Between two of
+    these events the loop only calls scheme.update, the clock is read after
+    each step only if an event depends on it.
+
+    Hooks are called with the simulation as argument, and may replace its
+    mass and particles (e.g. after merging bodies, see encounters.Encounters).
+
+    Example:
+
+        simu = Simulation(mass, particles, pygalaxy.Stormer_verlet(dt, n, engine))
+        simu.add_hook(lambda s: writer.write(s.it, s.particles), every=100)
+        simu.add_hook(lambda s: server.publish(s.it, s.particles), interval=.5)
+        simu.run(wall_time=3600)
+
+    Parameters:
+    -----------
+    mass, particles: arrays
+        Initial state.
+    scheme: TimeScheme
+        Time scheme, built on the same number of bodies.
+    engine: object or None
+        Force engine, the method of the scheme if None.
+    progress: float or None
+        Minimal wall clock time in seconds between two progress reports,
+        None to disable them.
+    log: callable
+        Called with the progress report lines.
+    """
+
+    def __init__(self, mass, particles, scheme, engine=None, progress=10.,
+                 log=print):
+        self.mass = mass
+        self.particles = particles
+        self.scheme = scheme
+        self.engine = scheme.method if engine is None else engine
+        self.progress = progress
+        self.log = log
+        self.it = 0
+        self.time = 0.
+        self.hooks = []
+        self._report = None
+
+    def add_hook(self, func, every=None, interval=None):
+        """ Call func(self) after every `every` steps (when the iteration
+        counter is a multiple of every) and/or every `interval` seconds of
+        wall clock time. Returns the hook, see remove_hook. """
+        if every is None and interval is None:
+            raise ValueError('a hook needs a cadence (every or interval)')
+        hook = _Hook(func, every, interval)
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def run(self, nsteps=None, wall_time=None, sim_time=None):
+        """ Advance the simulation until nsteps steps are done, wall_time
+        seconds elapsed or the simulated time increased by sim_time, the
+        first reached. Returns the number of steps done. """
+        if nsteps is None and wall_time is None and sim_time is None:
+            raise ValueError('run needs a budget (nsteps, wall_time or sim_time)')
+
+        start = time.perf_counter()
+        start_it = self.it
+        end_wall = math.inf if wall_time is None else start + wall_time
+        end_time = None if sim_time is None else self.time + sim_time
+        if self._report is None:
+            self._report = (start, self.it)
+        for hook in self.hooks:
+            if hook.interval is not None and hook.next_wall == math.inf:
+                hook.next_wall = start + hook.interval
+
+        while True:
+            # number of steps before the next event depending on the steps
+            nrun = math.inf if nsteps is None else start_it + nsteps - self.it
+            for hook in self.hooks:
+                if hook.every is not None:
+                    nrun = min(nrun, hook.every - self.it % hook.every)
+            dt = self.scheme.dt
+            if end_time is not None:
+                nrun = min(nrun, max(1, math.ceil((end_time - self.time)/dt - 1e-9)))
+            if nrun <= 0:
+                break
+
+            # next event depending on the clock
+            next_wall = end_wall
+            if self.progress is not None:
+                next_wall = min(next_wall, self._report[0] + self.progress)
+            for hook in self.hooks:
+                next_wall = min(next_wall, hook.next_wall)
+
+            update = self.scheme.update
+            mass = self.mass
+            particles = self.particles
+            done = 0
+            if next_wall == math.inf:
+                while done < nrun:
+                    update(mass, particles)
+                    done += 1
+            else:
+                while done < nrun:
+                    update(mass, particles)
+                    done += 1
+                    if time.perf_counter() >= next_wall:
+                        break
+            self.it += done
+            self.time += done*dt
+
+            now = time.perf_counter()
+            for hook in self.hooks:
+                due = hook.every is not None and self.it % hook.every == 0
+                if now >= hook.next_wall:
+                    due = True
+                    hook.next_wall = now + hook.interval
+                if due:
+                    hook.func(self)
+            if self.progress is not None and now >= self._report[0] + self.progress:
+                self.report(now, None if nsteps is None else start_it + nsteps)
+
+            if now >= end_wall or (end_time is not None and self.time >= end_time - 1e-9*dt):
+                break
+        return self.it - start_it
+
+    def report(self, now=None, last_it=None):
+        """ Log the iteration, the simulated time and the rate of the steps
+        since the last report (and the remaining time if last_it, the last
+        iteration of the run, is given). """
+        now = time.perf_counter() if now is None else now
+        t, it = self._report
+        rate = (self.it - it)/(now - t) if now > t else math.inf
+        line = 'it {} time {:.6g}: {:.3g} steps/s'.format(self.it, self.time, rate)
+        if last_it is not None and rate > 0:
+            line += ', {:.0f}s left'.format((last_it - self.it)/rate)
+        self.log(line)
+        self._report = (now, self.it)
+
+    def next(self, nsteps=1):
+        """ Advance by nsteps steps (the interface used by the renderers). """
+        self.run(nsteps)
@@ -0,0 +1,100 @@
+import numpy as np
+
+# The structure of arrays (SoA) layout stores each component of the bodies in
+# a contiguous array. The state given to the engines and the time schemes is
+# still an (N, 4) array, a transposed (Fortran ordered) view of the
+# components: particles[:, 0] is the contiguous x array, and the slices of
+# columns (particles[:, :2], ...) are contiguous blocks.
+
+
+def zeros(shape, dtype=np.float64):
+    """ numpy.zeros in the SoA layout: the body dimension (the next to last
+    one) is the contiguous one. """
+    shape = tuple(shape)
+    if len(shape) < 2:
+        return np.zeros(shape, dtype=dtype)
+    return np.zeros(shape[:-2] + shape[:-3:-1], dtype=dtype).swapaxes(-1, -2)
+
+
+def is_soa(particles):
+    """ True if the bodies of particles are contiguous along each component. """
+    return particles.ndim == 2 and particles.strides[0] == particles.itemsize
+
+
+def take(array, keep):
+    """ array[keep] along the first dimension, in the layout of array (a
+    fancy index makes a row major copy). """
+    if array.ndim < 2 or not is_soa(array):
+        return array[keep]
+    return np.asfortranarray(array.T[:, keep].T)
+
+
+class Particles(object):
+    """ Bodies stored as a structure of arrays.
+
+    x, y, vx, vy and mass are contiguous arrays, the rows of self.data.
+    state is the (N, 4) view of the positions and velocities taken by the
+    engines, the time schemes and the writers, so that
+
+        bodies = Particles.from_arrays(mass, particles)
+        scheme = pygalaxy.Stormer_verlet(dt, len(bodies), engine, SoAStorage())
+        scheme.update(bodies.mass, bodies.state)
+
+    updates bodies in place. Give the time schemes a SoAStorage (or an
+    out_of_core.Storage with soa=True) so that their buffers have the same
+    layout.
+
+    Parameters:
+    -----------
+    n: int
+        Number of bodies.
+    """
+
+    components = ('x', 'y', 'vx', 'vy', 'mass')
+
+    def __init__(self, n):
+        self.data = np.zeros((5, n))
+
+    @classmethod
+    def from_arrays(cls, mass, particles):
+        """ Bodies of the (N,) mass and (N, 4) particles arrays. """
+        bodies = cls(mass.shape[0])
+        bodies.data[:4] = particles.T
+        bodies.data[4] = mass
+        return bodies
+
+    def to_arrays(self):
+        """ Copy of the bodies as (N,) mass and row major (N, 4) particles. """
+        return self.mass.copy(), np.ascontiguousarray(self.state)
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    @property
+    def state(self):
+        return self.data[:4].T
+
+    @property
+    def positions(self):
+        return self.data[:2].T
+
+    @property
+    def velocities(self):
+        return self.data[2:4].T
+
+    x = property(lambda self: self.data[0])
+    y = property(lambda self: self.data[1])
+    vx = property(lambda self: self.data[2])
+    vy = property(lambda self: self.data[3])
+    mass = property(lambda self: self.data[4])
+
+
+class SoAStorage(object):
+    """ In-memory storage of the time scheme buffers in the SoA layout (see
+    out_of_core.Storage for the interface). """
+
+    def zeros(self, shape, dtype=np.float64):
+        return zeros(shape, dtype)
+
+    def chunks(self, n):
+        return [slice(0, n)]
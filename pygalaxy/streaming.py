@@ -0,0 +1,259 @@
+import asyncio
+import collections
+import json
+import math
+import struct
+import threading
+
+import numpy as np
+
+from .codec import SnapshotCodec
+
+# message header: length of the JSON info, length of the encoded frame
+_MESSAGE = struct.Struct('<II')
+
+
+def _to_json(value):
+    # numpy scalars and arrays of the diagnostics
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+class _Client(object):
+    def __init__(self, writer, codec, max_pending):
+        self.writer = writer
+        self.codec = codec
+        self.pending = collections.deque(maxlen=max_pending)
+        self.ready = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+
+    def push(self, item):
+        # the oldest pending snapshot is dropped if the client is too slow
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+        self.pending.append(item)
+        self.ready.set()
+
+
+class SnapshotServer(object):
+    """ Stream snapshots of a running simulation to TCP clients.
+
+    The server runs an asyncio event loop on a background thread. The
+    simulation calls publish after its steps, which only copies the
+    decimated snapshot and hands it to the loop: the integrator never waits
+    for the clients. Each client has a queue of at most max_pending
+    snapshots, the oldest one is dropped when a new one arrives on a full
+    queue, so a slow client receives fewer frames without slowing the others.
+
+    Snapshots are encoded with a SnapshotCodec per client (delta frames are
+    relative to the last frame sent to that client). Each message is a
+    _MESSAGE header, a JSON dict (iteration, time, nbodies, diagnostics and
+    the number of frames dropped for the client) and the encoded frame, see
+    SnapshotClient.
+
+    Example:
+
+        with SnapshotServer(port=5555, max_bodies=100000) as server:
+            for it in range(niter):
+                scheme.update(mass, particles)
+                server.publish(it, particles, diagnostics=diag.update(...))
+
+    Parameters:
+    -----------
+    host: str
+        Address the server listens on, localhost by default.
+    port: int
+        Port of the server, a free one if 0 (see self.port).
+    every: int
+        Publication cadence in iterations.
+    bodies: array or None
+        Indices of the streamed bodies.
+    max_bodies: int or None
+        If bodies is None, the bodies are decimated with a constant stride
+        so that at most max_bodies are streamed (all if None).
+    components: slice or list
+        Streamed components of the state, the positions by default.
+    precision, compression, level, keyframe:
+        Parameters of the codec, see codec.SnapshotCodec.
+    max_pending: int
+        Number of snapshots queued per client.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, every=1, bodies=None,
+                 max_bodies=None, components=slice(0, 2), precision='float32',
+                 compression='zlib', level=1, keyframe=32, max_pending=2):
+        self.host = host
+        self.port = port
+        self.every = every
+        self.bodies = None if bodies is None else np.asarray(bodies)
+        self.max_bodies = max_bodies
+        self.components = components
+        self.codec_options = dict(precision=precision, compression=compression,
+                                  level=level, keyframe=keyframe)
+        self.max_pending = max_pending
+        self.clients = set()
+        self.published = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._tasks = set()
+
+    def start(self):
+        """ Start listening, returns self. """
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._handle, self.host, self.port),
+            self._loop).result()
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def close(self):
+        """ Disconnect the clients and stop the server. """
+        if self._loop is None:
+            return
+
+        async def shutdown():
+            self._server.close()
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def select(self, particles):
+        """ Copy of the streamed part of the state. """
+        if self.bodies is not None:
+            data = particles[self.bodies]
+        else:
+            stride = 1
+            if self.max_bodies is not None:
+                stride = max(1, math.ceil(particles.shape[0]/self.max_bodies))
+            data = particles[::stride]
+        return np.array(data[:, self.components], dtype=np.float64)
+
+    def publish(self, it, particles, time=None, diagnostics=None):
+        """ Send the snapshot of iteration it to the clients if it is due
+        (see every) and there are clients. Returns True if it was sent.
+
+        diagnostics is a JSON serializable dict (numpy scalars and arrays are
+        converted), e.g. the one returned by Diagnostics.update.
+        """
+        if self._loop is None or it % self.every != 0 or not self.clients:
+            return False
+        info = {'iteration': int(it), 'time': time,
+                'nbodies': particles.shape[0], 'diagnostics': diagnostics}
+        info = json.loads(json.dumps(info, default=_to_json))
+        item = (info, self.select(particles))
+        self._loop.call_soon_threadsafe(self._dispatch, item)
+        self.published += 1
+        return True
+
+    def _dispatch(self, item):
+        for client in self.clients:
+            client.push(item)
+
+    async def _handle(self, reader, writer):
+        client = _Client(writer, SnapshotCodec(**self.codec_options), self.max_pending)
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self.clients.add(client)
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await client.ready.wait()
+                client.ready.clear()
+                while client.pending:
+                    info, frame = client.pending.popleft()
+                    # encoded off the loop so that the other clients are served
+                    data = await loop.run_in_executor(None, client.codec.encode, frame)
+                    header = json.dumps(dict(info, dropped=client.dropped)).encode()
+                    writer.write(_MESSAGE.pack(len(header), len(data)) + header + data)
+                    await writer.drain()
+                    client.sent += 1
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.clients.discard(client)
+            self._tasks.discard(task)
+            writer.close()
+
+
+class SnapshotClient(object):
+    """ Client of a SnapshotServer.
+
+    Example:
+
+        client = await SnapshotClient.connect(port=5555)
+        async for info, frame in client:
+            print(info['iteration'], frame.shape)
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.codec = SnapshotCodec()
+
+    @classmethod
+    async def connect(cls, host='127.0.0.1', port=5555):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def receive(self):
+        """ Next snapshot, as (info dict, (nbodies, ncomp) frame). Raises
+        asyncio.IncompleteReadError when the server closed the connection. """
+        header_size, frame_size = _MESSAGE.unpack(
+            await self.reader.readexactly(_MESSAGE.size))
+        info = json.loads(await self.reader.readexactly(header_size))
+        frame = self.codec.decode(await self.reader.readexactly(frame_size))
+        return info, frame
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.receive()
+        except asyncio.IncompleteReadError:
+            raise StopAsyncIteration
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+def receive_snapshots(count, host='127.0.0.1', port=5555, timeout=10.):
+    """ Connect to a server and return its next count snapshots (fewer if
+    the server stops), as a list of (info, frame). Blocking. """
+    async def receive():
+        client = await SnapshotClient.connect(host, port)
+        snapshots = []
+        try:
+            async for snapshot in client:
+                snapshots.append(snapshot)
+                if len(snapshots) == count:
+                    break
+        finally:
+            await client.close()
+        return snapshots
+
+    async def run():
+        return await asyncio.wait_for(receive(), timeout)
+
+    return asyncio.run(run())
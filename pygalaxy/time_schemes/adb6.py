@@ -1,34 +1,60 @@
 import numpy as np
 from .rk4 import RK4
+from .scheme import TimeScheme
 
-class ADB6:
-    def __init__(self, dt, nbodies, method):
+class ADB6(TimeScheme):
+    state_attributes = ('f', 'nsteps')
+    body_attributes = ('f',)
+
+    def __init__(self, dt, nbodies, method, storage=None, dim=2):
         self.dt = dt
         self.method = method
+        self.storage = storage
+        self.dim = dim
         self.c = [4277.0 / 1440.0,
                  -7923.0 / 1440.0,
                   9982.0 / 1440.0,
                  -7298.0 / 1440.0,
                   2877.0 / 1440.0,
                   -475.0 / 1440.0]
-        self.f = np.zeros((6, nbodies, 4)) 
+        self.f = self.zeros((6, nbodies, 2*dim))
+        # the first 5 steps are done with RK4 to fill the history f
+        self.nsteps = 0
+        self.rk4 = None
 
     def init(self, mass, particles):
-        nbodies = mass.nbodies
-        rk4 = RK4(self.dt, nbodies, self.method)
+        while self.nsteps < 5:
+            self.update(mass, particles)
 
-        for i in range(5):
-            rk4.update(self, mass, particles)
-            self.f[i, :] = rk4.k1 
-        
-        self.method(mass, particles, self.f[5])
+    def resize(self, keep):
+        # the history of the merged bodies is not the one of their new
+        # state: restart the RK4 bootstrap
+        super().resize(keep)
+        self.nsteps = 0
+        self.rk4 = None
 
     def update(self, mass, particles):
-        particles[:, :] += self.dt * (self.c[0] * self.f[5] +
-                                      self.c[1] * self.f[4] +
-                                      self.c[2] * self.f[3] +
-                                      self.c[3] * self.f[2] +
-                                      self.c[4] * self.f[1] +
-                                      self.c[5] * self.f[0])
-        self.f = np.roll(self.f, -1, axis=0)
+        if self.nsteps < 5:
+            if self.rk4 is None:
+                self.rk4 = RK4(self.dt, particles.shape[0], self.method, self.storage,
+                               self.dim)
+            self.rk4.update(mass, particles)
+            self.f[self.nsteps, :] = self.rk4.k1
+            self.nsteps += 1
+            if self.nsteps == 5:
+                self.method(mass, particles, self.f[5])
+                self.rk4 = None
+            return
+
+        for s in self.chunks(particles.shape[0]):
+            f = self.f[:, s]
+            particles[s] += self.dt * (self.c[0] * f[5] +
+                                       self.c[1] * f[4] +
+                                       self.c[2] * f[3] +
+                                       self.c[3] * f[2] +
+                                       self.c[4] * f[1] +
+                                       self.c[5] * f[0])
+            # in place, the buffer may be memory-mapped
+            f[:] = np.roll(f, -1, axis=0)
         self.method(mass, particles, self.f[5])
+        self.nsteps += 1
@@ -1,29 +1,42 @@
 import numpy as np
+from .scheme import TimeScheme
 
-class Euler:
-    def __init__(self, dt, nbodies, method):
+class Euler(TimeScheme):
+    body_attributes = ('k1',)
+
+    def __init__(self, dt, nbodies, method, storage=None, dim=2):
         self.dt = dt
         self.method = method
-        self.k1 = np.zeros((nbodies, 4))
+        self.storage = storage
+        self.dim = dim
+        self.k1 = self.zeros((nbodies, 2*dim))
 
     def init(self, mass, particles):
         pass
 
     def update(self, mass, particles):
         self.method(mass, particles, self.k1)
-        particles[:, :] += self.dt*self.k1
+        for s in self.chunks(particles.shape[0]):
+            particles[s] += self.dt*self.k1[s]
+
+class Euler_symplectic(TimeScheme):
+    body_attributes = ('k1',)
 
-class Euler_symplectic:
-    def __init__(self, dt, nbodies, method):
+    def __init__(self, dt, nbodies, method, storage=None, dim=2):
         self.dt = dt
         self.method = method
-        self.k1 = np.zeros((nbodies, 4))
+        self.storage = storage
+        self.dim = dim
+        self.k1 = self.zeros((nbodies, 2*dim))
 
     def init(self, mass, particles):
         pass
 
     def update(self, mass, particles):
+        chunks = self.chunks(particles.shape[0])
         self.method(mass, particles, self.k1)
-        particles[:, :2] += self.dt*self.k1[:, :2]
+        for s in chunks:
+            particles[s, :self.dim] += self.dt*self.k1[s, :self.dim]
         self.method(mass, particles, self.k1)
-        particles[:, 2:] += self.dt*self.k1[:, 2:]
\ No newline at end of file
+        for s in chunks:
+            particles[s, self.dim:] += self.dt*self.k1[s, self.dim:]
\ No newline at end of file
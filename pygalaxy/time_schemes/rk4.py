@@ -1,32 +1,43 @@
 import numpy as np
+from .scheme import TimeScheme
 
-class RK4:
-    def __init__(self, dt, nbodies, method):
+class RK4(TimeScheme):
+    body_attributes = ('k1', 'k2', 'k3', 'k4', 'tmp')
+
+    def __init__(self, dt, nbodies, method, storage=None, dim=2):
         self.dt = dt
         self.method = method
-        self.k1 = np.zeros((nbodies, 4)) 
-        self.k2 = np.zeros((nbodies, 4)) 
-        self.k3 = np.zeros((nbodies, 4)) 
-        self.k4 = np.zeros((nbodies, 4)) 
-        self.tmp = np.zeros((nbodies, 4))
+        self.storage = storage
+        self.dim = dim
+        self.k1 = self.zeros((nbodies, 2*dim))
+        self.k2 = self.zeros((nbodies, 2*dim))
+        self.k3 = self.zeros((nbodies, 2*dim))
+        self.k4 = self.zeros((nbodies, 2*dim))
+        self.tmp = self.zeros((nbodies, 2*dim))
 
     def init(self, mass, particles):
         pass
 
     def update(self, mass, particles):
+        chunks = self.chunks(particles.shape[0])
+
         # k1
         self.method(mass, particles, self.k1)
-        self.tmp[:, :] = particles[:, :4] + self.dt*0.5*self.k1
+        for s in chunks:
+            self.tmp[s] = particles[s, :2*self.dim] + self.dt*0.5*self.k1[s]
 
         # k2
         self.method(mass, self.tmp, self.k2)
-        self.tmp[:, :] = particles[:, :4] + self.dt*0.5*self.k2
+        for s in chunks:
+            self.tmp[s] = particles[s, :2*self.dim] + self.dt*0.5*self.k2[s]
 
         # k3
         self.method(mass, self.tmp, self.k3)
-        self.tmp[:, :] = particles[:, :4] + self.dt*self.k3
+        for s in chunks:
+            self.tmp[s] = particles[s, :2*self.dim] + self.dt*self.k3[s]
 
         # k4
         self.method(mass, self.tmp, self.k4)
 
-        particles[:, :] += self.dt/6*(self.k1 + 2*(self.k2+self.k3) + self.k4)
\ No newline at end of file
+        for s in chunks:
+            particles[s] += self.dt/6*(self.k1[s] + 2*(self.k2[s]+self.k3[s]) + self.k4[s])
\ No newline at end of file
@@ -0,0 +1,71 @@
+import numpy as np
+
+class TimeScheme:
+    """ Base of the time schemes, providing checkpoint and restore.
+
+    The attributes listed in state_attributes (besides dt) are the state
+    needed to continue the integration; work buffers overwritten at each
+    update are not saved. The attributes listed in body_attributes are the
+    buffers with one row per body (their next to last dimension), resized
+    when bodies are removed.
+
+    The state of the bodies is an (N, 2*dim) array, the dim components of
+    the positions followed by those of the velocities (dim is 2 by default,
+    3 for the octree engine).
+
+    If the scheme is given a storage (an out_of_core.Storage), its buffers
+    are memory-mapped arrays and the updates are done by chunks of bodies.
+    """
+    state_attributes = ()
+    body_attributes = ()
+    storage = None
+
+    def zeros(self, shape):
+        """ New buffer, memory-mapped if the scheme has a storage. """
+        if self.storage is None:
+            return np.zeros(shape)
+        return self.storage.zeros(shape)
+
+    def chunks(self, n):
+        """ Slices of the chunks of n bodies the updates are done by. """
+        if self.storage is None:
+            return [slice(0, n)]
+        return self.storage.chunks(n)
+
+    def checkpoint(self):
+        """ Return the integrator state as a dict of arrays. """
+        state = {'dt': np.asarray(self.dt)}
+        for name in self.state_attributes:
+            state[name] = np.array(getattr(self, name))
+        return state
+
+    def restore(self, state):
+        """ Restore a state returned by checkpoint. """
+        self.dt = np.asarray(state['dt']).item()
+        for name in self.state_attributes:
+            value = getattr(self, name)
+            if isinstance(value, np.ndarray):
+                value[...] = state[name]
+            else:
+                setattr(self, name, np.asarray(state[name]).item())
+
+    def resize(self, keep):
+        """ Keep only the bodies selected by the boolean array keep (e.g.
+        after bodies merged) in the buffers of body_attributes. """
+        for name in self.body_attributes:
+            value = getattr(self, name)
+            if value.shape[-2] != keep.size:
+                raise ValueError('{} has {} bodies, keep has {}'
+                                 .format(name, value.shape[-2], keep.size))
+            setattr(self, name, self._select(value, keep))
+
+    def _select(self, value, keep):
+        # copy in a buffer of the scheme, to keep its storage and layout
+        shape = value.shape[:-2] + (np.count_nonzero(keep),) + value.shape[-1:]
+        selected = self.zeros(shape)
+        start = 0
+        for s in self.chunks(keep.size):
+            chunk = value[..., s, :][..., keep[s], :]
+            selected[..., start:start + chunk.shape[-2], :] = chunk
+            start += chunk.shape[-2]
+        return selected
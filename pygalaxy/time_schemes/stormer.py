@@ -1,33 +1,48 @@
 import numpy as np
+from .scheme import TimeScheme
 
 
-def stormer(dt, mass, particles, method, k1):
+def stormer(dt, mass, particles, method, k1, chunks=(slice(None),)):
+        # positions then velocities, dim components each
+        dim = k1.shape[1]//2
         method(mass, particles, k1)
-        particles[:, 2:] += .5*dt*k1[:, 2:]
+        for s in chunks:
+            particles[s, dim:] += .5*dt*k1[s, dim:]
         
         method(mass, particles, k1)
-        particles[:, :2] += dt*k1[:, :2]
+        for s in chunks:
+            particles[s, :dim] += dt*k1[s, :dim]
 
         method(mass, particles, k1)
-        particles[:, 2:] += .5*dt*k1[:, 2:]
+        for s in chunks:
+            particles[s, dim:] += .5*dt*k1[s, dim:]
 
-class Stormer_verlet:
-    def __init__(self, dt, nbodies, method):
+class Stormer_verlet(TimeScheme):
+    body_attributes = ('k1',)
+
+    def __init__(self, dt, nbodies, method, storage=None, dim=2):
         self.dt = dt
         self.method = method
-        self.k1 = np.zeros((nbodies, 4))
+        self.storage = storage
+        self.dim = dim
+        self.k1 = self.zeros((nbodies, 2*dim))
 
     def init(self, mass, particles):
         pass
 
     def update(self, mass, particles):
-        stormer(self.dt, mass, particles, self.method, self.k1)
+        stormer(self.dt, mass, particles, self.method, self.k1,
+                self.chunks(particles.shape[0]))
+
+class Optimized_815(TimeScheme):
+    body_attributes = ('k1',)
 
-class Optimized_815:
-    def __init__(self, dt, nbodies, method):
+    def __init__(self, dt, nbodies, method, storage=None, dim=2):
         self.dt = dt
         self.method = method
-        self.k1 = np.zeros((nbodies, 4))
+        self.storage = storage
+        self.dim = dim
+        self.k1 = self.zeros((nbodies, 2*dim))
         self.gamma = np.zeros(15)
         self.gamma[0]  =  0.74167036435061295344822780
         self.gamma[1]  = -0.40910082580003159399730010
@@ -50,5 +65,6 @@ class Optimized_815:
 
     def update(self, mass, particles):
         for g in self.gamma:
-            stormer(g*self.dt, mass, particles, self.method, self.k1)
+            stormer(g*self.dt, mass, particles, self.method, self.k1,
+                    self.chunks(particles.shape[0]))
 
@@ -0,0 +1,250 @@
+import queue
+import threading
+
+import numpy as np
+
+from .codec import SnapshotAppender
+
+# Fixed size of the .npy header so that it can be rewritten in place when
+# frames are appended (the shape only grows in its first dimension).
+HEADER_SIZE = 256
+
+
+class NpyAppender(object):
+    """ .npy file of shape (frames, *frame_shape) growing frame by frame.
+
+    The header is rewritten after each append so that the file is always a
+    valid .npy file readable with numpy.load (also with mmap_mode), even if
+    the run crashes.
+    """
+
+    def __init__(self, path, frame_shape, dtype=np.float64):
+        self.path = path
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.nframes = 0
+        self._file = open(path, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+            np.lib.format.dtype_to_descr(self.dtype),
+            (self.nframes, *self.frame_shape))
+        prefix = np.lib.format.magic(1, 0)
+        length = HEADER_SIZE - len(prefix) - 2
+        header = header.ljust(length - 1) + '\n'
+        self._file.seek(0)
+        self._file.write(prefix)
+        self._file.write(np.uint16(length).tobytes())
+        self._file.write(header.encode('latin1'))
+
+    def append(self, frame):
+        """ Append one frame of shape frame_shape. """
+        frame = np.ascontiguousarray(frame, dtype=self.dtype)
+        if frame.shape != self.frame_shape:
+            raise ValueError('frame shape {} differs from {}'.format(
+                frame.shape, self.frame_shape))
+
+        self._file.seek(0, 2)
+        self._file.write(frame.tobytes())
+        self.nframes += 1
+        self._write_header()
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class TrajectoryWriter(object):
+    """ Stream snapshots of a simulation to .npy files on a background thread.
+
+    Each stream writes the state of a subset of the bodies (all by default)
+    every `every` iterations. Snapshots are copied and queued; at most
+    max_pending snapshots are kept in memory, write blocks when the queue is
+    full, so the memory footprint does not depend on the length of the run.
+
+    Example: full snapshots every 100 iterations and 10 tracers at each one
+
+        writer = TrajectoryWriter()
+        writer.add_stream('particles.npy', every=100)
+        writer.add_stream('tracers.npy', bodies=np.arange(10))
+        for it in range(niter):
+            simu.next()
+            writer.write(it, simu.particles)
+        writer.close()
+    """
+
+    class _Stream(object):
+        def __init__(self, path, every, bodies, dtype, codec):
+            self.path = path
+            self.every = every
+            self.bodies = None if bodies is None else np.asarray(bodies)
+            self.dtype = dtype
+            self.codec = codec
+            self.file = None
+
+        def open(self, snapshot):
+            if self.codec is None:
+                self.file = NpyAppender(self.path, snapshot.shape, snapshot.dtype)
+            else:
+                self.file = SnapshotAppender(self.path, self.codec)
+
+        def select(self, particles):
+            if self.bodies is None:
+                return particles.astype(self.dtype, copy=True)
+            return particles[self.bodies].astype(self.dtype, copy=False)
+
+    def __init__(self, max_pending=4):
+        self.streams = []
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add_stream(self, path, every=1, bodies=None, dtype=np.float64,
+                   codec=None):
+        """ Add an output file.
+
+        Parameters:
+        -----------
+        path: str
+            Output file, a .npy file of shape (frames, nbodies, 4) unless a
+            codec is given.
+        every: int
+            Write cadence in iterations.
+        bodies: array or None
+            Indices of the bodies to write, all if None.
+        dtype: numpy dtype
+            Data type of the written state.
+        codec: codec.SnapshotCodec or None
+            If given, snapshots are encoded with the codec (on the writer
+            thread) and the file is read with codec.read_snapshots.
+        """
+        stream = TrajectoryWriter._Stream(path, every, bodies, dtype, codec)
+        self.streams.append(stream)
+        return stream
+
+    def write(self, it, particles):
+        """ Queue the snapshot of iteration it for the streams it is due for. """
+        self._check()
+        for stream in self.streams:
+            if it % stream.every == 0:
+                self._queue.put((stream, stream.select(particles)))
+
+    def close(self):
+        """ Write pending snapshots and close the files. """
+        self._queue.put(None)
+        self._thread.join()
+        for stream in self.streams:
+            if stream.file is not None:
+                stream.file.close()
+        self._check()
+
+    def _check(self):
+        if self._error is not None:
+            raise RuntimeError('trajectory writer failed') from self._error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+
+            stream, snapshot = item
+            try:
+                if stream.file is None:
+                    stream.open(snapshot)
+                stream.file.append(snapshot)
+            except Exception as e:
+                self._error = e
+
+
+class TrajectoryReader(object):
+    """ Lazy access to a (frames, nbodies, ncomp) .npy trajectory.
+
+    The file is memory-mapped: nothing is read until data is accessed, and
+    the iterate/reduce methods go through the frames by chunks of at most
+    chunk_size bytes, so analysing runs larger than the memory uses a
+    constant amount of it.
+
+    Example: speed of bodies 1 to 10 every 10 frames
+
+        traj = TrajectoryReader('particles.npy')
+        speeds = traj.speed(bodies=slice(1, 11), frames=slice(None, None, 10))
+    """
+
+    # components of the state
+    X, Y, VX, VY = range(4)
+
+    def __init__(self, path, chunk_size=64*2**20):
+        self.path = path
+        self.data = np.load(path, mmap_mode='r')
+        self.chunk_size = chunk_size
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def nframes(self):
+        return self.data.shape[0]
+
+    @property
+    def nbodies(self):
+        return self.data.shape[1]
+
+    def __len__(self):
+        return self.nframes
+
+    def __getitem__(self, key):
+        """ Memory-mapped view (or copy, for index arrays) of the data. """
+        return self.data[key]
+
+    def iterate(self, frames=slice(None), bodies=slice(None),
+                components=slice(None)):
+        """ Yield (frame indices, data) chunks of the selection.
+
+        Parameters:
+        -----------
+        frames: slice
+            Frame range and stride.
+        bodies: slice or array
+            Selected bodies.
+        components: slice, int or array
+            Selected components, e.g. slice(0, 2) for the positions.
+        """
+        indices = np.arange(self.nframes)[frames]
+        if indices.size == 0:
+            return
+
+        frame_bytes = self.data[0][bodies][..., components].nbytes
+        nchunk = max(1, self.chunk_size // max(frame_bytes, 1))
+
+        for start in range(0, indices.size, nchunk):
+            chunk = indices[start:start + nchunk]
+            # slices keep the memory map, only the selection is read
+            step = chunk[1] - chunk[0] if chunk.size > 1 else 1
+            stop = chunk[-1] + (1 if step > 0 else -1)
+            # a negative stride down to the first frame has no stop
+            data = self.data[chunk[0]:stop if stop >= 0 else None:step]
+            yield chunk, np.array(data[:, bodies][..., components])
+
+    def reduce(self, func, frames=slice(None), bodies=slice(None),
+               components=slice(None)):
+        """ Apply func to the selection chunk by chunk.
+
+        func receives a (frames, bodies, components) array and returns an
+        array whose first dimension is the frame one; the results of the
+        chunks are concatenated.
+        """
+        results = [func(data) for _, data in self.iterate(frames, bodies, components)]
+        if not results:
+            return np.empty(0)
+        return np.concatenate(results)
+
+    def speed(self, frames=slice(None), bodies=slice(None)):
+        """ Speed magnitudes, of shape (frames, bodies). """
+        return self.reduce(lambda v: np.sqrt(v[..., 0]**2 + v[..., 1]**2),
+                           frames, bodies, slice(self.VX, self.VY + 1))
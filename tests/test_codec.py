@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+
+from pygalaxy.codec import SnapshotCodec
+
+
+@pytest.mark.parametrize('precision', ['uint16', 'uint32', 'float32', 'float64'])
+def test_empty_frame(precision):
+    # all the bodies removed, then new ones
+    frames = [np.random.default_rng(0).random((5, 4)), np.empty((0, 4)),
+              np.empty((0, 4)), np.random.default_rng(1).random((3, 4))]
+    codec = SnapshotCodec(precision)
+    for frame in frames:
+        decoded = codec.decode(codec.encode(frame))
+        assert decoded.shape == frame.shape
+        np.testing.assert_allclose(decoded, frame, atol=1e-4)
@@ -0,0 +1,48 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+GL = pytest.importorskip('OpenGL.GL')
+GLUT = pytest.importorskip('OpenGL.GLUT')
+
+
+@pytest.fixture(scope='module')
+def context():
+    if sys.platform.startswith('linux') and not os.environ.get('DISPLAY'):
+        # freeglut exits the process when it cannot open a display
+        pytest.skip('no display for an OpenGL context')
+    try:
+        GLUT.glutInit()
+        GLUT.glutInitDisplayMode(GLUT.GLUT_RGBA)
+        window = GLUT.glutCreateWindow(b'test')
+    except Exception as e:
+        pytest.skip('no OpenGL context: {}'.format(e))
+    GLUT.glutHideWindow()
+    yield
+    GLUT.glutDestroyWindow(window)
+
+
+def uploaded(buffer):
+    buffer.bind()
+    data = GL.glGetBufferSubData(GL.GL_ARRAY_BUFFER, 0, buffer.data.nbytes)
+    return np.frombuffer(data, dtype=np.float32).reshape(buffer.data.shape)
+
+
+def test_buffer_only_if_changed(context):
+    from pygalaxy.opengl import Animation
+    buffer = Animation._Buffer()
+    a = np.arange(8.).reshape(4, 2)
+    b = a + .5
+    assert buffer.update(a, only_if_changed=True) == a.size*4
+    assert buffer.update(a, only_if_changed=True) == 0
+    assert buffer.update(b, only_if_changed=True) == b.size*4
+    np.testing.assert_array_equal(uploaded(buffer), b)
+    # a is still in the spare host array after the swap
+    assert buffer.update(a, only_if_changed=True) == a.size*4
+    np.testing.assert_array_equal(uploaded(buffer), a)
+    assert buffer.update(a, only_if_changed=True) == 0
+    # a new shape reallocates the buffer
+    assert buffer.update(np.ones((2, 2)), only_if_changed=True) == 16
+    np.testing.assert_array_equal(uploaded(buffer), np.ones((2, 2)))
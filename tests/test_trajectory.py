@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from pygalaxy.trajectory import TrajectoryReader
+
+
+@pytest.fixture
+def trajectory(tmp_path):
+    path = str(tmp_path / 'trajectory.npy')
+    np.save(path, np.random.default_rng(0).random((10, 5, 4)))
+    return path
+
+
+@pytest.mark.parametrize('frames', [
+    slice(None), slice(None, None, 2), slice(1, 9, 3), slice(None, None, -1),
+    slice(None, None, -3), slice(8, 2, -2), slice(2, None, -1), slice(5, 5)])
+@pytest.mark.parametrize('chunk_size', [1, 3*5*4*8, 2**20])
+def test_iterate(trajectory, frames, chunk_size):
+    expected = np.load(trajectory)[frames]
+    reader = TrajectoryReader(trajectory, chunk_size=chunk_size)
+    chunks = list(reader.iterate(frames))
+    indices = np.concatenate([c for c, _ in chunks]) if chunks else np.empty(0, int)
+    data = np.concatenate([d for _, d in chunks]) if chunks else np.empty((0, 5, 4))
+    np.testing.assert_array_equal(indices, np.arange(10)[frames])
+    np.testing.assert_array_equal(data, expected)
+    if expected.size:
+        np.testing.assert_array_equal(reader.speed(frames),
+                                      np.sqrt(expected[..., 2]**2 + expected[..., 3]**2))
@@ -0,0 +1,15 @@
+import numpy as np
+
+from pygalaxy.barnes_hut_array.energy import build_tree
+
+
+def test_mass_distribution():
+    # fractional masses and positions: the cells accumulate in floats
+    rng = np.random.default_rng(0)
+    particles = rng.random((100, 4)) - .5
+    mass = rng.random(100)
+    root = build_tree(mass, particles)
+    n = root.nbodies
+    np.testing.assert_allclose(root.mass[n], mass.sum())
+    np.testing.assert_allclose(root.center_of_mass[n],
+                               (mass[:, None]*particles[:, :2]).sum(axis=0)/mass.sum())